@@ -0,0 +1,55 @@
+"""
+Pet model benchmarks
+
+    $ python -m pytest benchmarks/bench_models.py --benchmark-json=models.json
+"""
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from service.models import Pet  # pylint: disable=wrong-import-position
+
+
+def test_save(benchmark, catalog):
+    """Save an existing Pet"""
+    pet = Pet(catalog // 2, "fido", "dog")
+    benchmark(pet.save)
+
+
+def test_create(benchmark, catalog):
+    """Save a new Pet"""
+    benchmark(lambda: Pet(0, "fido", "dog").save())
+
+
+def test_find(benchmark, catalog):
+    """Find a Pet by its id"""
+    assert benchmark(Pet.find, catalog // 2)
+
+
+def test_all(benchmark, catalog):
+    """List all of the Pets"""
+    pets = benchmark.pedantic(Pet.all, rounds=3)
+    assert len(pets) >= catalog
+
+
+def test_find_by_name(benchmark, catalog):
+    """Find a Pet by its unique name"""
+    assert len(benchmark(Pet.find_by_name, "pet0")) == 1
+
+
+def test_find_by_category(benchmark, catalog):
+    """Find the fifth of the Pets that are in a category"""
+    pets = benchmark.pedantic(Pet.find_by_category, args=("cat",), rounds=3)
+    assert pets
+
+
+def test_find_by_availability(benchmark, catalog):
+    """Find the half of the Pets that are available"""
+    pets = benchmark.pedantic(Pet.find_by_availability, args=(True,), rounds=3)
+    assert pets
+
+
+def test_iter_json(benchmark, catalog):
+    """Serialize all of the Pets from their stored JSON"""
+    pets = benchmark.pedantic(lambda: list(Pet.iter_json()), rounds=3)
+    assert len(pets) >= catalog
@@ -0,0 +1,116 @@
+"""
+Pet service route benchmarks
+
+Every route is measured through the Flask test client, so the numbers
+include the routing, the model and Redis but not the network or gunicorn.
+
+    $ python -m pytest benchmarks/bench_routes.py --benchmark-json=routes.json
+"""
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+# pylint: disable=wrong-import-position
+from service import routes
+from service.models import Pet
+
+PET = {"name": "fido", "category": "dog", "available": True}
+
+
+def new_pet():
+    """Setup for benchmarks that use up a Pet, returns the path to it"""
+    pet = Pet(0, "fido", "dog", True)
+    pet.save()
+    return ("/pets/{}".format(pet.id),), {}
+
+
+def check(response, code=200):
+    """Asserts that a request succeeded"""
+    assert response.status_code == code, response.data
+    return response
+
+
+def test_index(benchmark, client, catalog):
+    """GET /"""
+    check(benchmark(client.get, "/"))
+
+
+@pytest.mark.parametrize("cache_ttl", [0, 60], ids=["uncached", "cached"])
+def test_list_pets(benchmark, client, catalog, cache_ttl, monkeypatch):
+    """GET /pets"""
+    monkeypatch.setattr(routes, "RESPONSE_CACHE_TTL", cache_ttl)
+    check(benchmark.pedantic(client.get, args=("/pets",), rounds=5))
+
+
+def test_query_pets(benchmark, client, catalog):
+    """GET /pets?category=cat"""
+    check(benchmark.pedantic(client.get, args=("/pets?category=cat",), rounds=5))
+
+
+def test_list_pets_page(benchmark, client, catalog):
+    """GET /pets?limit=100"""
+    check(benchmark(client.get, "/pets?limit=100"))
+
+
+def test_stream_pets(benchmark, client, catalog):
+    """GET /pets?stream=true"""
+    response = benchmark.pedantic(
+        lambda: check(client.get("/pets?stream=true")).get_data(), rounds=5
+    )
+    assert response
+
+
+def test_get_pet(benchmark, client, catalog):
+    """GET /pets/<id>"""
+    check(benchmark(client.get, "/pets/{}".format(catalog // 2)))
+
+
+def test_create_pet(benchmark, client, catalog):
+    """POST /pets"""
+    check(benchmark(client.post, "/pets", json=PET), 201)
+
+
+def test_create_pet_batch(benchmark, client, catalog):
+    """POST /pets/batch with 100 Pets"""
+    check(benchmark(client.post, "/pets/batch", json=[PET] * 100), 201)
+
+
+def test_update_pet(benchmark, client, catalog):
+    """PUT /pets/<id>"""
+    check(benchmark(client.put, "/pets/{}".format(catalog // 2), json=PET))
+
+
+def test_patch_pet(benchmark, client, catalog):
+    """PATCH /pets/<id>"""
+    path = "/pets/{}".format(catalog // 2)
+    check(benchmark(client.patch, path, json={"category": "k9"}))
+
+
+def test_update_pet_batch(benchmark, client, catalog):
+    """PUT /pets/batch with 100 Pets"""
+    pets = [dict(PET, id=pet_id) for pet_id in range(1, 101)]
+    check(benchmark(client.put, "/pets/batch", json=pets))
+
+
+def test_delete_pet(benchmark, client, catalog):
+    """DELETE /pets/<id>"""
+    check(benchmark.pedantic(client.delete, setup=new_pet, rounds=100), 204)
+
+
+def test_delete_pet_batch(benchmark, client, catalog):
+    """DELETE /pets/batch with 100 Pets"""
+
+    def new_pets():
+        pets = Pet.create_many([Pet(0, "fido", "dog") for _ in range(100)])
+        return ("/pets/batch",), {"json": [pet.id for pet in pets]}
+
+    check(benchmark.pedantic(client.delete, setup=new_pets, rounds=20))
+
+
+def test_purchase_pet(benchmark, client, catalog):
+    """PUT /pets/<id>/purchase"""
+
+    def purchase(path):
+        return client.put(path + "/purchase")
+
+    check(benchmark.pedantic(purchase, setup=new_pet, rounds=100))
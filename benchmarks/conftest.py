@@ -0,0 +1,35 @@
+"""
+Fixtures for the benchmarks
+
+Set BENCH_PETS to a comma separated list of catalog sizes to run every
+benchmark against, for example BENCH_PETS=1000,100000,1000000
+"""
+import os
+import logging
+import pytest
+from service import app, routes
+from service.models import Pet
+from benchmarks.seed import seed
+
+SIZES = [int(size) for size in os.getenv("BENCH_PETS", "1000").split(",")]
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    """Connects to Redis once for all of the benchmarks"""
+    routes.initialize_logging(logging.CRITICAL)
+    routes.init_db()
+    yield
+    Pet.remove_all()
+
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda size: "{}pets".format(size))
+def catalog(request):
+    """Seeds a catalog and returns the number of Pets in it"""
+    return seed(request.param)
+
+
+@pytest.fixture
+def client():
+    """Returns a test client for the service"""
+    return app.test_client()
@@ -0,0 +1,85 @@
+"""
+JSON codec benchmark
+
+Measures the CPU time per request of the routes that encode or decode
+through the JSON codec, with every codec that is installed: GET /pets/<id>,
+a page of GET /pets?limit= and POST /pets/batch with an NDJSON body. The
+full listing of GET /pets is left out because it passes the stored JSON
+through without the codec. Run it against a Redis that holds nothing you
+want to keep:
+
+    $ python -m benchmarks.json_codec --pets 1000 --requests 200
+"""
+import json
+import time
+import logging
+import argparse
+from service import app, codec, routes
+from service.models import Pet
+from benchmarks.seed import seed
+
+
+def measure(send, requests):
+    """Returns the CPU milliseconds spent per request"""
+    send(0)  # warm up
+    start = time.process_time()
+    for number in range(requests):
+        response = send(number)
+        assert response.status_code < 300, response.status_code
+    return (time.process_time() - start) * 1000 / requests
+
+
+def main():
+    """Loads the Pets and prints the cost of each route for each codec"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pets", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+
+    routes.initialize_logging(logging.CRITICAL)
+    routes.init_db()
+    seed(args.pets)
+    client = app.test_client()
+    batch = "\n".join(
+        json.dumps({"name": "pet{}".format(i), "category": "dog", "available": True})
+        for i in range(args.batch)
+    )
+    requests = [
+        (
+            "GET /pets/<id>",
+            lambda number: client.get("/pets/{}".format(number % args.pets + 1)),
+        ),
+        (
+            "GET /pets?limit={}".format(args.page),
+            lambda number: client.get("/pets", query_string={"limit": args.page}),
+        ),
+        (
+            "POST /pets/batch x{}".format(args.batch),
+            lambda number: client.post(
+                "/pets/batch", data=batch, content_type=routes.NDJSON
+            ),
+        ),
+    ]
+    default = codec.name
+    print(
+        "{:<24} {:<8} {:>12} {:>9}".format("request", "codec", "ms/request", "savings")
+    )
+    for label, send in requests:
+        baseline = None
+        for name in ["json"] + [name for name in codec.CODECS if name != "json"]:
+            codec.use(name)
+            cost = measure(send, args.requests)
+            baseline = baseline or cost
+            print(
+                "{:<24} {:<8} {:>12.3f} {:>8.0%}".format(
+                    label, name, cost, 1 - cost / baseline
+                )
+            )
+    codec.use(default)
+    Pet.remove_all()
+
+
+if __name__ == "__main__":
+    main()
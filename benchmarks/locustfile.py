@@ -0,0 +1,104 @@
+"""
+Load test for the Pet service
+
+Start the service against a local redis-server, seed a catalog and then
+run locust headless. The --csv option writes the request statistics and
+their history as CSV files that can be compared across releases:
+
+    $ python -m benchmarks.seed --pets 100000
+    $ honcho start
+    $ locust -f benchmarks/locustfile.py --host http://localhost:5000 \\
+        --headless --users 50 --spawn-rate 10 --run-time 1m --csv results/pets
+
+Set BENCH_PETS to the size of the seeded catalog so that reads hit it.
+"""
+import os
+import random
+from locust import HttpUser, between, task
+
+CATALOG_SIZE = int(os.getenv("BENCH_PETS", "1000").split(",")[0])
+CATEGORIES = ["dog", "cat", "fish", "bird", "lizard"]
+
+
+def new_pet():
+    """Returns the body of a new Pet"""
+    return {"name": "fido", "category": random.choice(CATEGORIES), "available": True}
+
+
+class PetShopper(HttpUser):
+    """A client that mostly browses the catalog and sometimes changes it"""
+
+    wait_time = between(0.1, 0.5)
+
+    def pet_path(self):
+        """Returns the path of a random Pet in the seeded catalog"""
+        return "/pets/{}".format(random.randint(1, CATALOG_SIZE))
+
+    @task(20)
+    def get_pet(self):
+        """GET /pets/<id>"""
+        self.client.get(self.pet_path(), name="/pets/[id]")
+
+    @task(5)
+    def query_pets(self):
+        """GET /pets?category="""
+        category = random.choice(CATEGORIES)
+        self.client.get("/pets?category=" + category, name="/pets?category=[category]")
+
+    @task(5)
+    def list_pets_page(self):
+        """GET /pets?limit=100"""
+        self.client.get("/pets?limit=100", name="/pets?limit=100")
+
+    @task(1)
+    def list_pets(self):
+        """GET /pets"""
+        self.client.get("/pets", name="/pets")
+
+    @task(1)
+    def stream_pets(self):
+        """GET /pets?stream=true"""
+        self.client.get("/pets?stream=true", name="/pets?stream=true")
+
+    @task(1)
+    def index(self):
+        """GET /"""
+        self.client.get("/")
+
+    @task(3)
+    def update_pet(self):
+        """PUT /pets/<id>"""
+        self.client.put(self.pet_path(), json=new_pet(), name="/pets/[id]")
+
+    @task(3)
+    def patch_pet(self):
+        """PATCH /pets/<id>"""
+        self.client.patch(
+            self.pet_path(), json={"available": True}, name="/pets/[id]"
+        )
+
+    @task(2)
+    def purchase_pet(self):
+        """PUT /pets/<id>/purchase"""
+        path = self.pet_path() + "/purchase"
+        with self.client.put(
+            path, name="/pets/[id]/purchase", catch_response=True
+        ) as response:
+            if response.status_code == 400:  # someone else bought it first
+                response.success()
+
+    @task(2)
+    def create_and_delete_pet(self):
+        """POST /pets and DELETE /pets/<id>"""
+        response = self.client.post("/pets", json=new_pet())
+        if response.status_code == 201:
+            self.client.delete(response.headers["Location"], name="/pets/[id]")
+
+    @task(1)
+    def batches(self):
+        """POST, PUT and DELETE /pets/batch"""
+        response = self.client.post("/pets/batch", json=[new_pet()] * 10)
+        if response.status_code == 201:
+            pets = [item["pet"] for item in response.json()]
+            self.client.put("/pets/batch", json=pets)
+            self.client.delete("/pets/batch", json=[pet["id"] for pet in pets])
@@ -0,0 +1,71 @@
+"""
+Record format memory report
+
+Stores a catalog in every record format that is available and reports the
+memory that Redis uses for the hash of each Pet, as measured by MEMORY
+USAGE, the bytes read back for each Pet by a listing, and the memory saved
+per million Pets compared to the json format. The indexes are the same in
+every format and are left out. Only use it on a Redis that holds nothing
+you want to keep:
+
+    $ python -m benchmarks.record_size --pets 10000
+"""
+import logging
+import argparse
+from service import record_codec, routes
+from service.models import Pet
+from benchmarks.seed import seed
+
+MILLION = 1000000
+
+
+def measure(count, samples):
+    """Returns the memory and the bytes read per Pet for a seeded catalog"""
+    seed(count)
+    ids = list(range(1, count + 1, max(1, count // samples)))
+    memory = sum(Pet.redis.memory_usage(Pet.key(pet_id), samples=0) for pet_id in ids)
+    read = sum(
+        len(record_codec.to_bytes(value))
+        for values in Pet.storage.load(ids, Pet.stored_fields)
+        for value in values
+        if value is not None
+    )
+    return memory / len(ids), read / len(ids)
+
+
+def main():
+    """Prints the size of a Pet in every record format"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pets", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    routes.initialize_logging(logging.CRITICAL)
+    routes.init_db()
+    default = record_codec.name
+    baseline = None
+    print(
+        "{:<14} {:>10} {:>10} {:>13} {:>14}".format(
+            "format", "bytes/pet", "read/pet", "MB/million", "saved/million"
+        )
+    )
+    for base in ["json"] + list(record_codec.FORMATS):
+        for name in [base] if base == "json" else [base, base + "+zlib"]:
+            record_codec.use(name)
+            memory, read = measure(args.pets, args.samples)
+            baseline = baseline or memory
+            print(
+                "{:<14} {:>10.1f} {:>10.1f} {:>10.1f} MB {:>11.1f} MB".format(
+                    name,
+                    memory,
+                    read,
+                    memory * MILLION / 2**20,
+                    (baseline - memory) * MILLION / 2**20,
+                )
+            )
+    record_codec.use(default)
+    Pet.remove_all()
+
+
+if __name__ == "__main__":
+    main()
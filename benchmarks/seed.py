@@ -0,0 +1,43 @@
+"""
+Benchmark catalog
+
+Replaces the Pets in Redis with a generated catalog of a given size. Every
+fifth Pet is in each category and the names are unique. Only use it on a
+Redis that holds nothing you want to keep:
+
+    $ python -m benchmarks.seed --pets 100000
+"""
+import logging
+import argparse
+from service import routes
+from service.models import Pet
+
+CATEGORIES = ["dog", "cat", "fish", "bird", "lizard"]
+CHUNK_SIZE = 10000
+
+
+def seed(count):
+    """Replaces all of the Pets with a generated catalog of count Pets"""
+    Pet.remove_all()
+    for start in range(0, count, CHUNK_SIZE):
+        Pet.create_many(
+            [
+                Pet(0, "pet{}".format(i), CATEGORIES[i % len(CATEGORIES)], i % 2 == 0)
+                for i in range(start, min(start + CHUNK_SIZE, count))
+            ]
+        )
+    return count
+
+
+def main():
+    """Seeds the catalog with the number of Pets given on the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pets", type=int, default=1000)
+    args = parser.parse_args()
+    routes.initialize_logging(logging.CRITICAL)
+    routes.init_db()
+    print("Seeded {} Pets".format(seed(args.pets)))
+
+
+if __name__ == "__main__":
+    main()
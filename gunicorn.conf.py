@@ -0,0 +1,14 @@
+"""
+Gunicorn configuration
+
+Gunicorn reads this file from the working directory on start up
+"""
+import os
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drops the live metrics of a worker that exited"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -11,7 +11,7 @@ from flask import Flask
 app = Flask(__name__)
 app.config["LOGGING_LEVEL"] = logging.INFO
 
-from service import routes, models, error_handlers
+from service import routes, models, error_handlers, commands, metrics
 
 # Set up logging for production
 print("Setting up logging for {}...".format(__name__))
@@ -0,0 +1,542 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Async Pet API Controller
+
+This module serves the same REST API as service.routes as an ASGI
+application on top of the AsyncPet model, so a single process can keep
+thousands of requests waiting on Redis at once. Run it with:
+
+    uvicorn service.asgi:app
+
+The paths, status codes, ETags and error bodies are the same as those of
+the Flask service.
+"""
+import os
+import logging
+from http import HTTPStatus
+from functools import wraps
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.http import generate_etag, parse_etags, quote_etag
+from service import codec, status
+from service.async_models import AsyncPet
+from service.models import DataValidationError, VersionConflictError
+from service.routes import (
+    MAX_BATCH_SIZE,
+    MAX_PAGE_SIZE,
+    NDJSON,
+    batch_error,
+    batch_status,
+    get_batch_id,
+    get_query,
+)
+
+logger = logging.getLogger(__name__)
+STATIC_FOLDER = os.path.join(os.path.dirname(__file__), "static")
+# the reason phrases that differ from the standard ones in the Flask service
+ERRORS = {
+    status.HTTP_405_METHOD_NOT_ALLOWED: "Method not Allowed",
+    status.HTTP_415_UNSUPPORTED_MEDIA_TYPE: "Unsupported media type",
+}
+
+
+######################################################################
+# DECORATORS
+######################################################################
+def requires_content_type(*content_types):
+    """Use this decorator to check content type"""
+
+    def decorator(func):
+        """Inner decorator"""
+
+        @wraps(func)
+        async def wrapper(request):
+            """Checks that the content type is correct"""
+            content_type = request.headers.get("Content-Type")
+            if content_type is None:
+                raise HTTPException(
+                    status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be set"
+                )
+            if content_type not in content_types:
+                logger.error("Invalid Content-Type: %s", content_type)
+                raise HTTPException(
+                    status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                    "Content-Type must be {}".format(content_types),
+                )
+            return await func(request)
+
+        return wrapper
+
+    return decorator
+
+
+######################################################################
+# RESPONSES
+######################################################################
+def json_response(data, code=status.HTTP_200_OK, headers=None):
+    """Returns data encoded with the fastest JSON codec that is installed"""
+    return Response(codec.dumpb(data), code, headers, media_type="application/json")
+
+
+def pet_response(pet, code=status.HTTP_200_OK, headers=None):
+    """Returns a Pet with its version as a strong ETag"""
+    response = json_response(pet.serialize(), code, headers)
+    response.headers["ETag"] = quote_etag(str(pet.version))
+    return response
+
+
+def not_found(pet_id):
+    """Returns the error for a Pet that does not exist"""
+    return HTTPException(
+        status.HTTP_404_NOT_FOUND, "Pet with id '{}' was not found.".format(pet_id)
+    )
+
+
+def get_if_match(request):
+    """Returns the Pet versions that an If-Match header allows or None for any"""
+    etags = parse_etags(request.headers.get("If-Match"))
+    if not etags or etags.star_tag:
+        return None
+    return list(etags.as_set())  # weak ETags never match
+
+
+async def get_json(request):
+    """Returns the JSON in the body of a request or None if it is invalid"""
+    try:
+        return codec.loads(await request.body())
+    except ValueError:
+        return None
+
+
+######################################################################
+# GET INDEX
+######################################################################
+async def index(request):
+    """Send back the home page"""
+    logger.info("Request for home page")
+    return FileResponse(os.path.join(STATIC_FOLDER, "index.html"))
+
+
+######################################################################
+# LIST ALL PETS
+######################################################################
+async def list_pets(request):
+    """
+    Returns all of the Pets
+
+    Takes the same filters, paging and streaming options as the Flask
+    service. The stored JSON is passed through without building any Pets.
+    """
+    logger.info("Request for List Pets")
+    args = request.query_params
+    ndjson = NDJSON in request.headers.get("Accept", "")
+    if ndjson or args.get("stream", "").lower() == "true":
+        return stream_pets(request, ndjson)
+    if "limit" in args or "cursor" in args:
+        return await list_pets_page(request)
+
+    attribute, value = get_query(request.query_params)
+    pets = [pet async for pet in AsyncPet.iter_json(attribute, value)]
+    body = "[{}]".format(",".join(pets)).encode("utf-8")
+    return conditional_response(request, body)
+
+
+async def list_pets_page(request):
+    """Returns one page of the Pets that match the query"""
+    try:
+        limit = int(request.query_params.get("limit", MAX_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST, "limit must be a positive integer"
+        )
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    attribute, value = get_query(request.query_params)
+    pets, next_cursor = await AsyncPet.paginate(
+        limit, request.query_params.get("cursor"), attribute, value
+    )
+
+    body = codec.dumpb([pet.serialize() for pet in pets])
+    headers = {}
+    if next_cursor:
+        next_url = request.url.include_query_params(limit=limit, cursor=next_cursor)
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+    return conditional_response(request, body, headers)
+
+
+def conditional_response(request, body, headers=None):
+    """Returns a list tagged with the hash of its body, or 304 if it is unchanged"""
+    etag = generate_etag(body)
+    if parse_etags(request.headers.get("If-None-Match")).contains_weak(etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": quote_etag(etag)}
+        )
+    response = Response(body, status.HTTP_200_OK, headers, "application/json")
+    response.headers["ETag"] = quote_etag(etag)
+    return response
+
+
+def stream_pets(request, ndjson):
+    """Streams the Pets that match the query a batch at a time"""
+    attribute, value = get_query(request.query_params)
+    pets = AsyncPet.iter_json(attribute, value)
+
+    async def generate_ndjson():
+        async for pet in pets:
+            yield pet + "\n"
+
+    async def generate_array():
+        separator = "["
+        async for pet in pets:
+            yield separator + pet
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    if ndjson:
+        return StreamingResponse(generate_ndjson(), media_type=NDJSON)
+    return StreamingResponse(generate_array(), media_type="application/json")
+
+
+######################################################################
+# RETRIEVE A PET
+######################################################################
+async def get_pets(request):
+    """
+    Retrieve a single Pet
+
+    This endpoint will return a Pet based on it's id
+    """
+    pet_id = request.path_params["pet_id"]
+    logger.info("Request to get Pet with id %s", pet_id)
+    pet = await AsyncPet.find(pet_id)
+    if not pet:
+        raise not_found(pet_id)
+    etags = parse_etags(request.headers.get("If-None-Match"))
+    if etags.contains_weak(str(pet.version)):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": quote_etag(str(pet.version))},
+        )
+    return pet_response(pet)
+
+
+######################################################################
+# CREATE A NEW PET
+######################################################################
+@requires_content_type("application/json", "application/x-www-form-urlencoded")
+async def create_pets(request):
+    """
+    Creates a Pet
+
+    This endpoint will create a Pet based the data in the body that is posted
+    or data that is sent via an html form post.
+    """
+    logger.info("Request to create a Pet")
+    if request.headers["Content-Type"] == "application/x-www-form-urlencoded":
+        logger.info("Processing FORM data")
+        form = parse_qs((await request.body()).decode("utf-8"))
+        try:
+            data = {
+                "name": form["name"][0],
+                "category": form["category"][0],
+                "available": form["available"][0].lower() in ["true", "1", "t"],
+            }
+        except KeyError as error:
+            raise DataValidationError("Invalid pet: missing " + error.args[0])
+    else:
+        logger.info("Processing JSON data")
+        data = await get_json(request)
+    pet = AsyncPet()
+    pet.deserialize(data)
+    await pet.save()
+    location = request.url_for("get_pets", pet_id=pet.id)
+    return pet_response(pet, status.HTTP_201_CREATED, {"Location": str(location)})
+
+
+######################################################################
+# CREATE MANY PETS
+######################################################################
+@requires_content_type("application/json", NDJSON)
+async def create_pets_batch(request):
+    """
+    Creates many Pets
+
+    This endpoint will create a Pet for each item in a JSON array or in the
+    lines of an NDJSON body and report the result of every item
+    """
+    logger.info("Request to create a batch of Pets")
+    results = []
+    pets = []
+    for data in await get_batch(request):
+        try:
+            pet = AsyncPet().deserialize(data)
+            if pet.name is None:
+                raise DataValidationError("Invalid pet: name must be set")
+        except DataValidationError as error:
+            results.append(batch_error(error))
+            continue
+        pets.append((len(results), pet))
+        results.append(None)  # filled in once the Pet has been given an id
+    await AsyncPet.create_many([pet for _, pet in pets])
+
+    for position, pet in pets:
+        results[position] = {
+            "status": status.HTTP_201_CREATED,
+            "location": str(request.url_for("get_pets", pet_id=pet.id)),
+            "pet": pet.serialize(),
+        }
+    return json_response(results, batch_status(results, status.HTTP_201_CREATED))
+
+
+async def get_batch(request):
+    """Returns the items in the body of a batch request"""
+    if request.headers.get("Content-Type") == NDJSON:
+        items = []
+        for line in (await request.body()).decode("utf-8").splitlines():
+            if line.strip():
+                try:
+                    items.append(codec.loads(line))
+                except ValueError:
+                    items.append(None)  # reported as bad data for this item
+    else:
+        items = await get_json(request)
+        if not isinstance(items, list):
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, "Body must be a JSON array"
+            )
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            "Batches are limited to {} items".format(MAX_BATCH_SIZE),
+        )
+    return items
+
+
+######################################################################
+# UPDATE AN EXISTING PET
+######################################################################
+@requires_content_type("application/json")
+async def update_pets(request):
+    """
+    Update a Pet
+
+    This endpoint will update a Pet based the body that is posted
+    """
+    pet_id = request.path_params["pet_id"]
+    logger.info("Request to update Pet with id %s", pet_id)
+    pet = await AsyncPet.find(pet_id)
+    if not pet:
+        raise not_found(pet_id)
+    pet.deserialize(await get_json(request))
+    pet.id = pet_id
+    await pet.save(if_match=get_if_match(request))
+    return pet_response(pet)
+
+
+######################################################################
+# PARTIALLY UPDATE AN EXISTING PET
+######################################################################
+@requires_content_type("application/json", "application/merge-patch+json")
+async def patch_pets(request):
+    """
+    Partially update a Pet
+
+    This endpoint will update only the attributes that are in the body
+    """
+    pet_id = request.path_params["pet_id"]
+    logger.info("Request to patch Pet with id %s", pet_id)
+    data = await get_json(request)
+    if not isinstance(data, dict):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Body must be a JSON object")
+    data.pop("id", None)  # the id in the path is the one that counts
+    AsyncPet.check_fields(data)  # before the keys can clash with the arguments
+    pet = await AsyncPet.update_fields(pet_id, if_match=get_if_match(request), **data)
+    if not pet:
+        raise not_found(pet_id)
+    return pet_response(pet)
+
+
+######################################################################
+# UPDATE MANY PETS
+######################################################################
+@requires_content_type("application/json", NDJSON)
+async def update_pets_batch(request):
+    """
+    Update many Pets
+
+    This endpoint will update the Pet identified by the id of each item in
+    a JSON array or NDJSON body and report the result of every item
+    """
+    logger.info("Request to update a batch of Pets")
+    results = []
+    pets = []
+    for data in await get_batch(request):
+        try:
+            pet = AsyncPet(get_batch_id(data)).deserialize(data)
+            if pet.name is None:
+                raise DataValidationError("Invalid pet: name must be set")
+        except DataValidationError as error:
+            results.append(batch_error(error))
+            continue
+        pets.append((len(results), pet))
+        results.append(None)  # filled in once the Pet has been saved
+    saved = await AsyncPet.save_many([pet for _, pet in pets])
+
+    for (position, pet), found in zip(pets, saved):
+        if found:
+            results[position] = {"status": status.HTTP_200_OK, "pet": pet.serialize()}
+        else:
+            results[position] = batch_error(
+                "Pet with id '{}' was not found.".format(pet.id),
+                status.HTTP_404_NOT_FOUND,
+            )
+    return json_response(results, batch_status(results, status.HTTP_200_OK))
+
+
+######################################################################
+# DELETE A PET
+######################################################################
+async def delete_pets(request):
+    """
+    Delete a Pet
+
+    This endpoint will delete a Pet based the id specified in the path
+    """
+    pet_id = request.path_params["pet_id"]
+    logger.info("Request to delete Pet with id %s", pet_id)
+    await AsyncPet(pet_id).delete(if_match=get_if_match(request))
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+######################################################################
+# DELETE MANY PETS
+######################################################################
+@requires_content_type("application/json", NDJSON)
+async def delete_pets_batch(request):
+    """
+    Delete many Pets
+
+    This endpoint will delete the Pets whose ids are listed in the body and
+    report which of them were not found
+    """
+    logger.info("Request to delete a batch of Pets")
+    results = []
+    pet_ids = []
+    for pet_id in await get_batch(request):
+        try:
+            pet_id = get_batch_id({"id": pet_id})
+        except DataValidationError as error:
+            results.append(batch_error(error))
+            continue
+        pet_ids.append((len(results), pet_id))
+        results.append(None)  # filled in once the Pet has been deleted
+    deleted = await AsyncPet.delete_many([pet_id for _, pet_id in pet_ids])
+
+    for (position, pet_id), found in zip(pet_ids, deleted):
+        if found:
+            results[position] = {"status": status.HTTP_204_NO_CONTENT, "id": pet_id}
+        else:
+            results[position] = batch_error(
+                "Pet with id '{}' was not found.".format(pet_id),
+                status.HTTP_404_NOT_FOUND,
+            )
+    return json_response(results, batch_status(results, status.HTTP_200_OK))
+
+
+######################################################################
+# PURCHASE A PET
+######################################################################
+async def purchase_pets(request):
+    """Purchase a Pet"""
+    pet_id = request.path_params["pet_id"]
+    logger.info("Request to purchase Pet with id %s", pet_id)
+    pet = await AsyncPet.purchase(pet_id, if_match=get_if_match(request))
+    if not pet:
+        raise not_found(pet_id)
+    return pet_response(pet)
+
+
+######################################################################
+# Error Handlers
+######################################################################
+def error_response(code, message):
+    """Returns the JSON body that the Flask service uses for errors"""
+    error = ERRORS.get(code, HTTPStatus(code).phrase)
+    return json_response({"status": code, "error": error, "message": message}, code)
+
+
+async def request_validation_error(request, error):
+    """Handles Value Errors from bad data"""
+    logger.warning(str(error))
+    return error_response(status.HTTP_400_BAD_REQUEST, str(error))
+
+
+async def version_conflict_error(request, error):
+    """Handles writes with a stale If-Match with 412_PRECONDITION_FAILED"""
+    logger.warning(str(error))
+    return error_response(status.HTTP_412_PRECONDITION_FAILED, str(error))
+
+
+async def http_error(request, error):
+    """Handles the HTTP errors raised by the routes and the router"""
+    logger.warning(error.detail)
+    return error_response(error.status_code, error.detail)
+
+
+async def internal_server_error(request, error):
+    """Handles unexpected server error with 500_SERVER_ERROR"""
+    logger.error(str(error))
+    return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, str(error))
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+@asynccontextmanager
+async def lifespan(app):  # pylint: disable=redefined-outer-name,unused-argument
+    """Connects to Redis while the application runs"""
+    await AsyncPet.init_db()
+    yield
+    await AsyncPet.close_db()
+
+
+app = Starlette(
+    routes=[
+        Route("/", index),
+        Route("/pets", list_pets, methods=["GET"]),
+        Route("/pets", create_pets, methods=["POST"]),
+        Route("/pets/batch", create_pets_batch, methods=["POST"]),
+        Route("/pets/batch", update_pets_batch, methods=["PUT"]),
+        Route("/pets/batch", delete_pets_batch, methods=["DELETE"]),
+        Route("/pets/{pet_id:int}", get_pets, methods=["GET"]),
+        Route("/pets/{pet_id:int}", update_pets, methods=["PUT"]),
+        Route("/pets/{pet_id:int}", patch_pets, methods=["PATCH"]),
+        Route("/pets/{pet_id:int}", delete_pets, methods=["DELETE"]),
+        Route("/pets/{pet_id:int}/purchase", purchase_pets, methods=["PUT"]),
+    ],
+    exception_handlers={
+        DataValidationError: request_validation_error,
+        VersionConflictError: version_conflict_error,
+        HTTPException: http_error,
+        Exception: internal_server_error,
+    },
+    lifespan=lifespan,
+)
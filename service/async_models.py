@@ -0,0 +1,410 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Async Pet Model that uses Redis through redis.asyncio
+
+AsyncPet mirrors the Pet model for asyncio applications. Both use the same
+keys, indexes and Lua scripts, so the Flask and ASGI services can serve the
+same database side by side and the caches of the Flask workers are still
+invalidated by writes made here.
+"""
+import logging
+from redis.asyncio import Redis, BlockingConnectionPool
+from redis.exceptions import ConnectionError
+from service import record_codec
+from service.models import Pet, DataValidationError
+from service.storage import (
+    ID_SEQUENCE,
+    INVALIDATE_CHANNEL,
+    SAVE_SCRIPT,
+    DELETE_SCRIPT,
+    PURCHASE_SCRIPT,
+    UPDATE_SCRIPT,
+    VERSION_CLOCK,
+    save_call,
+    delete_call,
+    update_call,
+    purchase_call,
+)
+
+
+class AsyncPet(Pet):
+    """Pet interface to database for asyncio applications"""
+
+    __slots__ = ()
+
+    logger = logging.getLogger(__name__)
+    redis = None
+    save_script = None
+    delete_script = None
+    purchase_script = None
+    update_script = None
+
+    async def save(self, if_match=None):
+        """
+        Saves a Pet in the database
+
+        Exception:
+        ----------
+          VersionConflictError - if the stored version is not in if_match
+        """
+        if self.name is None:  # name is the only required field
+            raise DataValidationError("name attribute is not set")
+        if self.id == 0:
+            self.id = await AsyncPet.redis.incr(ID_SEQUENCE)
+        version = await AsyncPet._save_with(AsyncPet.redis, self, if_match=if_match)
+        if version < 0:
+            raise AsyncPet._conflict(self.id)
+        self.version = version
+
+    async def delete(self, if_match=None):
+        """
+        Deletes a Pet from the database
+
+        Exception:
+        ----------
+          VersionConflictError - if the stored version is not in if_match
+        """
+        deleted = await AsyncPet._delete_with(AsyncPet.redis, self.id, if_match)
+        if deleted < 0:
+            raise AsyncPet._conflict(self.id)
+
+    ######################################################################
+    #  S T A T I C   D A T A B S E   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    def _save_with(cls, client, pet, must_exist=False, if_match=None):
+        """Runs the save script for a Pet on a client or pipeline"""
+        keys, args = save_call(pet.id, pet.to_hash(), must_exist, if_match)
+        return cls.save_script(keys=keys, args=args, client=client)
+
+    @classmethod
+    def _delete_with(cls, client, pet_id, if_match=None):
+        """Runs the delete script for a Pet on a client or pipeline"""
+        index_fields = ["_" + name for name in cls.indexed_attributes]
+        keys, args = delete_call(pet_id, index_fields, if_match)
+        return cls.delete_script(keys=keys, args=args, client=client)
+
+    @classmethod
+    async def create_many(cls, pets):
+        """Saves many new Pets at once with one pipeline per batch"""
+        for pet in pets:
+            if pet.name is None:  # name is the only required field
+                raise DataValidationError("name attribute is not set")
+        if not pets:
+            return pets
+        first_id = await cls.redis.incrby(ID_SEQUENCE, len(pets)) - len(pets) + 1
+        for offset, pet in enumerate(pets):
+            pet.id = first_id + offset
+        for start in range(0, len(pets), cls.batch_size):
+            batch = pets[start : start + cls.batch_size]
+            async with cls.redis.pipeline(transaction=False) as pipe:
+                for pet in batch:
+                    await cls._save_with(pipe, pet)
+                for pet, version in zip(batch, await pipe.execute()):
+                    pet.version = version
+        return pets
+
+    @classmethod
+    async def save_many(cls, pets):
+        """
+        Updates many existing Pets at once
+
+        Returns a list with True for every Pet that was saved and False for
+        those that were not found.
+        """
+        for pet in pets:
+            if pet.name is None:  # name is the only required field
+                raise DataValidationError("name attribute is not set")
+        results = []
+        for start in range(0, len(pets), cls.batch_size):
+            batch = pets[start : start + cls.batch_size]
+            async with cls.redis.pipeline(transaction=False) as pipe:
+                for pet in batch:
+                    await cls._save_with(pipe, pet, must_exist=True)
+                for pet, version in zip(batch, await pipe.execute()):
+                    if version > 0:
+                        pet.version = version
+                    results.append(version > 0)
+        return results
+
+    @classmethod
+    async def delete_many(cls, pet_ids):
+        """
+        Deletes many Pets at once
+
+        Returns a list with True for every Pet that was deleted and False
+        for those that were not found.
+        """
+        results = []
+        for start in range(0, len(pet_ids), cls.batch_size):
+            async with cls.redis.pipeline(transaction=False) as pipe:
+                for pet_id in pet_ids[start : start + cls.batch_size]:
+                    await cls._delete_with(pipe, pet_id)
+                results.extend(deleted > 0 for deleted in await pipe.execute())
+        return results
+
+    @classmethod
+    async def all(cls, batch_size=None):
+        """Query that returns all Pets"""
+        return [pet async for pet in cls.iter_query(batch_size=batch_size)]
+
+    @classmethod
+    async def paginate(cls, limit, cursor=None, attribute=None, value=None):
+        """
+        Query that returns one page of Pets ordered by id
+
+        Returns the Pets on the page and an opaque cursor for the next page,
+        or None when this is the last one.
+        """
+        after = cls._decode_cursor(cursor) if cursor else 0
+        key = cls._query_key(attribute, value)
+        if key is None:
+            return [], None
+        # fetch one extra id to find out if there is another page
+        ids = await cls.redis.zrangebyscore(
+            key, "({}".format(after), "+inf", 0, limit + 1
+        )
+        next_cursor = None
+        if len(ids) > limit:
+            ids = ids[:limit]
+            next_cursor = cls._encode_cursor(ids[-1])
+        return await cls.__load([int(pet_id) for pet_id in ids]), next_cursor
+
+    @classmethod
+    async def iter_query(cls, attribute=None, value=None, batch_size=None):
+        """Asynchronous generator that returns Pets in id order"""
+        async for ids in cls.__iter_ids(attribute, value, batch_size):
+            for pet in await cls.__load(ids):
+                yield pet
+
+    @classmethod
+    async def iter_json(cls, attribute=None, value=None, batch_size=None):
+        """
+        Asynchronous generator that returns Pets in id order as serialized
+        JSON objects without decoding their stored values
+        """
+        async for ids in cls.__iter_ids(attribute, value, batch_size):
+            async with cls.redis.pipeline(transaction=False) as pipe:
+                for pet_id in ids:
+                    pipe.hmget(cls.key(pet_id), cls.json_fields)
+                rows = await pipe.execute()
+            for pet_id, values in zip(ids, rows):
+                data = cls._to_json(pet_id, values)
+                if data:  # skip Pets deleted after their id was read
+                    yield data
+
+    @classmethod
+    async def __iter_ids(cls, attribute, value, batch_size):
+        """Returns the ids of the Pets in a query a batch at a time"""
+        batch_size = batch_size or cls.batch_size
+        key = cls._query_key(attribute, value)
+        if key is None:
+            return
+        after = 0
+        while True:
+            ids = await cls.redis.zrangebyscore(
+                key, "({}".format(after), "+inf", 0, batch_size
+            )
+            if ids:
+                yield [int(pet_id) for pet_id in ids]
+            if len(ids) < batch_size:
+                return
+            after = int(ids[-1])
+
+    @classmethod
+    async def __load(cls, ids):
+        """Fetches the Pets for a batch of ids in a single pipeline"""
+        if not ids:
+            return []
+        async with cls.redis.pipeline(transaction=False) as pipe:
+            for pet_id in ids:
+                pipe.hmget(cls.key(pet_id), cls.stored_fields)
+            rows = await pipe.execute()
+        pets = [cls._from_hash(pet_id, values) for pet_id, values in zip(ids, rows)]
+        return [pet for pet in pets if pet]  # skip Pets deleted after their id was read
+
+    @classmethod
+    async def update_fields(cls, pet_id, if_match=None, **fields):
+        """
+        Updates some of the attributes of a Pet in a single atomic operation
+
+        Returns the updated Pet or None if it was not found.
+
+        Exception:
+        ----------
+          DataValidationError - if a field is unknown or the name is removed
+          VersionConflictError - if the stored version is not in if_match
+        """
+        cls.check_fields(fields)
+        if not fields and if_match is None:
+            return await cls.find(pet_id)
+        result = [-3]
+        if not record_codec.packed():
+            keys, args = update_call(
+                pet_id, cls.hash_fields(fields), if_match, cls.stored_fields
+            )
+            result = await cls.update_script(keys=keys, args=args)
+        if result[0] == -3:  # stored in a packed record
+            result = await cls.__rewrite(
+                pet_id, if_match, lambda pet: cls._set(pet, fields)
+            )
+        if result[0] == 0:
+            return None
+        if result[0] < 0:
+            raise cls._conflict(pet_id)
+        return cls._from_hash(pet_id, result[1])
+
+    @classmethod
+    async def purchase(cls, pet_id, if_match=None):
+        """
+        Purchases a Pet in a single atomic operation
+
+        Returns the purchased Pet or None if it was not found.
+
+        Exception:
+        ----------
+          DataValidationError - if the Pet is not available
+          VersionConflictError - if the stored version is not in if_match
+        """
+        result = [-3]
+        if not record_codec.packed():
+            unavailable_key = cls.index_key("available", cls.index_value(False))
+            keys, args = purchase_call(
+                pet_id, if_match, unavailable_key, cls.stored_fields
+            )
+            result = await cls.purchase_script(keys=keys, args=args)
+        if result[0] == -3:  # stored in a packed record
+            result = await cls.__rewrite(pet_id, if_match, cls._sell)
+        if result[0] == 0:
+            return None
+        if result[0] == -2:
+            raise cls._conflict(pet_id)
+        if result[0] < 0:
+            raise DataValidationError(
+                "Pet with id '{}' is not available.".format(pet_id)
+            )
+        return cls._from_hash(pet_id, result[1])
+
+    @classmethod
+    async def __rewrite(cls, pet_id, if_match, change):
+        """
+        Changes a Pet in a packed record by reading it and writing it back
+        on condition that its version has not changed in between
+        """
+        while True:
+            pet = await cls.find(pet_id)
+            failed = cls._change(pet, if_match, change)
+            if failed is not None:
+                return [failed]
+            data = pet.to_hash()
+            keys, args = save_call(pet.id, data, True, [pet.version])
+            version = await cls.save_script(keys=keys, args=args)
+            if version == 0:  # deleted since it was read
+                return [0]
+            if version > 0:
+                return [1, cls._written_values(data, version)]
+
+    @classmethod
+    async def remove_all(cls):
+        """Removes all Pets but the version clock a batch at a time"""
+        batch = []
+        async for key in cls.redis.scan_iter(match=cls.key("*"), count=cls.batch_size):
+            if key == VERSION_CLOCK:
+                continue
+            batch.append(key)
+            if len(batch) >= cls.batch_size:
+                await cls.redis.unlink(*batch)
+                batch = []
+        if batch:
+            await cls.redis.unlink(*batch)
+        await cls.redis.publish(INVALIDATE_CHANNEL, "*")
+
+    ######################################################################
+    #  F I N D E R   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    async def find(cls, pet_id):
+        """Query that finds Pets by their id"""
+        values = await cls.redis.hmget(cls.key(pet_id), cls.stored_fields)
+        return cls._from_hash(pet_id, values)
+
+    @classmethod
+    async def __find_by(cls, attribute, value):
+        """Generic Query that finds Pets using the index for an attribute"""
+        cls.logger.info("Processing %s query for %s", attribute, value)
+        return [pet async for pet in cls.iter_query(attribute, value)]
+
+    @classmethod
+    async def find_by_name(cls, name):
+        """Query that finds Pets by their name"""
+        return await cls.__find_by("name", name)
+
+    @classmethod
+    async def find_by_category(cls, category):
+        """Query that finds Pets by their category"""
+        return await cls.__find_by("category", category)
+
+    @classmethod
+    async def find_by_availability(cls, available=True):
+        """Query that finds Pets by their availability"""
+        return await cls.__find_by("available", available)
+
+    ######################################################################
+    #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    async def init_db(cls, redis=None):
+        """
+        Initialized the asynchronous Redis database connection
+
+        The service is found the same way as by Pet.init_db() and the pool
+        is configured with the same environment variables.
+
+        Exception:
+        ----------
+          redis.ConnectionError - if ping() test fails
+          ValueError - if the client can not read the packed records
+        """
+        if redis is None:
+            hostname, port, password = cls.redis_credentials()
+            pool = BlockingConnectionPool(
+                host=hostname, port=port, password=password, **cls.pool_options()
+            )
+            redis = Redis(connection_pool=pool)
+        cls.check_client(redis)
+        cls.redis = redis
+        try:
+            await cls.redis.ping()
+            cls.logger.info("Connection established")
+        except ConnectionError:
+            cls.logger.fatal("*** FATAL ERROR: Could not connect to the Redis Service")
+            cls.redis = None
+            raise ConnectionError("Could not connect to the Redis Service")
+        cls.save_script = cls.redis.register_script(SAVE_SCRIPT)
+        cls.delete_script = cls.redis.register_script(DELETE_SCRIPT)
+        cls.purchase_script = cls.redis.register_script(PURCHASE_SCRIPT)
+        cls.update_script = cls.redis.register_script(UPDATE_SCRIPT)
+
+    @classmethod
+    async def close_db(cls):
+        """Closes the connections to Redis"""
+        if cls.redis is not None:
+            # aclose() replaced close() in redis 5
+            await getattr(cls.redis, "aclose", cls.redis.close)()
+            await cls.redis.connection_pool.disconnect()
+            cls.redis = None
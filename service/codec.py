@@ -0,0 +1,105 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Module: codec
+
+The JSON encoder and decoder used for storage and responses
+
+The fastest library that is installed is used: orjson, then ujson, then the
+json module of the standard library. They all write compact JSON that any
+of the others can read. Set JSON_CODEC to pick one by name.
+"""
+import os
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+def dumpb_json(value):
+    """Encodes a value as compact JSON bytes with the json module"""
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def with_fallback(encode):
+    """
+    Wraps an encoder so that values it can not encode go to the json module
+
+    orjson and ujson only encode integers of up to 64 bits, which is less
+    than JSON allows, so the rare larger one is left to the slower encoder.
+    """
+
+    def dumpb_with_fallback(value):
+        try:
+            return encode(value)
+        except (TypeError, OverflowError):
+            return dumpb_json(value)
+
+    return dumpb_with_fallback
+
+
+# name: (dumps returning bytes, loads accepting str or bytes)
+CODECS = {"json": (dumpb_json, json.loads)}
+if ujson:
+    CODECS["ujson"] = (
+        with_fallback(
+            lambda value: ujson.dumps(
+                value, ensure_ascii=False, escape_forward_slashes=False
+            ).encode("utf-8")
+        ),
+        ujson.loads,
+    )
+if orjson:
+    CODECS["orjson"] = (with_fallback(orjson.dumps), orjson.loads)
+
+name = None
+_dumpb = None
+_loads = None
+
+
+def use(codec_name):
+    """Switches to the named codec"""
+    global name, _dumpb, _loads  # pylint: disable=global-statement
+    if codec_name not in CODECS:
+        raise ValueError("JSON codec {} is not installed".format(codec_name))
+    name = codec_name
+    _dumpb, _loads = CODECS[codec_name]
+
+
+def dumpb(value):
+    """Encodes a value as JSON bytes"""
+    return _dumpb(value)
+
+
+def dumps(value):
+    """Encodes a value as a JSON string"""
+    return _dumpb(value).decode("utf-8")
+
+
+def loads(data):
+    """Decodes JSON from a string or bytes, raises ValueError if it is invalid"""
+    return _loads(data)
+
+
+use(
+    os.getenv("JSON_CODEC")
+    or next(codec for codec in ("orjson", "ujson", "json") if codec in CODECS)
+)
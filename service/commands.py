@@ -0,0 +1,151 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Module: commands
+
+Flask CLI commands for maintaining the Pet database
+
+Commands:
+---------
+flask pets migrate - Migrates Pets stored by older versions to the current layout
+flask pets reindex - Rebuilds the id and secondary indexes from the stored Pets
+flask pets reencode - Rewrites the Pets stored in another record format
+flask pets import FILE - Loads Pets from an NDJSON or CSV file
+flask pets export - Writes every Pet out as NDJSON or CSV
+"""
+import csv
+import click
+from flask.cli import AppGroup
+from service import codec, record_codec
+from service.models import Pet, DataValidationError
+from service.routes import get_batch_id
+from . import app
+
+CSV_FIELDS = ["id", "name", "category", "available"]
+
+pets_cli = AppGroup("pets", help="Maintain the Pet database")
+
+
+@pets_cli.command("migrate")
+def migrate():
+    """Migrates Pets stored by older versions to the current layout"""
+    count = Pet.migrate()
+    click.echo("Migrated {} Pets".format(count))
+
+
+@pets_cli.command("reindex")
+def reindex():
+    """Rebuilds the id and secondary indexes from the stored Pets"""
+    count = Pet.reindex()
+    click.echo("Reindexed {} Pets".format(count))
+
+
+@pets_cli.command("reencode")
+@click.option(
+    "--pause", default=0.0, show_default=True, help="Seconds to wait between batches"
+)
+def reencode(pause):
+    """Rewrites the Pets stored in another record format"""
+    count = Pet.reencode(pause)
+    click.echo("Rewrote {} Pets as {} records".format(count, record_codec.name))
+
+
+@pets_cli.command("import")
+@click.argument("source", type=click.File("r"))
+@click.option(
+    "--format", "file_format", type=click.Choice(["ndjson", "csv"]), default="ndjson"
+)
+@click.option("--chunk-size", default=1000, show_default=True, help="Pets per write")
+@click.option(
+    "--keep-ids", is_flag=True, help="Restore the Pets with the ids in the file"
+)
+def import_pets(source, file_format, chunk_size, keep_ids):
+    """Loads Pets from an NDJSON or CSV file ('-' reads stdin)"""
+    rows = read_csv(source) if file_format == "csv" else read_ndjson(source)
+    imported = 0
+    errors = 0
+    chunk = []
+    for line, data in rows:
+        try:
+            pet = Pet(get_batch_id(data) if keep_ids else 0).deserialize(data)
+            if pet.name is None:
+                raise DataValidationError("Invalid pet: name must be set")
+        except (DataValidationError, AttributeError, TypeError, ValueError) as error:
+            click.echo("Skipping line {}: {}".format(line, error), err=True)
+            errors += 1
+            continue
+        chunk.append(pet)
+        if len(chunk) >= chunk_size:
+            imported += write_chunk(chunk, keep_ids)
+            click.echo("Imported {} Pets...".format(imported), err=True)
+            chunk = []
+    if chunk:
+        imported += write_chunk(chunk, keep_ids)
+    click.echo("Imported {} Pets with {} errors".format(imported, errors))
+
+
+@pets_cli.command("export")
+@click.option("--output", type=click.File("w"), default="-", help="Defaults to stdout")
+@click.option(
+    "--format", "file_format", type=click.Choice(["ndjson", "csv"]), default="ndjson"
+)
+@click.option("--chunk-size", default=1000, show_default=True, help="Pets per read")
+def export_pets(output, file_format, chunk_size):
+    """Writes every Pet out as NDJSON or CSV"""
+    writer = None
+    if file_format == "csv":
+        writer = csv.DictWriter(output, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+    exported = 0
+    for pet in Pet.iter_all(batch_size=chunk_size):
+        if writer:
+            writer.writerow(pet.serialize())
+        else:
+            output.write(codec.dumps(pet.serialize()) + "\n")
+        exported += 1
+        if exported % chunk_size == 0:
+            click.echo("Exported {} Pets...".format(exported), err=True)
+    click.echo("Exported {} Pets".format(exported), err=True)
+
+
+def read_ndjson(source):
+    """Returns the line number and data of every line in an NDJSON file"""
+    for line, text in enumerate(source, start=1):
+        if text.strip():
+            try:
+                yield line, codec.loads(text)
+            except ValueError:
+                yield line, None  # reported as bad data for this line
+
+
+def read_csv(source):
+    """Returns the line number and data of every row in a CSV file"""
+    reader = csv.DictReader(source)
+    for row in reader:
+        data = {name: value or None for name, value in row.items()}
+        if data.get("available") is not None:
+            data["available"] = data["available"].lower() in ["true", "1", "t"]
+        yield reader.line_num, data
+
+
+def write_chunk(pets, keep_ids):
+    """Saves a chunk of imported Pets in bulk"""
+    if keep_ids:
+        Pet.restore_many(pets)
+    else:
+        Pet.create_many(pets)
+    return len(pets)
+
+
+app.cli.add_command(pets_cli)
@@ -15,7 +15,7 @@
 Module: error_handlers
 """
 from flask import jsonify
-from service.models import DataValidationError
+from service.models import DataValidationError, VersionConflictError
 from . import app, status
 
 ######################################################################
@@ -27,6 +27,21 @@ def request_validation_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(VersionConflictError)
+def version_conflict_error(error):
+    """Handles writes with a stale If-Match with 412_PRECONDITION_FAILED"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad reuests with 400_BAD_REQUEST"""
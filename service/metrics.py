@@ -0,0 +1,148 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Module: metrics
+
+Prometheus metrics for the Pet service, served at /metrics
+
+The metrics are only collected when prometheus_client is installed. Under
+gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty directory so that the
+metrics of all of the workers are added up, gunicorn.conf.py removes the
+ones of workers that exit.
+"""
+import os
+import time
+from flask import Response, g, request
+from service.models import Pet
+from . import app
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram, multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+if prometheus_client:
+    REQUESTS = Counter(
+        "http_requests_total",
+        "HTTP requests that were handled",
+        ["method", "route", "status"],
+    )
+    REQUEST_LATENCY = Histogram(
+        "http_request_duration_seconds",
+        "Time spent handling HTTP requests",
+        ["method", "route", "status"],
+    )
+    IN_PROGRESS = Gauge(
+        "http_requests_in_progress",
+        "HTTP requests that are being handled",
+        ["method", "route"],
+        multiprocess_mode="livesum",
+    )
+    REDIS_LATENCY = Histogram(
+        "redis_command_duration_seconds",
+        "Time spent on Redis commands and pipelines",
+        ["command"],
+        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+    )
+    REDIS_ERRORS = Counter(
+        "redis_command_errors_total",
+        "Redis commands and pipelines that failed",
+        ["command"],
+    )
+
+
+######################################################################
+# REQUEST HOOKS
+######################################################################
+def start_request():
+    """Starts timing a request"""
+    g.metrics_start = time.perf_counter()
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    IN_PROGRESS.labels(request.method, g.metrics_route).inc()
+
+
+def finish_request(response):
+    """Records the outcome and latency of a request"""
+    if "metrics_start" not in g:  # a before_request hook failed first
+        return response
+    labels = (request.method, g.metrics_route, response.status_code)
+    REQUESTS.labels(*labels).inc()
+    REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - g.metrics_start)
+    IN_PROGRESS.labels(request.method, g.metrics_route).dec()
+    return response
+
+
+def observe_redis_command(command, seconds, failed):
+    """Records the latency of a Redis command sent by the Pet model"""
+    REDIS_LATENCY.labels(command).observe(seconds)
+    if failed:
+        REDIS_ERRORS.labels(command).inc()
+
+
+class PoolCollector(object):
+    """
+    Reports the usage of the Redis connection pools when they are scraped
+
+    Each worker has its own pools, so with PROMETHEUS_MULTIPROC_DIR the
+    usage is the one of the worker that serves the scrape.
+    """
+
+    @staticmethod
+    def gauge():
+        """Returns an empty gauge of the pool connections"""
+        return GaugeMetricFamily(
+            "redis_pool_connections",
+            "Connections in the Redis connection pool",
+            labels=["state"],
+        )
+
+    def describe(self):
+        """Names the metric without reading the pools"""
+        return [self.gauge()]
+
+    def collect(self):
+        """Reads the usage of the pools"""
+        gauge = self.gauge()
+        if Pet.redis is not None:
+            for state, count in Pet.pool_stats().items():
+                gauge.add_metric([state], count)
+        return [gauge]
+
+
+######################################################################
+# GET METRICS
+######################################################################
+def metrics():
+    """Returns the metrics in the Prometheus text format"""
+    registry = prometheus_client.REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(PoolCollector())
+    return Response(
+        prometheus_client.generate_latest(registry),
+        content_type=prometheus_client.CONTENT_TYPE_LATEST,
+    )
+
+
+if prometheus_client:
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics)
+    prometheus_client.REGISTRY.register(PoolCollector())
+    Pet.command_observer = observe_redis_command
+else:  # pragma: no cover
+    app.logger.warning("prometheus_client is not installed, /metrics is disabled")
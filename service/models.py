@@ -14,20 +14,52 @@
 # limitations under the License.
 ######################################################################
 """
-Pet Model that uses Redis
+Pet Model that uses Redis or an in-memory store
 
 You must initlaize this class before use by calling inititlize().
 This class looks for an environment variable called VCAP_SERVICES
 to get it's database credentials from. If it cannot find one, it
 tries to connect to Redis on the localhost. If that fails it looks
-for a server name 'redis' to connect to.
+for a server name 'redis' to connect to. Set REDIS_CLUSTER_NODES, or
+"cluster" in the VCAP_SERVICES credentials, to use a Redis Cluster, and
+REDIS_SENTINELS or REDIS_REPLICAS to read from replicas of the primary.
+
+Set PET_STORAGE to memory to keep the Pets in this process instead, which
+needs no Redis at all but is not shared with other processes, and
+PET_RECORD_FORMAT to store the values of each Pet in one packed record.
 """
 
 import os
 import json
+import time
+import base64
 import logging
-from redis import StrictRedis
-from redis.exceptions import ConnectionError
+import binascii
+from functools import partial
+from redis import StrictRedis, BlockingConnectionPool
+from redis.client import Pipeline
+from redis.sentinel import Sentinel
+from redis.exceptions import ConnectionError, RedisError
+
+try:  # Redis Cluster support arrived in redis 4.1
+    from redis.cluster import RedisCluster, ClusterNode
+    from redis.exceptions import RedisClusterException
+except ImportError:  # pragma: no cover
+    RedisCluster = None
+from service import codec, record_codec
+from service.cache import LRUCache
+from service.storage import (
+    NAMESPACE,
+    SCHEMA_VERSION,
+    SCHEMA_KEY,
+    ID_INDEX,
+    INVALIDATE_CHANNEL,
+    RECORD_FIELD,
+    UNAVAILABLE,
+    RedisStorage,
+    ClusterStorage,
+    MemoryStorage,
+)
 
 
 class DataValidationError(Exception):
@@ -36,11 +68,112 @@ class DataValidationError(Exception):
     pass
 
 
+class VersionConflictError(Exception):
+    """Custom Exception when a Pet has changed since the version a client has"""
+
+    pass
+
+
+def observe_command(command, func, *args, **kwargs):
+    """Runs a Redis command and reports how long it took to Pet.command_observer"""
+    observer = Pet.command_observer
+    if observer is None:
+        return func(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except RedisError:
+        observer(command, time.perf_counter() - start, True)
+        raise
+    observer(command, time.perf_counter() - start, False)
+    return result
+
+
+class ObservedRedis(StrictRedis):
+    """Redis client that reports the latency of every command it sends"""
+
+    def execute_command(self, *args, **options):
+        """Sends a command to Redis"""
+        return observe_command(args[0], super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        """Returns a pipeline that reports the latency of its round trips"""
+        return ObservedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class ObservedPipeline(Pipeline):
+    """Pipeline that reports the latency of every round trip it makes"""
+
+    def execute(self, raise_on_error=True):
+        """Sends all of the buffered commands to Redis"""
+        return observe_command("PIPELINE", super().execute, raise_on_error)
+
+
+def observe_pipeline(pipe):
+    """Makes a pipeline report the latency of every round trip it makes"""
+    pipe.execute = partial(observe_command, "PIPELINE", pipe.execute)
+    return pipe
+
+
+if RedisCluster is not None:
+
+    class ObservedRedisCluster(RedisCluster):
+        """Redis Cluster client that reports the latency of every command it sends"""
+
+        def execute_command(self, *args, **kwargs):
+            """Sends a command to the nodes that own its keys"""
+            return observe_command(args[0], super().execute_command, *args, **kwargs)
+
+        def pipeline(self, transaction=None, shard_hint=None):
+            """Returns a pipeline that reports the latency of its round trips"""
+            return observe_pipeline(super().pipeline(transaction, shard_hint))
+
+        def node_pipeline(self, node):
+            """Returns a pipeline to one node that reports its round trips"""
+            client = self.get_redis_connection(node)
+            return observe_pipeline(client.pipeline(transaction=False))
+
+
 class Pet(object):
     """Pet interface to database"""
 
+    # Pets are created for every row of a listing so they have no __dict__
+    __slots__ = ("id", "name", "category", "available", "version")
+
     logger = logging.getLogger(__name__)
+    # the storage engine and, when it is Redis, the client it uses
+    storage = None
     redis = None
+    pool = None
+    pool_settings = None
+    cluster = None
+    cluster_settings = None
+    # clients of the read replicas of the primary, if there are any
+    replicas = []
+    replica_pools = {}
+    sentinel = None
+    sentinel_settings = None
+    # optional in-process cache in front of find()
+    cache = None
+    cache_listener = None
+    # called with the command, seconds and whether it failed for every
+    # Redis command sent by a client from connect_to_redis()
+    command_observer = None
+    # attributes that are stored in the hash of each Pet
+    fields = ("name", "category", "available")
+    # hash fields that are read back for each Pet, then its version and the
+    # record its values are packed in, if they are
+    stored_fields = fields + ("_version", RECORD_FIELD)
+    # hash fields that are read to serialize a Pet
+    json_fields = fields + (RECORD_FIELD,)
+    # attributes that have a secondary index for the find_by queries
+    indexed_attributes = ("name", "category", "available")
+    # number of Pets fetched per round trip when reading in bulk
+    batch_size = int(os.getenv("REDIS_BATCH_SIZE", "1000"))
+    # the JSON object of a Pet with its stored JSON values filled in
+    json_template = '{{"id":{},"name":{},"category":{},"available":{}}}'
 
     def __init__(self, id=0, name=None, category=None, available=True):
         """Constructor"""
@@ -48,18 +181,78 @@ class Pet(object):
         self.name = name
         self.category = category
         self.available = available
+        self.version = 0  # set by every write and read of the Pet
 
-    def save(self):
-        """Saves a Pet in the database"""
+    def save(self, if_match=None):
+        """
+        Saves a Pet in the database
+
+        Pass a list of versions as if_match to only save the Pet if the
+        stored copy still has one of them.
+
+        Exception:
+        ----------
+          VersionConflictError - if the stored version is not in if_match
+        """
         if self.name is None:  # name is the only required field
             raise DataValidationError("name attribute is not set")
         if self.id == 0:
-            self.id = Pet.__next_index()
-        Pet.redis.set(self.id, json.dumps(self.serialize()))
+            self.id = Pet.storage.next_ids()
+        [version] = Pet.storage.save([(self.id, self.to_hash(), if_match)])
+        Pet.__invalidate(self.id)
+        if version < 0:
+            raise Pet._conflict(self.id)
+        self.version = version
 
-    def delete(self):
-        """Deletes a Pet from the database"""
-        Pet.redis.delete(self.id)
+    def delete(self, if_match=None):
+        """
+        Deletes a Pet from the database
+
+        Exception:
+        ----------
+          VersionConflictError - if the stored version is not in if_match
+        """
+        [deleted] = Pet.storage.delete([(self.id, if_match)])
+        Pet.__invalidate(self.id)
+        if deleted < 0:
+            raise Pet._conflict(self.id)
+
+    def to_hash(self):
+        """
+        Returns the hash fields that a Pet is stored as
+
+        The fields of the other layout are written empty, which removes them,
+        so a Pet stored in another record format is converted as it is saved.
+        """
+        values = {name: getattr(self, name) for name in Pet.fields}
+        if not record_codec.packed():
+            data = Pet.hash_fields(values)
+            data[RECORD_FIELD] = ""
+            return data
+        data = Pet.index_fields(values)
+        data.update(dict.fromkeys(Pet.fields, ""))
+        data[RECORD_FIELD] = record_codec.pack([values[name] for name in Pet.fields])
+        return data
+
+    @staticmethod
+    def hash_fields(values):
+        """Returns the hash fields that store the given attribute values"""
+        data = Pet.index_fields(values)
+        for name, value in values.items():
+            data[name] = codec.dumps(value)
+        return data
+
+    @staticmethod
+    def index_fields(values):
+        """Returns the fields naming the indexes of the given attribute values"""
+        data = {}
+        for name, value in values.items():
+            if name in Pet.indexed_attributes:
+                index_value = Pet.index_value(value)
+                data["_" + name] = (
+                    "" if index_value is None else Pet.index_key(name, index_value)
+                )
+        return data
 
     def serialize(self):
         """serializes a Pet into a dictionary"""
@@ -76,6 +269,7 @@ class Pet(object):
             self.name = data["name"]
             self.category = data["category"]
             self.available = data["available"]
+            Pet.check_fields({"available": self.available})
         except KeyError as error:
             raise DataValidationError("Invalid pet: missing " + error.args[0])
         except TypeError as error:
@@ -84,66 +278,600 @@ class Pet(object):
             )
         return self
 
+    @classmethod
+    def check_fields(cls, fields):
+        """
+        Checks the attribute values that a Pet is about to be updated with
+
+        Exception:
+        ----------
+          DataValidationError - if a field is unknown, the name is removed
+          or available is not a boolean
+        """
+        for name in fields:
+            if name not in cls.fields:
+                raise DataValidationError("Invalid pet: unknown field " + name)
+        if "name" in fields and fields["name"] is None:
+            raise DataValidationError("name attribute is not set")
+        if "available" in fields and not isinstance(fields["available"], bool):
+            raise DataValidationError("Invalid pet: available must be a boolean")
+
     ######################################################################
     #  S T A T I C   D A T A B S E   M E T H O D S
     ######################################################################
 
+    @staticmethod
+    def key(pet_id):
+        """Returns the key of the hash that a Pet is stored in"""
+        return "{}:{}".format(NAMESPACE, pet_id)
+
+    @staticmethod
+    def _conflict(pet_id):
+        """Returns the error for a write that lost to a newer version"""
+        return VersionConflictError(
+            "Pet with id '{}' has been changed by someone else.".format(pet_id)
+        )
+
     @classmethod
-    def __next_index(cls):
-        """Increments the index and returns it"""
-        return cls.redis.incr("index")
+    def create_many(cls, pets):
+        """
+        Saves many new Pets at once
+
+        The ids for all of the Pets are reserved at once and the Pets are
+        written with one pipeline per batch, so importing thousands of Pets
+        into Redis costs a handful of round trips.
+        """
+        for pet in pets:
+            if pet.name is None:  # name is the only required field
+                raise DataValidationError("name attribute is not set")
+        if not pets:
+            return pets
+        first_id = cls.storage.next_ids(len(pets)) - len(pets) + 1
+        for offset, pet in enumerate(pets):
+            pet.id = first_id + offset
+        for start in range(0, len(pets), cls.batch_size):
+            batch = pets[start : start + cls.batch_size]
+            records = [(pet.id, pet.to_hash(), None) for pet in batch]
+            for pet, version in zip(batch, cls.storage.save(records)):
+                pet.version = version
+        return pets
 
     @classmethod
-    def remove_all(cls):
-        """Removes all Pets from the database"""
-        cls.redis.flushall()
+    def restore_many(cls, pets):
+        """
+        Saves many Pets with the ids that they already have
+
+        This is how a backup is loaded: Pets with the same ids are
+        overwritten and the id counter is moved past the largest restored
+        id so that new Pets never collide with them.
+        """
+        for pet in pets:
+            if pet.name is None:  # name is the only required field
+                raise DataValidationError("name attribute is not set")
+            if pet.id < 1:
+                raise DataValidationError("Invalid pet: id must be a positive integer")
+        for start in range(0, len(pets), cls.batch_size):
+            batch = pets[start : start + cls.batch_size]
+            records = [(pet.id, pet.to_hash(), None) for pet in batch]
+            for pet, version in zip(batch, cls.storage.save(records)):
+                pet.version = version
+            cls.storage.advance_ids(max(pet.id for pet in batch))
+        for pet in pets:
+            cls.__invalidate(pet.id)
+        return pets
 
     @classmethod
-    def all(cls):
-        """Query that returns all Pets"""
-        # results = [cls.from_dict(redis.hgetall(key)) for key in redis.keys() if key != 'index']
+    def save_many(cls, pets):
+        """
+        Updates many existing Pets at once
+
+        The Pets are written with one pipeline per batch and a Pet that no
+        longer exists is skipped rather than created again. Returns a list
+        with True for every Pet that was saved and False for those that
+        were not found.
+        """
+        for pet in pets:
+            if pet.name is None:  # name is the only required field
+                raise DataValidationError("name attribute is not set")
         results = []
-        for key in cls.redis.keys():
-            if key != "index":  # filer out our id index
-                data = json.loads(cls.redis.get(key))
-                pet = Pet(data["id"]).deserialize(data)
-                results.append(pet)
+        for start in range(0, len(pets), cls.batch_size):
+            batch = pets[start : start + cls.batch_size]
+            records = [(pet.id, pet.to_hash(), None) for pet in batch]
+            for pet, version in zip(batch, cls.storage.save(records, must_exist=True)):
+                if version > 0:
+                    pet.version = version
+                results.append(version > 0)
+        for pet in pets:
+            cls.__invalidate(pet.id)
         return results
 
+    @classmethod
+    def delete_many(cls, pet_ids):
+        """
+        Deletes many Pets at once
+
+        Returns a list with True for every Pet that was deleted and False
+        for those that were not found.
+        """
+        results = []
+        for start in range(0, len(pet_ids), cls.batch_size):
+            batch = pet_ids[start : start + cls.batch_size]
+            records = [(pet_id, None) for pet_id in batch]
+            results.extend(bool(deleted) for deleted in cls.storage.delete(records))
+        for pet_id in pet_ids:
+            cls.__invalidate(pet_id)
+        return results
+
+    @classmethod
+    def remove_all(cls):
+        """
+        Removes all Pets from the database
+
+        Only the keys in the Pet namespace are removed, so other data in a
+        shared Redis is left alone.
+        """
+        cls.storage.remove_all()
+        cls.__invalidate("*")
+
+    @classmethod
+    def all(cls, batch_size=None):
+        """Query that returns all Pets"""
+        return list(cls.iter_all(batch_size))
+
+    @classmethod
+    def iter_all(cls, batch_size=None):
+        """Generator that returns all Pets in id order"""
+        return cls.iter_query(batch_size=batch_size)
+
+    @classmethod
+    def paginate(cls, limit, cursor=None, attribute=None, value=None):
+        """
+        Query that returns one page of Pets ordered by id
+
+        Returns the Pets on the page and an opaque cursor for the next page,
+        or None when this is the last one. Pass an attribute and value to
+        page through the results of a find_by query instead.
+        """
+        after = cls._decode_cursor(cursor) if cursor else 0
+        key = cls._query_key(attribute, value)
+        if key is None:
+            return [], None
+        # fetch one extra id to find out if there is another page
+        ids = cls.storage.range(key, after, limit + 1)
+        next_cursor = None
+        if len(ids) > limit:
+            ids = ids[:limit]
+            next_cursor = cls._encode_cursor(ids[-1])
+        return list(cls.__load(ids)), next_cursor
+
+    @classmethod
+    def iter_query(cls, attribute=None, value=None, batch_size=None):
+        """
+        Generator that returns Pets in id order
+
+        Walks the id index, or the index of an attribute value, a batch at a
+        time (one ZRANGEBYSCORE and one pipelined HMGET with Redis) so memory
+        use stays constant no matter how many Pets match.
+        """
+        for ids in cls.__iter_ids(attribute, value, batch_size):
+            yield from cls.__load(ids)
+
+    @classmethod
+    def iter_json(cls, attribute=None, value=None, batch_size=None):
+        """
+        Generator that returns Pets in id order as serialized JSON objects
+
+        The JSON values stored for each Pet are copied into the output
+        without being decoded, so no Pets or dicts are created at all.
+        """
+        for ids in cls.__iter_ids(attribute, value, batch_size):
+            for pet_id, values in zip(ids, cls.storage.load(ids, cls.json_fields)):
+                data = cls._to_json(pet_id, values)
+                if data:  # skip Pets deleted after their id was read
+                    yield data
+
+    @classmethod
+    def _to_json(cls, pet_id, values):
+        """
+        Returns the JSON object of a Pet from the values of its json_fields
+
+        Only the values of a packed record are decoded. Returns None when
+        the Pet is not stored.
+        """
+        if values[-1] is not None:
+            values = [codec.dumps(value) for value in record_codec.unpack(values[-1])]
+        elif values[0] is None:  # every stored Pet has a name
+            return None
+        else:
+            values = [cls._raw_json(value) for value in values[:-1]]
+        return cls.json_template.format(pet_id, *values)
+
+    @staticmethod
+    def _raw_json(value):
+        """Returns a stored JSON value as a string"""
+        if value is None:
+            return "null"
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    @classmethod
+    def __iter_ids(cls, attribute, value, batch_size):
+        """Generator that returns the ids of the Pets in a query a batch at a time"""
+        batch_size = batch_size or cls.batch_size
+        key = cls._query_key(attribute, value)
+        if key is None:
+            return
+        after = 0
+        while True:
+            ids = cls.storage.range(key, after, batch_size)
+            if ids:
+                yield ids
+            if len(ids) < batch_size:
+                return
+            after = ids[-1]
+
+    @classmethod
+    def _query_key(cls, attribute, value):
+        """Returns the index key for a query or None if nothing can match"""
+        if not attribute:
+            return ID_INDEX
+        search_criteria = cls.index_value(value)  # make case insensitive
+        if search_criteria is None:
+            return None
+        return cls.index_key(attribute, search_criteria)
+
+    @staticmethod
+    def _encode_cursor(pet_id):
+        """Turns the last id on a page into an opaque cursor"""
+        return base64.urlsafe_b64encode(str(int(pet_id)).encode()).decode().rstrip("=")
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """Turns a cursor back into the id to continue after"""
+        try:
+            padding = "=" * (-len(cursor) % 4)
+            return int(base64.urlsafe_b64decode(cursor + padding).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise DataValidationError("Invalid cursor: {}".format(cursor))
+
+    @classmethod
+    def reindex(cls):
+        """Rebuilds the id and secondary indexes from the stored Pets"""
+        count = 0
+        for pet_id in cls.storage.stored_ids():
+            pet = cls.find(pet_id)
+            if pet:
+                pet.save()
+                count += 1
+        cls.logger.info("Reindexed %d Pets", count)
+        return count
+
+    @classmethod
+    def migrate(cls):
+        """
+        Migrates Pets stored by older versions to the current layout
+
+        Version 1 stored each Pet as a JSON string under its bare id and kept
+        the id counter in 'index'. Returns the number of Pets that were
+        migrated. Pets that can not be read are logged and left where they
+        are. Only a single Redis can hold Pets of older versions, so there is
+        nothing to migrate in a cluster or when the Pets are kept in memory.
+        """
+        if cls.storage.name != RedisStorage.name:
+            return 0
+        count = 0
+        batch = []
+        seen = set()  # SCAN may return the same key more than once
+        for key in cls.redis.scan_iter(count=cls.batch_size):
+            if key.isdigit() and key not in seen:  # only version 1 Pets
+                seen.add(key)
+                batch.append(key)
+            if len(batch) >= cls.batch_size:
+                count += cls.__migrate_batch(batch)
+                batch = []
+        if batch:
+            count += cls.__migrate_batch(batch)
+        legacy_index = cls.redis.get("index")
+        if legacy_index is not None:
+            cls.storage.advance_ids(legacy_index)
+        cls.redis.delete("index")
+        cls.redis.set(SCHEMA_KEY, SCHEMA_VERSION)
+        cls.logger.info("Migrated %d Pets to schema version %d", count, SCHEMA_VERSION)
+        return count
+
+    @classmethod
+    def __migrate_batch(cls, keys):
+        """Rewrites a batch of version 1 Pets as hashes"""
+        records = []
+        migrated = []
+        for key, value in zip(keys, cls.redis.mget(keys)):
+            if value is None:
+                continue
+            try:
+                data = codec.loads(value)
+                pet = Pet(
+                    data["id"],
+                    data["name"],
+                    data["category"],
+                    cls.legacy_available(data["available"]),
+                )
+            except (ValueError, KeyError, TypeError) as error:
+                cls.logger.warning("Skipping unreadable Pet %s: %s", key, error)
+                continue
+            records.append((pet.id, pet.to_hash(), None))
+            migrated.append(key)
+        if records:
+            cls.storage.save(records)
+            cls.redis.delete(*migrated)
+        return len(records)
+
+    @staticmethod
+    def legacy_available(value):
+        """Returns an available value of version 1, which may be any JSON, as a bool"""
+        if isinstance(value, str):
+            return value.strip().lower() in ("true", "t", "1", "yes", "y")
+        return bool(value)
+
+    @classmethod
+    def reencode(cls, pause=0):
+        """
+        Rewrites the Pets that are stored in another record format
+
+        Meant to run next to the service after PET_RECORD_FORMAT changed:
+        the Pets are read a batch at a time and each one is written back
+        only if nobody saved it in the meantime, because every save stores
+        it in the current format anyway. Sleeps for pause seconds between
+        batches to leave room for the service. Returns the number of Pets
+        that were rewritten.
+        """
+        count = 0
+        batch = []
+        for pet_id in cls.storage.stored_ids():
+            batch.append(pet_id)
+            if len(batch) >= cls.batch_size:
+                count += cls.__reencode_batch(batch)
+                batch = []
+                time.sleep(pause)
+        if batch:
+            count += cls.__reencode_batch(batch)
+        cls.logger.info("Rewrote %d Pets as %s records", count, record_codec.name)
+        return count
+
+    @classmethod
+    def __reencode_batch(cls, ids):
+        """Rewrites the Pets of a batch that are not in the current format"""
+        records = []
+        for pet_id, values in zip(ids, cls.storage.load(ids, cls.stored_fields)):
+            pet = cls._from_hash(pet_id, values)
+            if pet is None:  # deleted since its id was read
+                continue
+            data = pet.to_hash()
+            stored = record_codec.to_bytes(values[-1])
+            if stored != (data[RECORD_FIELD] or None):
+                records.append((pet_id, data, [pet.version]))
+        if not records:
+            return 0
+        versions = cls.storage.save(records, must_exist=True)
+        for pet_id, _, _ in records:
+            cls.__invalidate(pet_id)
+        return sum(1 for version in versions if version > 0)
+
+    @classmethod
+    def __load(cls, ids):
+        """Fetches the Pets for a batch of ids in a single pipeline"""
+        if not ids:
+            return
+        for pet_id, values in zip(ids, cls.storage.load(ids, cls.stored_fields)):
+            pet = cls._from_hash(pet_id, values)
+            if pet:  # skip Pets deleted after their id was read
+                yield pet
+
+    @classmethod
+    def _from_hash(cls, pet_id, values):
+        """Creates a Pet from the values of its stored fields"""
+        record = values[len(cls.fields) + 1]
+        if record is not None:
+            attributes = record_codec.unpack(record)
+        elif values[0] is None:  # every stored Pet has a name
+            return None
+        else:
+            attributes = [
+                None if value is None else codec.loads(value)
+                for value in values[: len(cls.fields)]
+            ]
+        pet = cls(pet_id)
+        for name, value in zip(cls.fields, attributes):
+            setattr(pet, name, value)
+        pet.version = int(values[len(cls.fields)] or 0)
+        return pet
+
+    @staticmethod
+    def _change(pet, if_match, change):
+        """
+        Calls change(pet) on a Pet that was read to be written back whole
+
+        Returns None when the changed Pet can be written back, or the result
+        of the update or purchase that failed: 0 when the Pet was not found,
+        -1 when change(pet) returned False or -2 when its version is not in
+        if_match.
+        """
+        if pet is None:
+            return 0
+        if if_match is not None and str(pet.version) not in map(str, if_match):
+            return -2
+        if not change(pet):
+            return -1
+        return None
+
+    @classmethod
+    def _written_values(cls, data, version):
+        """Returns the stored values of a Pet that was just written as data"""
+        values = [data.get(name) or None for name in cls.stored_fields]
+        values[len(cls.fields)] = str(version)
+        return values
+
+    @classmethod
+    def __rewrite(cls, pet_id, if_match, change):
+        """
+        Changes a Pet by reading it and writing it back whole
+
+        A Pet in a packed record cannot be changed field by field in
+        storage, so it is read from the primary and written back on
+        condition that its version has not changed, or read again if it
+        has. Returns the same results as the update and purchase of the
+        storage engines.
+        """
+        while True:
+            pet = cls.find(pet_id, primary=True)
+            failed = cls._change(pet, if_match, change)
+            if failed is not None:
+                return [failed]
+            data = pet.to_hash()
+            [version] = cls.storage.save(
+                [(pet.id, data, [pet.version])], must_exist=True
+            )
+            if version == 0:  # deleted since it was read
+                return [0]
+            if version > 0:
+                return [1, cls._written_values(data, version)]
+
+    @classmethod
+    def update_fields(cls, pet_id, if_match=None, **fields):
+        """
+        Updates some of the attributes of a Pet in a single atomic operation
+
+        Only the given fields are written, without reading the Pet first,
+        unless it is stored in a packed record. Returns the updated Pet or
+        None if it was not found.
+
+        Exception:
+        ----------
+          DataValidationError - if a field is unknown or the name is removed
+          VersionConflictError - if the stored version is not in if_match
+        """
+        cls.check_fields(fields)
+        if not fields and if_match is None:
+            return cls.find(pet_id)
+        result = [-3]
+        if not record_codec.packed():
+            result = cls.storage.update(pet_id, cls.hash_fields(fields), if_match)
+        if result[0] == -3:  # stored in a packed record
+            result = cls.__rewrite(pet_id, if_match, lambda pet: cls._set(pet, fields))
+        cls.__invalidate(pet_id)
+        if result[0] == 0:
+            return None
+        if result[0] < 0:
+            raise cls._conflict(pet_id)
+        return cls._from_hash(pet_id, result[1])
+
+    @classmethod
+    def purchase(cls, pet_id, if_match=None):
+        """
+        Purchases a Pet in a single atomic operation
+
+        The availability check and the update happen together in storage,
+        or as a write that is conditional on the version the check was made
+        at, so two buyers can never purchase the same Pet. Returns the
+        purchased Pet or None if it was not found.
+
+        Exception:
+        ----------
+          DataValidationError - if the Pet is not available
+          VersionConflictError - if the stored version is not in if_match
+        """
+        result = [-3]
+        if not record_codec.packed():
+            result = cls.storage.purchase(
+                pet_id, cls.index_key("available", cls.index_value(False)), if_match
+            )
+        if result[0] == -3:  # stored in a packed record
+            result = cls.__rewrite(pet_id, if_match, cls._sell)
+        cls.__invalidate(pet_id)
+        if result[0] == 0:
+            return None
+        if result[0] == -2:
+            raise cls._conflict(pet_id)
+        if result[0] < 0:
+            raise DataValidationError(
+                "Pet with id '{}' is not available.".format(pet_id)
+            )
+        return cls._from_hash(pet_id, result[1])
+
+    @staticmethod
+    def _set(pet, fields):
+        """Sets some attributes of a Pet that is being updated"""
+        for name, value in fields.items():
+            setattr(pet, name, value)
+        return True
+
+    @staticmethod
+    def _sell(pet):
+        """Marks a Pet that is being purchased as unavailable if it is available"""
+        if codec.dumps(pet.available) in UNAVAILABLE:
+            return False
+        pet.available = False
+        return True
+
+    @classmethod
+    def get_response(cls, query):
+        """
+        Returns the catalog version and the cached response for a list query
+
+        Both are read in a single round trip. The response is None when it
+        was never cached or the catalog has changed since it was.
+        """
+        return cls.storage.get_response(query)
+
+    @classmethod
+    def set_response(cls, query, version, body, ttl):
+        """Caches the response of a list query computed at a catalog version"""
+        cls.storage.set_response(query, version, body, ttl)
+
     ######################################################################
     #  F I N D E R   M E T H O D S
     ######################################################################
 
     @classmethod
-    def find(cls, pet_id):
-        """Query that finds Pets by their id"""
-        if cls.redis.exists(pet_id):
-            data = json.loads(cls.redis.get(pet_id))
-            pet = Pet(data["id"]).deserialize(data)
-            return pet
-        return None
+    def find(cls, pet_id, primary=False):
+        """
+        Query that finds Pets by their id
+
+        Pass primary=True to read the latest copy from the primary rather
+        than from a replica or the cache, e.g. before changing the Pet.
+        """
+        if cls.cache is None or primary:
+            values = cls.storage.get(pet_id, cls.stored_fields, primary)
+            return cls._from_hash(pet_id, values)
+        pet_id = int(pet_id)
+        generation = cls.cache.generation
+        values = cls.cache.get(pet_id)
+        if values is None:
+            # a replica may lag behind a change that was already invalidated
+            values = cls.storage.get(pet_id, cls.stored_fields, True)
+            if values[0] is not None or values[-1] is not None:  # only Pets that exist
+                # unless the Pet was changed while it was read
+                cls.cache.set(pet_id, values, generation)
+        # always build a new Pet so callers never share a cached instance
+        return cls._from_hash(pet_id, values)
 
     @classmethod
     def __find_by(cls, attribute, value):
-        """Generic Query that finds a key with a specific value"""
-        # return [pet for pet in Pet.__data if pet.category == category]
+        """Generic Query that finds Pets using the index for an attribute"""
         cls.logger.info("Processing %s query for %s", attribute, value)
-        if isinstance(value, str):
-            search_criteria = value.lower()  # make case insensitive
-        else:
-            search_criteria = value
-        results = []
-        for key in Pet.redis.keys():
-            if key != "index":  # filer out our id index
-                data = json.loads(Pet.redis.get(key))
-                # perform case insensitive search on strings
-                if isinstance(data[attribute], str):
-                    test_value = data[attribute].lower()
-                else:
-                    test_value = data[attribute]
-                if test_value == search_criteria:
-                    results.append(Pet(data["id"]).deserialize(data))
-        return results
+        return list(cls.iter_query(attribute, value))
+
+    @staticmethod
+    def index_value(value):
+        """Normalizes a value so that index lookups are case insensitive"""
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return str(value).lower()
+
+    @staticmethod
+    def index_key(attribute, value):
+        """Returns the key of the index for an attribute value"""
+        return "{}:{}:{}".format(NAMESPACE, attribute, value)
 
     @classmethod
     def find_by_name(cls, name):
@@ -160,6 +888,60 @@ class Pet(object):
         """Query that finds Pets by their availability"""
         return cls.__find_by("available", available)
 
+    ######################################################################
+    #  C A C H E   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    def enable_cache(cls, maxsize=1000, ttl=60):
+        """
+        Keeps an in-process cache of recently found Pets
+
+        Every worker listens on the invalidation channel and drops its copy
+        of a Pet as soon as any process saves, purchases or deletes it. The
+        time to live bounds how stale an entry can get if a message is lost.
+        Pets that are kept in memory are never cached.
+        """
+        cls.disable_cache()
+        if cls.redis is None:
+            return
+        cls.cache = LRUCache(maxsize, ttl)
+        pubsub = cls.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATE_CHANNEL: cls.__on_invalidate})
+        cls.cache_listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        cls.logger.info("Caching up to %d Pets for %d seconds", maxsize, ttl)
+
+    @classmethod
+    def __configure_cache(cls):
+        """Turns on the cache when PET_CACHE_SIZE is set in the environment"""
+        maxsize = int(os.getenv("PET_CACHE_SIZE", "0"))
+        if maxsize > 0:
+            cls.enable_cache(maxsize, int(os.getenv("PET_CACHE_TTL", "60")))
+
+    @classmethod
+    def disable_cache(cls):
+        """Stops caching Pets in this process"""
+        if cls.cache_listener:
+            cls.cache_listener.stop()
+            cls.cache_listener = None
+        cls.cache = None
+
+    @classmethod
+    def __on_invalidate(cls, message):
+        """Drops a Pet that another process changed from the cache"""
+        cls.__invalidate(message["data"])
+
+    @classmethod
+    def __invalidate(cls, pet_id):
+        """Drops a Pet (or every Pet for '*') from the cache"""
+        cache = cls.cache
+        if cache is None:
+            return
+        if pet_id == "*":
+            cache.clear()
+        else:
+            cache.invalidate(int(pet_id))
+
     ######################################################################
     #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
     ######################################################################
@@ -168,12 +950,8 @@ class Pet(object):
     def connect_to_redis(cls, hostname, port, password):
         """Connects to Redis and tests the connection"""
         cls.logger.info("Testing Connection to: %s:%s", hostname, port)
-        cls.redis = StrictRedis(
-            host=hostname,
-            port=port,
-            password=password,
-            charset="utf-8",
-            decode_responses=True,
+        cls.redis = ObservedRedis(
+            connection_pool=cls.connection_pool(hostname, port, password)
         )
 
         try:
@@ -184,6 +962,259 @@ class Pet(object):
             cls.redis = None
         return cls.redis
 
+    @classmethod
+    def connect_to_cluster(cls, nodes, password):
+        """
+        Connects to a Redis Cluster through some of its nodes
+
+        The client finds the rest of the nodes itself and is created once
+        per process like the connection pool.
+        """
+        if RedisCluster is None:
+            raise ConnectionError("Redis Cluster support needs redis 4.1 or later")
+        settings = (tuple(nodes), password, os.getpid())
+        if cls.cluster is None or cls.cluster_settings != settings:
+            cls.logger.info("Connecting to Redis Cluster nodes %s", nodes)
+            options = cls.pool_options()
+            del options["timeout"]  # only blocking pools wait for a connection
+            try:
+                cls.cluster = ObservedRedisCluster(
+                    startup_nodes=[ClusterNode(host, port) for host, port in nodes],
+                    password=password,
+                    **options
+                )
+            except (RedisError, RedisClusterException) as error:
+                cls.logger.warning("Connection Error from cluster: %s", error)
+                cls.cluster = None
+                cls.redis = None
+                return None
+            cls.cluster_settings = settings
+        cls.redis = cls.cluster
+        return cls.redis
+
+    @classmethod
+    def connect_to_sentinel(cls, sentinels, master_name, password):
+        """
+        Connects to the primary and the replicas that Sentinel monitors
+
+        The clients ask the Sentinels where the primary is whenever they
+        open a connection, so after a failover the new primary is used
+        without a restart. The replica client falls back to the primary
+        when no replica is up.
+        """
+        settings = (tuple(sentinels), master_name, password, os.getpid())
+        if cls.sentinel is None or cls.sentinel_settings != settings:
+            cls.logger.info("Asking Sentinels %s for %s", sentinels, master_name)
+            options = cls.pool_options()
+            del options["timeout"]  # only blocking pools wait for a connection
+            sentinel = Sentinel(
+                sentinels,
+                socket_timeout=options["socket_timeout"],
+                socket_connect_timeout=options["socket_connect_timeout"],
+            )
+            cls.sentinel = (
+                sentinel.master_for(
+                    master_name, ObservedRedis, password=password, **options
+                ),
+                sentinel.slave_for(
+                    master_name, ObservedRedis, password=password, **options
+                ),
+            )
+            cls.sentinel_settings = settings
+        cls.redis, replica = cls.sentinel
+        cls.replicas = [replica]
+        try:
+            cls.redis.ping()
+            cls.logger.info("Connection established")
+        except ConnectionError:
+            cls.logger.warning("Sentinels do not know a primary for %s", master_name)
+            cls.redis = None
+        return cls.redis
+
+    @classmethod
+    def connect_to_replicas(cls, replicas, password):
+        """Connects to read replicas of the primary, each with its own pool"""
+        cls.replicas = []
+        for hostname, port in replicas:
+            settings = (hostname, port, password, os.getpid())
+            if settings not in cls.replica_pools:
+                cls.logger.info(
+                    "Creating connection pool for replica %s:%s", hostname, port
+                )
+                cls.replica_pools[settings] = BlockingConnectionPool(
+                    host=hostname, port=port, password=password, **cls.pool_options()
+                )
+            cls.replicas.append(
+                ObservedRedis(connection_pool=cls.replica_pools[settings])
+            )
+        return cls.replicas
+
+    @classmethod
+    def connection_pool(cls, hostname, port, password):
+        """
+        Returns the connection pool for this process
+
+        The pool is created once per process and shared by every client so
+        repeated calls to init_db() never open extra connections. It is
+        sized and tuned with the REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT,
+        REDIS_SOCKET_TIMEOUT, REDIS_CONNECT_TIMEOUT, REDIS_HEALTH_CHECK_INTERVAL
+        and REDIS_KEEPALIVE environment variables.
+        """
+        settings = (hostname, port, password, os.getpid())
+        if cls.pool is None or cls.pool_settings != settings:
+            cls.logger.info("Creating connection pool for %s:%s", hostname, port)
+            cls.pool = BlockingConnectionPool(
+                host=hostname, port=port, password=password, **cls.pool_options()
+            )
+            cls.pool_settings = settings
+        return cls.pool
+
+    @staticmethod
+    def pool_options():
+        """Returns the connection pool settings from the environment"""
+        return {
+            "max_connections": int(os.getenv("REDIS_MAX_CONNECTIONS", "50")),
+            "timeout": float(os.getenv("REDIS_POOL_TIMEOUT", "20")),
+            "socket_timeout": float(os.getenv("REDIS_SOCKET_TIMEOUT", "5")),
+            "socket_connect_timeout": float(os.getenv("REDIS_CONNECT_TIMEOUT", "5")),
+            "health_check_interval": int(
+                os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30")
+            ),
+            "socket_keepalive": os.getenv("REDIS_KEEPALIVE", "True") == "True",
+            "encoding": "utf-8",
+            # keeps the bytes of packed records that are not UTF-8
+            "encoding_errors": "surrogateescape",
+            "decode_responses": True,
+        }
+
+    @classmethod
+    def pool_stats(cls):
+        """
+        Returns the usage of the connection pool of the current client
+
+        A cluster client has a pool per node and the replicas each have
+        their own pool, the usage of all of them is added up.
+        """
+        if RedisCluster is not None and isinstance(cls.redis, RedisCluster):
+            pools = [node.redis_connection for node in cls.redis.get_nodes()]
+            pools = [client.connection_pool for client in pools if client]
+        else:
+            pools = [cls.redis.connection_pool]
+        pools += [replica.connection_pool for replica in cls.replicas]
+        stats = {"max_connections": 0, "created": 0, "in_use": 0, "idle": 0}
+        for pool in pools:
+            if isinstance(pool, BlockingConnectionPool):
+                created = len(pool._connections)
+                idle = len([conn for conn in list(pool.pool.queue) if conn])
+            else:
+                created = pool._created_connections
+                idle = len(pool._available_connections)
+            stats["max_connections"] += pool.max_connections
+            stats["created"] += created
+            stats["in_use"] += created - idle
+            stats["idle"] += idle
+        return stats
+
+    @classmethod
+    def cluster_credentials(cls):
+        """
+        Returns the (hostname, port) of some cluster nodes and the password
+
+        Returns None unless a Redis Cluster is configured, either with
+        "cluster": true and optionally a list of "nodes" in the credentials
+        in VCAP_SERVICES, or as host:port,host:port in REDIS_CLUSTER_NODES.
+        """
+        creds = cls.__vcap_credentials()
+        if creds is not None:
+            if not creds.get("cluster"):
+                return None
+            nodes = cls.__nodes(creds.get("nodes") or [creds])
+            return nodes, creds.get("password") or None
+        if not os.getenv("REDIS_CLUSTER_NODES"):
+            return None
+        nodes = cls.__nodes(os.environ["REDIS_CLUSTER_NODES"])
+        return nodes, os.getenv("REDIS_PASSWORD") or None
+
+    @classmethod
+    def sentinel_credentials(cls):
+        """
+        Returns the (hostname, port) of the Sentinels, the name they monitor
+        the primary as and its password
+
+        Returns None unless Sentinel is configured, either with a list of
+        "sentinels" and a "master_name" in the credentials in VCAP_SERVICES,
+        or as host:port,host:port in REDIS_SENTINELS with the name in
+        REDIS_SENTINEL_MASTER.
+        """
+        creds = cls.__vcap_credentials()
+        if creds is not None:
+            if not creds.get("sentinels"):
+                return None
+            return (
+                cls.__nodes(creds["sentinels"]),
+                creds.get("master_name", "mymaster"),
+                creds.get("password") or None,
+            )
+        if not os.getenv("REDIS_SENTINELS"):
+            return None
+        return (
+            cls.__nodes(os.environ["REDIS_SENTINELS"]),
+            os.getenv("REDIS_SENTINEL_MASTER", "mymaster"),
+            os.getenv("REDIS_PASSWORD") or None,
+        )
+
+    @classmethod
+    def replica_credentials(cls):
+        """
+        Returns the (hostname, port) of the read replicas of the primary
+
+        They are listed as "replicas" in the credentials in VCAP_SERVICES or
+        as host:port,host:port in REDIS_REPLICAS.
+        """
+        creds = cls.__vcap_credentials()
+        if creds is not None:
+            return cls.__nodes(creds.get("replicas", []))
+        return cls.__nodes(os.getenv("REDIS_REPLICAS", ""))
+
+    @staticmethod
+    def __vcap_credentials():
+        """Returns the credentials of the Redis service in VCAP_SERVICES or None"""
+        if "VCAP_SERVICES" not in os.environ:
+            return None
+        services = json.loads(os.environ["VCAP_SERVICES"])
+        return services["rediscloud"][0]["credentials"]
+
+    @staticmethod
+    def __nodes(nodes):
+        """
+        Returns a list of (hostname, port) from a host:port,host:port string
+        or a list of objects with a hostname and a port
+        """
+        if isinstance(nodes, str):
+            nodes = [node.strip().rpartition(":") for node in nodes.split(",")]
+            return [(hostname, int(port)) for hostname, _, port in nodes if port]
+        return [(node["hostname"], int(node["port"])) for node in nodes]
+
+    @classmethod
+    def redis_credentials(cls):
+        """Returns the hostname, port and password of the Redis service"""
+        # Get the credentials from the IBM Cloud environment
+        if "VCAP_SERVICES" in os.environ:
+            cls.logger.info("Using VCAP_SERVICES...")
+            vcap_services = os.environ["VCAP_SERVICES"]
+            services = json.loads(vcap_services)
+            creds = services["rediscloud"][0]["credentials"]
+            cls.logger.info(
+                "Conecting to Redis on host %s port %s",
+                creds["hostname"],
+                creds["port"],
+            )
+            return creds["hostname"], creds["port"], creds["password"]
+        cls.logger.info("VCAP_SERVICES not found, checking REDIS_HOST for Redis")
+        REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
+        REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+        return REDIS_HOST, REDIS_PORT, None
+
     @classmethod
     def init_db(cls, redis=None):
         """
@@ -194,41 +1225,99 @@ class Pet(object):
           2) With Redis running on the local server as with Travis CI
           3) With Redis --link in a Docker container called 'redis'
           4) Passing in your own Redis connection object
+          5) With a Redis Cluster from REDIS_CLUSTER_NODES or VCAP_SERVICES
+          6) With a primary and replicas found by Sentinel or listed
+          7) Without Redis when PET_STORAGE is memory
 
         Exception:
         ----------
           redis.ConnectionError - if ping() test fails
+          ValueError - if PET_STORAGE names an unknown engine or the client
+                       can not read the packed records
         """
+        engine = os.getenv("PET_STORAGE", RedisStorage.name)
+        if engine not in (RedisStorage.name, MemoryStorage.name):
+            raise ValueError("Unknown PET_STORAGE engine {}".format(engine))
+        if redis is None and engine == MemoryStorage.name:
+            cls.init_memory()
+            return
+
         if redis:
             cls.logger.info("Using client connection...")
+            cls.check_client(redis)
             cls.redis = redis
+            cls.replicas = []
             try:
                 cls.redis.ping()
                 cls.logger.info("Connection established")
             except ConnectionError:
                 cls.logger.error("Client Connection Error!")
                 cls.redis = None
+                cls.storage = None
                 raise ConnectionError("Could not connect to the Redis Service")
+            cls.__use_redis()
+            cls.__configure_cache()
             return
 
-        # Get the credentials from the IBM Cloud environment
-        if "VCAP_SERVICES" in os.environ:
-            cls.logger.info("Using VCAP_SERVICES...")
-            vcap_services = os.environ["VCAP_SERVICES"]
-            services = json.loads(vcap_services)
-            creds = services["rediscloud"][0]["credentials"]
-            cls.logger.info(
-                "Conecting to Redis on host %s port %s",
-                creds["hostname"],
-                creds["port"],
-            )
-            cls.connect_to_redis(creds["hostname"], creds["port"], creds["password"])
+        cls.replicas = []
+        cluster = cls.cluster_credentials()
+        sentinel = cls.sentinel_credentials()
+        if cluster:
+            cls.connect_to_cluster(*cluster)
+        elif sentinel:
+            cls.connect_to_sentinel(*sentinel)
         else:
-            cls.logger.info("VCAP_SERVICES not found, checking REDIS_HOST for Redis")
-            REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
-            REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
-            cls.connect_to_redis(REDIS_HOST, REDIS_PORT, None)
+            hostname, port, password = cls.redis_credentials()
+            cls.connect_to_redis(hostname, port, password)
+            cls.connect_to_replicas(cls.replica_credentials(), password)
         if not Pet.redis:
             # if you end up here, redis instance is down.
             cls.logger.fatal("*** FATAL ERROR: Could not connect to the Redis Service")
+            cls.storage = None
             raise ConnectionError("Could not connect to the Redis Service")
+        cls.__use_redis()
+        cls.__configure_cache()
+
+    @staticmethod
+    def check_client(redis):
+        """Raises a ValueError if a client can not read the packed records"""
+        if not record_codec.readable(redis):
+            raise ValueError(
+                "PET_RECORD_FORMAT {} needs a client that decodes replies with "
+                "encoding_errors='surrogateescape'".format(record_codec.name)
+            )
+
+    @classmethod
+    def __use_redis(cls):
+        """Stores the Pets in Redis through the client that is connected"""
+        index_fields = ["_" + name for name in cls.indexed_attributes]
+        if RedisCluster is not None and isinstance(cls.redis, RedisCluster):
+            cls.storage = ClusterStorage(
+                cls.redis,
+                cls.stored_fields,
+                index_fields,
+                cls.batch_size,
+                int(os.getenv("REDIS_CLUSTER_SHARDS", "16")),
+            )
+        else:
+            cls.storage = RedisStorage(
+                cls.redis,
+                cls.stored_fields,
+                index_fields,
+                cls.batch_size,
+                cls.replicas,
+            )
+
+    @classmethod
+    def init_memory(cls):
+        """
+        Stores the Pets in this process instead of Redis
+
+        The Pets are kept for the life of the process, so calling this again
+        keeps the ones that are already stored.
+        """
+        cls.disable_cache()
+        cls.redis = None
+        if not isinstance(cls.storage, MemoryStorage):
+            cls.logger.info("Storing Pets in memory")
+            cls.storage = MemoryStorage(cls.stored_fields)
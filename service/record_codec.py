@@ -0,0 +1,195 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Module: record_codec
+
+The formats that the attribute values of a Pet are stored in
+
+  json    - one hash field per attribute holding its JSON value
+  compact - one record field with the values in field order, each as a
+            type byte and a length instead of a field name and quotes
+  msgpack - one record field with the values as a MessagePack array
+
+Both packed formats can be followed by +zlib, e.g. compact+zlib, to
+compress the records that get smaller that way. Every packed record starts
+with a marker byte that names its format, so a record written in any
+format is read back whatever format is in use. Set PET_RECORD_FORMAT to
+pick one by name, json is the default.
+"""
+import os
+import zlib
+from service import codec
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+# set in the marker byte of a record whose payload is compressed
+COMPRESSED = 0x80
+
+# type bytes of the values in the compact format
+NONE, FALSE, TRUE, TEXT, JSON = range(5)
+
+
+def varint(number):
+    """Encodes a length in as few bytes as it needs, 7 bits per byte"""
+    data = bytearray()
+    while number >= 0x80:
+        data.append(number & 0x7F | 0x80)
+        number >>= 7
+    data.append(number)
+    return data
+
+
+def pack_compact(values):
+    """Encodes values in the compact format"""
+    data = bytearray()
+    for value in values:
+        if value is None:
+            data.append(NONE)
+        elif value is True or value is False:
+            data.append(TRUE if value else FALSE)
+        else:
+            if isinstance(value, str):
+                data.append(TEXT)
+                encoded = value.encode("utf-8")
+            else:  # numbers, lists and objects are kept as JSON
+                data.append(JSON)
+                encoded = codec.dumpb(value)
+            data += varint(len(encoded))
+            data += encoded
+    return bytes(data)
+
+
+def unpack_compact(data):
+    """Decodes values in the compact format"""
+    values = []
+    position = 0
+    while position < len(data):
+        kind = data[position]
+        position += 1
+        if kind in (NONE, FALSE, TRUE):
+            values.append((None, False, True)[kind])
+            continue
+        length = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        encoded = data[position : position + length]
+        position += length
+        if position > len(data):
+            raise ValueError("Invalid compact record: truncated")
+        if kind == TEXT:
+            values.append(encoded.decode("utf-8"))
+        elif kind == JSON:
+            values.append(codec.loads(encoded))
+        else:
+            raise ValueError("Invalid compact record: unknown type {}".format(kind))
+    return values
+
+
+# name: (marker byte, pack, unpack)
+FORMATS = {"compact": (1, pack_compact, unpack_compact)}
+if msgpack:
+    FORMATS["msgpack"] = (
+        2,
+        msgpack.packb,
+        lambda data: msgpack.unpackb(data, raw=False),
+    )
+UNPACKERS = {marker: unpack for marker, _, unpack in FORMATS.values()}
+
+name = None
+_marker = None
+_pack = None
+_compress = False
+
+
+def use(format_name):
+    """Switches to the named record format"""
+    global name, _marker, _pack, _compress  # pylint: disable=global-statement
+    base, _, compression = format_name.partition("+")
+    if format_name != "json" and (
+        base not in FORMATS or compression not in ("", "zlib")
+    ):
+        raise ValueError("Record format {} is not available".format(format_name))
+    name = format_name
+    _marker, _pack, _ = FORMATS.get(base, (None, None, None))
+    _compress = compression == "zlib"
+
+
+def packed():
+    """Tells if the values of a Pet are stored in one record field"""
+    return _pack is not None
+
+
+def pack(values):
+    """Encodes values as a record in the current packed format"""
+    marker = _marker
+    payload = _pack(values)
+    if _compress:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            marker, payload = marker | COMPRESSED, compressed
+    return bytes([marker]) + payload
+
+
+def unpack(record):
+    """Decodes a record in any packed format, raises ValueError if it is invalid"""
+    data = to_bytes(record)
+    if not data or (data[0] & ~COMPRESSED) not in UNPACKERS:
+        raise ValueError("Unknown record format")
+    payload = data[1:]
+    try:
+        if data[0] & COMPRESSED:
+            payload = zlib.decompress(payload)
+        return UNPACKERS[data[0] & ~COMPRESSED](payload)
+    except (zlib.error, IndexError, UnicodeDecodeError) as error:
+        raise ValueError("Invalid record: {}".format(error))
+
+
+def readable(client):
+    """
+    Tells if a Redis client returns the records it reads as they were stored
+
+    A client that decodes replies has to do it with surrogateescape, the
+    strict decoding fails on the bytes of a packed record that are not UTF-8.
+    """
+    get_encoder = getattr(client, "get_encoder", None)
+    encoder = get_encoder() if get_encoder else client.connection_pool.get_encoder()
+    return (
+        not packed()
+        or not encoder.decode_responses
+        or encoder.encoding_errors == "surrogateescape"
+    )
+
+
+def to_bytes(record):
+    """
+    Returns a record read from Redis as bytes
+
+    The Redis clients decode replies with surrogateescape, which turns the
+    bytes that are not UTF-8 into lone surrogates that encode back to the
+    very same bytes.
+    """
+    if record is None or isinstance(record, bytes):
+        return record
+    return record.encode("utf-8", "surrogateescape")
+
+
+use(os.getenv("PET_RECORD_FORMAT", "json"))
@@ -19,25 +19,38 @@ This modules provides a REST API for the Pet Model
 
 Paths:
 ------
-GET /pets - Lists all of the Pets
+GET /pets - Lists all of the Pets (use limit and cursor to page through them)
+GET /pets?stream=true - Streams all of the Pets (or as NDJSON if accepted)
 GET /pets/{id} - Retrieves a single Pet with the specified id
 POST /pets - Creates a new Pet
+POST /pets/batch - Creates many Pets from a JSON array or NDJSON
 PUT /pets/{id} - Updates a single Pet with the specified id
+PUT /pets/batch - Updates many Pets, each item must include its id
+PATCH /pets/{id} - Updates only the given attributes of a Pet
 DELETE /pets/{id} - Deletes a single Pet with the specified id
+DELETE /pets/batch - Deletes the Pets whose ids are in the body
 POST /pets/{id}/purchase - Action to purchase a Pet
+
+Every Pet is returned with its version as a strong ETag. GET requests with a
+matching If-None-Match get 304 Not Modified and PUT, PATCH, DELETE and purchase
+requests with an If-Match that no longer matches get 412 Precondition Failed.
 """
 
 import os
 import sys
 import logging
 from functools import wraps
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, request, url_for, make_response, abort
 from service.models import Pet, DataValidationError
-from service import app, status  # HTTP Status Codes
+from service import app, codec, status  # HTTP Status Codes
 
 # Pull options from environment
 DEBUG = os.getenv("DEBUG", "False") == "True"
 PORT = os.getenv("PORT", "5000")
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+NDJSON = "application/x-ndjson"
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "60"))
 
 
 ######################################################################
@@ -74,6 +87,14 @@ def requires_content_type(*content_types):
     return decorator
 
 
+######################################################################
+# RESPONSES
+######################################################################
+def json_response(data, code=status.HTTP_200_OK, headers=None):
+    """Returns data encoded with the fastest JSON codec that is installed"""
+    return Response(codec.dumpb(data), code, headers, mimetype="application/json")
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -89,23 +110,97 @@ def index():
 ######################################################################
 @app.route("/pets", methods=["GET"])
 def list_pets():
-    """Returns all of the Pets"""
+    """
+    Returns all of the Pets
+
+    When a limit or cursor is given only one page of Pets is returned and
+    the next page is advertised in a Link header with rel="next".
+    Clients that accept application/x-ndjson or pass stream=true have the
+    Pets streamed to them as they are read from the database. Otherwise the
+    response is cached in Redis until any Pet is changed.
+    """
     app.logger.info("Request for List Pets")
-    pets = []
-    category = request.args.get("category")
-    name = request.args.get("name")
-    available = request.args.get("available")
-    if category:
-        pets = Pet.find_by_category(category)
-    elif name:
-        pets = Pet.find_by_name(name)
-    elif available:
-        pets = Pet.find_by_availability(available)
-    else:
-        pets = Pet.all()
+    ndjson = (
+        request.accept_mimetypes.best_match(["application/json", NDJSON])
+        == NDJSON
+    )
+    if ndjson or request.args.get("stream", "").lower() == "true":
+        return stream_pets(ndjson)
+    if "limit" in request.args or "cursor" in request.args:
+        return list_pets_page()
+
+    attribute, value = get_query()
+    query = "{}={}".format(attribute, Pet.index_value(value)) if attribute else "all"
+    body = None
+    if RESPONSE_CACHE_TTL > 0:
+        version, body = Pet.get_response(query)
+    if body is None:
+        # the stored JSON is passed through without building any Pets
+        pets = Pet.iter_json(attribute, value)
+        body = "[{}]".format(",".join(pets)).encode("utf-8")
+        if RESPONSE_CACHE_TTL > 0:
+            Pet.set_response(query, version, body, RESPONSE_CACHE_TTL)
+
+    response = Response(body, status.HTTP_200_OK, mimetype="application/json")
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def list_pets_page():
+    """Returns one page of the Pets that match the query"""
+    try:
+        limit = int(request.args.get("limit", MAX_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer")
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    attribute, value = get_query()
+    pets, next_cursor = Pet.paginate(
+        limit, request.args.get("cursor"), attribute, value
+    )
 
     results = [pet.serialize() for pet in pets]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    headers = {}
+    if next_cursor:
+        args = request.args.to_dict()
+        args.update(limit=limit, cursor=next_cursor)
+        next_url = url_for("list_pets", _external=True, **args)
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+    response = json_response(results, status.HTTP_200_OK, headers)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def get_query(args=None):
+    """Returns the attribute and value that the Pets are filtered by"""
+    args = request.args if args is None else args
+    for attribute in ["category", "name", "available"]:
+        if args.get(attribute):
+            return attribute, args.get(attribute)
+    return None, None
+
+
+def stream_pets(ndjson):
+    """Streams the Pets that match the query a batch at a time"""
+    attribute, value = get_query()
+    pets = Pet.iter_json(attribute, value)
+
+    def generate_ndjson():
+        for pet in pets:
+            yield pet + "\n"
+
+    def generate_array():
+        separator = "["
+        for pet in pets:
+            yield separator + pet
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    if ndjson:
+        return Response(generate_ndjson(), status.HTTP_200_OK, mimetype=NDJSON)
+    return Response(generate_array(), status.HTTP_200_OK, mimetype="application/json")
 
 
 ######################################################################
@@ -124,7 +219,25 @@ def get_pets(pet_id):
         abort(
             status.HTTP_404_NOT_FOUND, "Pet with id '{}' was not found.".format(pet_id)
         )
-    return make_response(jsonify(pet.serialize()), status.HTTP_200_OK)
+    if request.if_none_match.contains_weak(str(pet.version)):
+        response = make_response("", status.HTTP_304_NOT_MODIFIED)
+        response.set_etag(str(pet.version))
+        return response
+    return pet_response(pet)
+
+
+def pet_response(pet, code=status.HTTP_200_OK, headers=None):
+    """Returns a Pet with its version as a strong ETag"""
+    response = json_response(pet.serialize(), code, headers)
+    response.set_etag(str(pet.version))
+    return response
+
+
+def get_if_match():
+    """Returns the Pet versions that an If-Match header allows or None for any"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return list(request.if_match.as_set())  # weak ETags never match
 
 
 ######################################################################
@@ -155,14 +268,84 @@ def create_pets():
     pet = Pet()
     pet.deserialize(data)
     pet.save()
-    message = pet.serialize()
-    return make_response(
-        jsonify(message),
+    return pet_response(
+        pet,
         status.HTTP_201_CREATED,
         {"Location": url_for("get_pets", pet_id=pet.id, _external=True)},
     )
 
 
+######################################################################
+# CREATE MANY PETS
+######################################################################
+@app.route("/pets/batch", methods=["POST"])
+@requires_content_type("application/json", NDJSON)
+def create_pets_batch():
+    """
+    Creates many Pets
+
+    This endpoint will create a Pet for each item in a JSON array or in the
+    lines of an NDJSON body. Every item gets its own result so that bad
+    items are reported without rejecting the whole batch.
+    """
+    app.logger.info("Request to create a batch of Pets")
+    results = []
+    pets = []
+    for data in get_batch():
+        try:
+            pet = Pet().deserialize(data)
+            if pet.name is None:
+                raise DataValidationError("Invalid pet: name must be set")
+        except DataValidationError as error:
+            results.append(batch_error(error))
+            continue
+        pets.append((len(results), pet))
+        results.append(None)  # filled in once the Pet has been given an id
+    Pet.create_many([pet for _, pet in pets])
+
+    for position, pet in pets:
+        results[position] = {
+            "status": status.HTTP_201_CREATED,
+            "location": url_for("get_pets", pet_id=pet.id, _external=True),
+            "pet": pet.serialize(),
+        }
+    return json_response(results, batch_status(results, status.HTTP_201_CREATED))
+
+
+def get_batch():
+    """Returns the items in the body of a batch request"""
+    if request.headers.get("Content-Type") == NDJSON:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if line.strip():
+                try:
+                    items.append(codec.loads(line))
+                except ValueError:
+                    items.append(None)  # reported as bad data for this item
+    else:
+        items = request.get_json()
+        if not isinstance(items, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Body must be a JSON array")
+    if len(items) > MAX_BATCH_SIZE:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Batches are limited to {} items".format(MAX_BATCH_SIZE),
+        )
+    return items
+
+
+def batch_error(error, code=status.HTTP_400_BAD_REQUEST):
+    """Returns the result for an item of a batch that failed"""
+    return {"status": code, "error": str(error)}
+
+
+def batch_status(results, success):
+    """Returns the status of a batch, 207 if any of its items failed"""
+    if any(result["status"] >= status.HTTP_400_BAD_REQUEST for result in results):
+        return status.HTTP_207_MULTI_STATUS
+    return success
+
+
 ######################################################################
 # UPDATE AN EXISTING PET
 ######################################################################
@@ -175,15 +358,89 @@ def update_pets(pet_id):
     This endpoint will update a Pet based the body that is posted
     """
     app.logger.info("Request to update Pet with id %s", pet_id)
-    pet = Pet.find(pet_id)
+    pet = Pet.find(pet_id, primary=True)  # a replica may not have it yet
     if not pet:
         abort(
             status.HTTP_404_NOT_FOUND, "Pet with id '{}' was not found.".format(pet_id)
         )
     pet.deserialize(request.get_json())
     pet.id = pet_id
-    pet.save()
-    return make_response(jsonify(pet.serialize()), status.HTTP_200_OK)
+    pet.save(if_match=get_if_match())
+    return pet_response(pet)
+
+
+######################################################################
+# PARTIALLY UPDATE AN EXISTING PET
+######################################################################
+@app.route("/pets/<int:pet_id>", methods=["PATCH"])
+@requires_content_type("application/json", "application/merge-patch+json")
+def patch_pets(pet_id):
+    """
+    Partially update a Pet
+
+    This endpoint will update only the attributes that are in the body
+    """
+    app.logger.info("Request to patch Pet with id %s", pet_id)
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "Body must be a JSON object")
+    data.pop("id", None)  # the id in the path is the one that counts
+    Pet.check_fields(data)  # before the keys can clash with the arguments
+    pet = Pet.update_fields(pet_id, if_match=get_if_match(), **data)
+    if not pet:
+        abort(
+            status.HTTP_404_NOT_FOUND, "Pet with id '{}' was not found.".format(pet_id)
+        )
+    return pet_response(pet)
+
+
+######################################################################
+# UPDATE MANY PETS
+######################################################################
+@app.route("/pets/batch", methods=["PUT"])
+@requires_content_type("application/json", NDJSON)
+def update_pets_batch():
+    """
+    Update many Pets
+
+    This endpoint will update the Pet identified by the id of each item in
+    a JSON array or NDJSON body and report the result of every item
+    """
+    app.logger.info("Request to update a batch of Pets")
+    results = []
+    pets = []
+    for data in get_batch():
+        try:
+            pet = Pet(get_batch_id(data)).deserialize(data)
+            if pet.name is None:
+                raise DataValidationError("Invalid pet: name must be set")
+        except DataValidationError as error:
+            results.append(batch_error(error))
+            continue
+        pets.append((len(results), pet))
+        results.append(None)  # filled in once the Pet has been saved
+    saved = Pet.save_many([pet for _, pet in pets])
+
+    for (position, pet), found in zip(pets, saved):
+        if found:
+            results[position] = {"status": status.HTTP_200_OK, "pet": pet.serialize()}
+        else:
+            results[position] = batch_error(
+                "Pet with id '{}' was not found.".format(pet.id),
+                status.HTTP_404_NOT_FOUND,
+            )
+    return json_response(results, batch_status(results, status.HTTP_200_OK))
+
+
+def get_batch_id(data):
+    """Returns the id of a Pet in a batch item"""
+    try:
+        pet_id = int(data["id"])
+    except (KeyError, TypeError, ValueError):
+        raise DataValidationError("Invalid pet: id must be a positive integer")
+    if pet_id < 1:
+        raise DataValidationError("Invalid pet: id must be a positive integer")
+    return pet_id
 
 
 ######################################################################
@@ -197,12 +454,47 @@ def delete_pets(pet_id):
     This endpoint will delete a Pet based the id specified in the path
     """
     app.logger.info("Request to delete Pet with id %s", pet_id)
-    pet = Pet.find(pet_id)
-    if pet:
-        pet.delete()
+    # deleting a Pet that does not exist is a no-op so there is no need to find it
+    Pet(pet_id).delete(if_match=get_if_match())
     return make_response("", status.HTTP_204_NO_CONTENT)
 
 
+######################################################################
+# DELETE MANY PETS
+######################################################################
+@app.route("/pets/batch", methods=["DELETE"])
+@requires_content_type("application/json", NDJSON)
+def delete_pets_batch():
+    """
+    Delete many Pets
+
+    This endpoint will delete the Pets whose ids are listed in the body and
+    report which of them were not found
+    """
+    app.logger.info("Request to delete a batch of Pets")
+    results = []
+    pet_ids = []
+    for pet_id in get_batch():
+        try:
+            pet_id = get_batch_id({"id": pet_id})
+        except DataValidationError as error:
+            results.append(batch_error(error))
+            continue
+        pet_ids.append((len(results), pet_id))
+        results.append(None)  # filled in once the Pet has been deleted
+    deleted = Pet.delete_many([pet_id for _, pet_id in pet_ids])
+
+    for (position, pet_id), found in zip(pet_ids, deleted):
+        if found:
+            results[position] = {"status": status.HTTP_204_NO_CONTENT, "id": pet_id}
+        else:
+            results[position] = batch_error(
+                "Pet with id '{}' was not found.".format(pet_id),
+                status.HTTP_404_NOT_FOUND,
+            )
+    return json_response(results, batch_status(results, status.HTTP_200_OK))
+
+
 ######################################################################
 # PURCHASE A PET
 ######################################################################
@@ -210,19 +502,12 @@ def delete_pets(pet_id):
 def purchase_pets(pet_id):
     """Purchase a Pet"""
     app.logger.info("Request to purchase Pet with id %s", pet_id)
-    pet = Pet.find(pet_id)
+    pet = Pet.purchase(pet_id, if_match=get_if_match())
     if not pet:
         abort(
             status.HTTP_404_NOT_FOUND, "Pet with id '{}' was not found.".format(pet_id)
         )
-    if not pet.available:
-        abort(
-            status.HTTP_400_BAD_REQUEST,
-            "Pet with id '{}' is not available.".format(pet_id),
-        )
-    pet.available = False
-    pet.save()
-    return make_response(jsonify(pet.serialize()), status.HTTP_200_OK)
+    return pet_response(pet)
 
 
 ######################################################################
@@ -230,7 +515,6 @@ def purchase_pets(pet_id):
 ######################################################################
 
 
-@app.before_first_request
 def init_db(redis=None):
     """Initlaize the model"""
     Pet.init_db(redis)
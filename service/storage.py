@@ -0,0 +1,864 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Module: storage
+
+The storage engines behind the Pet model
+
+Each Pet is stored as a record of fields with one JSON encoded value per
+attribute, or with every value packed into the record field by one of the
+formats in record_codec. Fields that start with an underscore are
+bookkeeping: _version holds the version of the last write and _<attribute>
+names the index key the Pet is currently filed under, so an engine can
+move it atomically. Writing an empty value removes a field that does not
+start with an underscore.
+Every engine keeps the records, the indexes and the version clock the same
+way and returns the same results:
+
+  RedisStorage   - Lua scripts on a Redis server that every worker shares
+  ClusterStorage - the same scripts on a Redis Cluster with sharded keys
+  MemoryStorage  - dicts in this process for single node deployments and CI
+"""
+import re
+import time
+import heapq
+import random
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from redis.exceptions import ConnectionError, TimeoutError
+from service import codec
+
+# Every key written by the Pet model starts with the namespace
+NAMESPACE = "pet"
+# Version of the storage layout written by the Pet model
+SCHEMA_VERSION = 2
+SCHEMA_KEY = NAMESPACE + ":schema"
+# Counter that hands out the Pet ids
+ID_SEQUENCE = NAMESPACE + ":seq"
+# Sorted set of every Pet id that gives listings a stable order
+ID_INDEX = NAMESPACE + ":ids"
+# Channel that announces changed Pet ids so workers can drop cached copies
+INVALIDATE_CHANNEL = NAMESPACE + ":invalidate"
+
+# Clock that stamps every write of a Pet with a new version, so it is also
+# the version of the whole catalog
+VERSION_CLOCK = NAMESPACE + ":version"
+
+# Hashes with the serialized results of list queries and the catalog version
+# they were computed at
+RESPONSE_PREFIX = NAMESPACE + ":response:"
+
+# Stored values of the available field that mean a Pet cannot be purchased
+UNAVAILABLE = ("false", "null", "0", '""')
+
+# Field that holds the values of a Pet stored in a packed record format,
+# the scripts below know it by name
+RECORD_FIELD = "r"
+
+# In Redis each Pet is a hash at pet:<id> and every index is a sorted set.
+# Every script announces the id it changed on the invalidation channel.
+
+# Functions that are shared by the scripts below
+PET_FUNCTIONS = """
+local function write_fields(key, id, fields)
+    local values = {}
+    local removed = {}
+    for i = 1, #fields, 2 do
+        local field, value = fields[i], fields[i + 1]
+        if string.sub(field, 1, 1) ~= '_' and value == '' then
+            removed[#removed + 1] = field
+        else
+            if string.sub(field, 1, 1) == '_' then
+                local old = redis.call('HGET', key, field)
+                if old and old ~= value then redis.call('ZREM', old, id) end
+                if value ~= '' then redis.call('ZADD', value, id, id) end
+            end
+            values[#values + 1] = field
+            values[#values + 1] = value
+        end
+    end
+    if #values > 0 then redis.call('HSET', key, unpack(values)) end
+    if #removed > 0 then redis.call('HDEL', key, unpack(removed)) end
+end
+
+local function field_list(encoded)
+    local fields = {}
+    for field, value in pairs(cjson.decode(encoded)) do
+        fields[#fields + 1] = field
+        fields[#fields + 1] = value
+    end
+    return fields
+end
+
+local function is_packed(key)
+    return redis.call('HEXISTS', key, 'r') == 1
+end
+
+local function version_matches(key, expected)
+    if expected == '' then return true end
+    local current = redis.call('HGET', key, '_version') or '0'
+    for _, version in ipairs(cjson.decode(expected)) do
+        if version == current then return true end
+    end
+    return false
+end
+
+local function next_version(key, clock)
+    local version = redis.call('INCR', clock)
+    redis.call('HSET', key, '_version', version)
+    return version
+end
+"""
+
+# KEYS: pet key, id index, version clock
+# ARGV: pet id, channel, must exist, expected versions, field, value, ...
+SAVE_SCRIPT = PET_FUNCTIONS + """
+if ARGV[3] == '1' and redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+if not version_matches(KEYS[1], ARGV[4]) then return -1 end
+write_fields(KEYS[1], ARGV[1], {unpack(ARGV, 5)})
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[1])
+redis.call('PUBLISH', ARGV[2], ARGV[1])
+return next_version(KEYS[1], KEYS[3])
+"""
+
+# KEYS: pet key, version clock
+# ARGV: pet id, channel, {field: value}, expected versions, fields to return...
+UPDATE_SCRIPT = PET_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then return {0} end
+if not version_matches(KEYS[1], ARGV[4]) then return {-2} end
+if is_packed(KEYS[1]) then return {-3} end
+write_fields(KEYS[1], ARGV[1], field_list(ARGV[3]))
+next_version(KEYS[1], KEYS[2])
+redis.call('PUBLISH', ARGV[2], ARGV[1])
+return {1, redis.call('HMGET', KEYS[1], unpack(ARGV, 5))}
+"""
+
+# KEYS: id sequence / ARGV: lowest value the sequence may have
+ADVANCE_SEQUENCE_SCRIPT = """
+if tonumber(redis.call('GET', KEYS[1]) or '0') < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return redis.call('GET', KEYS[1])
+"""
+
+# KEYS: pet key, id index, version clock
+# ARGV: pet id, channel, expected versions, index fields...
+DELETE_SCRIPT = PET_FUNCTIONS + """
+if not version_matches(KEYS[1], ARGV[3]) then return -1 end
+for _, key in ipairs(redis.call('HMGET', KEYS[1], unpack(ARGV, 4))) do
+    if key and key ~= '' then redis.call('ZREM', key, ARGV[1]) end
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('PUBLISH', ARGV[2], ARGV[1])
+local deleted = redis.call('DEL', KEYS[1])
+if deleted == 1 then redis.call('INCR', KEYS[3]) end
+return deleted
+"""
+
+# KEYS: pet key, version clock
+# ARGV: pet id, channel, expected versions, unavailable index key, fields to return...
+PURCHASE_SCRIPT = PET_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then return {0} end
+if not version_matches(KEYS[1], ARGV[3]) then return {-2} end
+if is_packed(KEYS[1]) then return {-3} end
+local available = redis.call('HGET', KEYS[1], 'available')
+if not available then return {0} end
+if available == 'false' or available == 'null' or available == '0'
+        or available == '""' then
+    return {-1}
+end
+local old = redis.call('HGET', KEYS[1], '_available')
+if old and old ~= '' then redis.call('ZREM', old, ARGV[1]) end
+redis.call('ZADD', ARGV[4], ARGV[1], ARGV[1])
+redis.call('HSET', KEYS[1], 'available', 'false', '_available', ARGV[4])
+next_version(KEYS[1], KEYS[2])
+redis.call('PUBLISH', ARGV[2], ARGV[1])
+return {1, redis.call('HMGET', KEYS[1], unpack(ARGV, 5))}
+"""
+
+
+def record_key(pet_id):
+    """Returns the key of the hash that a Pet is stored in"""
+    return "{}:{}".format(NAMESPACE, pet_id)
+
+
+def expected_versions(if_match):
+    """Encodes the versions a write is conditional on for the scripts"""
+    if if_match is None:
+        return ""
+    return codec.dumps([str(version) for version in if_match])
+
+
+######################################################################
+#  S C R I P T   A R G U M E N T S
+######################################################################
+def save_call(pet_id, fields, must_exist=False, if_match=None):
+    """Returns the keys and arguments of the save script"""
+    keys = [record_key(pet_id), ID_INDEX, VERSION_CLOCK]
+    args = [
+        pet_id,
+        INVALIDATE_CHANNEL,
+        "1" if must_exist else "0",
+        expected_versions(if_match),
+    ]
+    for field, value in fields.items():  # values may be binary records
+        args += [field, value]
+    return keys, args
+
+
+def delete_call(pet_id, index_fields, if_match=None):
+    """Returns the keys and arguments of the delete script"""
+    keys = [record_key(pet_id), ID_INDEX, VERSION_CLOCK]
+    args = [pet_id, INVALIDATE_CHANNEL, expected_versions(if_match)]
+    return keys, args + list(index_fields)
+
+
+def update_call(pet_id, fields, if_match, stored_fields):
+    """Returns the keys and arguments of the update script"""
+    keys = [record_key(pet_id), VERSION_CLOCK]
+    args = [
+        pet_id,
+        INVALIDATE_CHANNEL,
+        codec.dumps(fields),
+        expected_versions(if_match),
+    ]
+    return keys, args + list(stored_fields)
+
+
+def purchase_call(pet_id, if_match, unavailable_key, stored_fields):
+    """Returns the keys and arguments of the purchase script"""
+    keys = [record_key(pet_id), VERSION_CLOCK]
+    args = [pet_id, INVALIDATE_CHANNEL, expected_versions(if_match), unavailable_key]
+    return keys, args + list(stored_fields)
+
+
+######################################################################
+#  R E D I S   S T O R A G E
+######################################################################
+class RedisStorage(object):
+    """
+    Stores the Pets in Redis where every process shares them
+
+    Every write goes to the primary. Reads go to a random replica when there
+    are any, and to the primary when that replica cannot be reached.
+    """
+
+    name = "redis"
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+        self, redis, stored_fields, index_fields, batch_size=1000, replicas=()
+    ):
+        """Registers the Lua scripts that keep the indexes consistent"""
+        self.redis = redis
+        self.replicas = list(replicas)
+        self.stored_fields = stored_fields
+        self.index_fields = index_fields
+        self.batch_size = batch_size
+        self.save_script = redis.register_script(SAVE_SCRIPT)
+        self.delete_script = redis.register_script(DELETE_SCRIPT)
+        self.purchase_script = redis.register_script(PURCHASE_SCRIPT)
+        self.update_script = redis.register_script(UPDATE_SCRIPT)
+        self.advance_sequence_script = redis.register_script(ADVANCE_SEQUENCE_SCRIPT)
+
+    def next_ids(self, count=1):
+        """Reserves count new ids and returns the last one"""
+        return self.redis.incrby(ID_SEQUENCE, count)
+
+    def advance_ids(self, minimum):
+        """Makes sure that the ids handed out from now on are above minimum"""
+        self.advance_sequence_script(keys=[ID_SEQUENCE], args=[minimum])
+
+    def save(self, records, must_exist=False):
+        """
+        Writes (id, fields, if_match) records in one pipeline
+
+        Returns the new version of each record, 0 when it must exist but
+        does not or -1 when its version is not in if_match.
+        """
+        calls = [
+            save_call(pet_id, fields, must_exist, if_match)
+            for pet_id, fields, if_match in records
+        ]
+        return self._run(self.save_script, calls)
+
+    def delete(self, records):
+        """
+        Deletes (id, if_match) records in one pipeline
+
+        Returns 1 for each record that was deleted, 0 when it was not found
+        or -1 when its version is not in if_match.
+        """
+        calls = [
+            delete_call(pet_id, self.index_fields, if_match)
+            for pet_id, if_match in records
+        ]
+        return self._run(self.delete_script, calls)
+
+    def update(self, pet_id, fields, if_match=None):
+        """
+        Writes some of the fields of an existing record
+
+        Returns [1, stored values], [0] when it was not found, [-2] when
+        its version is not in if_match or [-3] when it is stored packed.
+        """
+        keys, args = update_call(pet_id, fields, if_match, self.stored_fields)
+        return self.update_script(keys=keys, args=args)
+
+    def purchase(self, pet_id, unavailable_key, if_match=None):
+        """
+        Marks an available record as unavailable
+
+        Returns [1, stored values], [0] when it was not found, [-1] when it
+        is not available, [-2] when its version is not in if_match or [-3]
+        when it is stored packed.
+        """
+        keys, args = purchase_call(
+            pet_id, if_match, unavailable_key, self.stored_fields
+        )
+        return self.purchase_script(keys=keys, args=args)
+
+    def get(self, pet_id, fields, primary=False):
+        """Returns the values of some fields of a record"""
+        return self._read(
+            lambda client: client.hmget(record_key(pet_id), fields), primary
+        )
+
+    def load(self, ids, fields):
+        """Returns the values of some fields of many records in one pipeline"""
+
+        def read(client):
+            pipe = client.pipeline(transaction=False)
+            for pet_id in ids:
+                pipe.hmget(record_key(pet_id), fields)
+            return pipe.execute()
+
+        return self._read(read)
+
+    def range(self, key, after, limit):
+        """Returns up to limit ids above after from the index at key"""
+        ids = self._read(
+            lambda client: client.zrangebyscore(
+                key, "({}".format(after), "+inf", 0, limit
+            )
+        )
+        return [int(pet_id) for pet_id in ids]
+
+    def stored_ids(self):
+        """Generator that returns the ids of every stored record"""
+        seen = set()  # SCAN may return the same key more than once
+        for key in self.redis.scan_iter(match=record_key("*"), count=self.batch_size):
+            pet_id = key.split(":", 1)[1]
+            if pet_id.isdigit() and pet_id not in seen:  # skip counters and indexes
+                seen.add(pet_id)
+                yield int(pet_id)
+
+    def clocks(self):
+        """Returns the keys of the version clocks"""
+        return [VERSION_CLOCK]
+
+    def remove_all(self):
+        """
+        Removes every key in the Pet namespace but the version clocks
+
+        The keys are removed a batch at a time with UNLINK, so other data in
+        a shared Redis is left alone and the server is never blocked by one
+        huge delete. The clocks are kept so that no version is ever handed
+        out twice and an old ETag can never match a new Pet.
+        """
+        clocks = set(self.clocks())
+        batch = []
+        for key in self.redis.scan_iter(match=NAMESPACE + ":*", count=self.batch_size):
+            if key in clocks:
+                continue
+            batch.append(key)
+            if len(batch) >= self.batch_size:
+                self.redis.unlink(*batch)
+                batch = []
+        if batch:
+            self.redis.unlink(*batch)
+        self.redis.publish(INVALIDATE_CHANNEL, "*")
+
+    def _run(self, script, calls):
+        """Runs a script for every (keys, args) call, pipelined when there are many"""
+        if len(calls) == 1:
+            keys, args = calls[0]
+            return [script(keys=keys, args=args)]
+        pipe = self.redis.pipeline(transaction=False)
+        for keys, args in calls:
+            script(keys=keys, args=args, client=pipe)
+        return pipe.execute()
+
+    def _read(self, read, primary=False):
+        """Runs read(client) on a replica, or on the primary if it must"""
+        if primary or not self.replicas:
+            return read(self.redis)
+        try:
+            return read(random.choice(self.replicas))
+        except (ConnectionError, TimeoutError) as error:
+            self.logger.warning("Reading from the primary, replica failed: %s", error)
+            return read(self.redis)
+
+    def get_response(self, query):
+        """Returns the catalog version and the response cached for a query"""
+
+        def read(client):
+            pipe = client.pipeline(transaction=False)
+            pipe.get(VERSION_CLOCK)
+            pipe.hmget(RESPONSE_PREFIX + query, "version", "body")
+            return pipe.execute()
+
+        version, (cached_version, body) = self._read(read)
+        version = int(version or 0)
+        if cached_version is None or int(cached_version) != version:
+            return version, None
+        return version, body
+
+    def set_response(self, query, version, body, ttl):
+        """Caches the response of a query computed at a catalog version"""
+        key = RESPONSE_PREFIX + query
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(key, mapping={"version": version, "body": body})
+        pipe.expire(key, ttl)
+        pipe.execute()
+
+
+######################################################################
+#  R E D I S   C L U S T E R   S T O R A G E
+######################################################################
+class ClusterStorage(RedisStorage):
+    """
+    Stores the Pets in a Redis Cluster
+
+    Pets are spread over a fixed number of shards by id. Every key of a
+    shard carries the shard as a hash tag, like pet:{3}:17 for a Pet and
+    pet:{3}:category:dog for its index, so all of the keys a script touches
+    are in one slot. Each shard has its own id index and version clock and
+    the catalog version is their sum. Batches are split by the node that
+    owns each key and the nodes are sent their pipelines in parallel, while
+    queries read every shard and merge the ids. The number of shards must
+    never change once Pets are stored.
+    """
+
+    name = "cluster"
+    # threads that talk to the nodes in parallel, shared by every instance
+    executor = None
+    record_pattern = re.compile(r"^{}:\{{\d+\}}:(\d+)$".format(NAMESPACE))
+
+    def __init__(self, redis, stored_fields, index_fields, batch_size=1000, shards=16):
+        """Registers the Lua scripts that keep the indexes consistent"""
+        super().__init__(redis, stored_fields, index_fields, batch_size)
+        self.shards = shards
+        if ClusterStorage.executor is None:
+            ClusterStorage.executor = ThreadPoolExecutor(
+                max_workers=16, thread_name_prefix="pet-cluster"
+            )
+
+    def shard(self, pet_id):
+        """Returns the shard that a Pet is stored in"""
+        return int(pet_id) % self.shards
+
+    @staticmethod
+    def tag(key, shard):
+        """Returns the key of a shard, e.g. pet:category:dog -> pet:{3}:category:dog"""
+        return "{}:{{{}}}:{}".format(NAMESPACE, shard, key[len(NAMESPACE) + 1 :])
+
+    def tag_fields(self, fields, shard):
+        """Points the index fields of a record at the indexes of its shard"""
+        return {
+            name: self.tag(value, shard) if name.startswith("_") and value else value
+            for name, value in fields.items()
+        }
+
+    def save(self, records, must_exist=False):
+        """Writes (id, fields, if_match) records with one pipeline per node"""
+        calls = []
+        for pet_id, fields, if_match in records:
+            shard = self.shard(pet_id)
+            keys, args = save_call(
+                pet_id, self.tag_fields(fields, shard), must_exist, if_match
+            )
+            calls.append(([self.tag(key, shard) for key in keys], args))
+        return self._run(self.save_script, calls)
+
+    def delete(self, records):
+        """Deletes (id, if_match) records with one pipeline per node"""
+        calls = []
+        for pet_id, if_match in records:
+            shard = self.shard(pet_id)
+            keys, args = delete_call(pet_id, self.index_fields, if_match)
+            calls.append(([self.tag(key, shard) for key in keys], args))
+        return self._run(self.delete_script, calls)
+
+    def update(self, pet_id, fields, if_match=None):
+        """Writes some of the fields of an existing record"""
+        shard = self.shard(pet_id)
+        keys, args = update_call(
+            pet_id, self.tag_fields(fields, shard), if_match, self.stored_fields
+        )
+        keys = [self.tag(key, shard) for key in keys]
+        return self.update_script(keys=keys, args=args)
+
+    def purchase(self, pet_id, unavailable_key, if_match=None):
+        """Marks an available record as unavailable"""
+        shard = self.shard(pet_id)
+        keys, args = purchase_call(
+            pet_id, if_match, self.tag(unavailable_key, shard), self.stored_fields
+        )
+        keys = [self.tag(key, shard) for key in keys]
+        return self.purchase_script(keys=keys, args=args)
+
+    def get(self, pet_id, fields, primary=False):
+        """Returns the values of some fields of a record"""
+        key = self.tag(record_key(pet_id), self.shard(pet_id))
+        return self.redis.hmget(key, fields)
+
+    def load(self, ids, fields):
+        """Returns the values of some fields of many records"""
+        calls = [
+            ([self.tag(record_key(pet_id), self.shard(pet_id))], [fields])
+            for pet_id in ids
+        ]
+        return self.__fan_out(
+            calls, lambda keys, args, client: client.hmget(keys[0], *args)
+        )
+
+    def range(self, key, after, limit):
+        """Returns up to limit ids above after from the index in every shard"""
+        calls = [
+            ([self.tag(key, shard)], ["({}".format(after), "+inf", 0, limit])
+            for shard in range(self.shards)
+        ]
+        shards = self.__fan_out(
+            calls, lambda keys, args, client: client.zrangebyscore(keys[0], *args)
+        )
+        merged = heapq.merge(*[[int(pet_id) for pet_id in ids] for ids in shards])
+        return list(merged)[:limit]
+
+    def stored_ids(self):
+        """Generator that returns the ids of every stored record"""
+        seen = set()  # SCAN may return the same key more than once
+        for key in self.redis.scan_iter(match=record_key("*"), count=self.batch_size):
+            match = self.record_pattern.match(key)
+            if match and match.group(1) not in seen:
+                seen.add(match.group(1))
+                yield int(match.group(1))
+
+    def clocks(self):
+        """Returns the keys of the version clocks of every shard"""
+        return [self.tag(VERSION_CLOCK, shard) for shard in range(self.shards)]
+
+    def get_response(self, query):
+        """Returns the catalog version and the response cached for a query"""
+        version = sum(
+            int(clock or 0) for clock in self.redis.mget_nonatomic(self.clocks())
+        )
+        cached_version, body = self.redis.hmget(
+            RESPONSE_PREFIX + query, "version", "body"
+        )
+        if cached_version is None or int(cached_version) != version:
+            return version, None
+        return version, body
+
+    def node_pipeline(self, node):
+        """Returns a pipeline to one node, from the client if it can make them"""
+        if hasattr(self.redis, "node_pipeline"):  # one that reports its latency
+            return self.redis.node_pipeline(node)
+        return self.redis.get_redis_connection(node).pipeline(transaction=False)
+
+    def _run(self, script, calls):
+        """Runs a script for every (keys, args) call on the nodes that own them"""
+        if len(calls) == 1:
+            keys, args = calls[0]
+            return [script(keys=keys, args=args)]
+        return self.__fan_out(calls, script)
+
+    def __fan_out(self, calls, command):
+        """
+        Runs command(keys, args, client) for every (keys, args) call
+
+        The calls are grouped by the node that owns their first key, each
+        node gets one pipeline and the nodes are sent them in parallel. The
+        results are returned in the order of the calls.
+        """
+        nodes = {}
+        for position, (keys, _) in enumerate(calls):
+            node = self.redis.get_node_from_key(keys[0])
+            nodes.setdefault(node.name, (node, []))[1].append(position)
+
+        def send(node, positions):
+            pipe = self.node_pipeline(node)
+            for position in positions:
+                keys, args = calls[position]
+                command(keys=keys, args=args, client=pipe)
+            return positions, pipe.execute()
+
+        results = [None] * len(calls)
+        if len(nodes) == 1:
+            replies = [send(*group) for group in nodes.values()]
+        else:
+            replies = self.executor.map(lambda group: send(*group), nodes.values())
+        for positions, values in replies:
+            for position, value in zip(positions, values):
+                results[position] = value
+        return results
+
+
+######################################################################
+#  M E M O R Y   S T O R A G E
+######################################################################
+class MemoryStorage(object):
+    """
+    Stores the Pets in dicts in this process
+
+    Every index is a sorted list of ids in a dict keyed by the same index
+    keys that Redis uses, so queries and pages are a bisect and a slice.
+    One lock makes each operation atomic like a Lua script, so concurrent
+    purchases of the same Pet behave exactly as they do with Redis.
+    """
+
+    name = "memory"
+    # most responses of list queries that are kept at a time
+    max_responses = 256
+
+    def __init__(self, stored_fields):
+        """Constructor"""
+        self.stored_fields = stored_fields
+        self._records = {}
+        self._indexes = {}
+        self._responses = OrderedDict()
+        self._sequence = 0
+        self._clock = 0
+        self._lock = threading.RLock()
+
+    def next_ids(self, count=1):
+        """Reserves count new ids and returns the last one"""
+        with self._lock:
+            self._sequence += count
+            return self._sequence
+
+    def advance_ids(self, minimum):
+        """Makes sure that the ids handed out from now on are above minimum"""
+        with self._lock:
+            self._sequence = max(self._sequence, int(minimum))
+
+    def save(self, records, must_exist=False):
+        """
+        Writes (id, fields, if_match) records
+
+        Returns the new version of each record, 0 when it must exist but
+        does not or -1 when its version is not in if_match.
+        """
+        results = []
+        with self._lock:
+            for pet_id, fields, if_match in records:
+                pet_id = int(pet_id)
+                record = self._records.get(pet_id)
+                if must_exist and record is None:
+                    results.append(0)
+                elif not self.__version_matches(record, if_match):
+                    results.append(-1)
+                else:
+                    record = self._records.setdefault(pet_id, {})
+                    self.__write_fields(pet_id, record, fields)
+                    self.__index(ID_INDEX, pet_id)
+                    results.append(self.__next_version(record))
+        return results
+
+    def delete(self, records):
+        """
+        Deletes (id, if_match) records
+
+        Returns 1 for each record that was deleted, 0 when it was not found
+        or -1 when its version is not in if_match.
+        """
+        results = []
+        with self._lock:
+            for pet_id, if_match in records:
+                pet_id = int(pet_id)
+                record = self._records.get(pet_id)
+                if not self.__version_matches(record, if_match):
+                    results.append(-1)
+                elif record is None:
+                    results.append(0)
+                else:
+                    for field, value in record.items():
+                        if field.startswith("_") and field != "_version":
+                            self.__unindex(value, pet_id)
+                    self.__unindex(ID_INDEX, pet_id)
+                    del self._records[pet_id]
+                    self._clock += 1
+                    results.append(1)
+        return results
+
+    def update(self, pet_id, fields, if_match=None):
+        """
+        Writes some of the fields of an existing record
+
+        Returns [1, stored values], [0] when it was not found, [-2] when
+        its version is not in if_match or [-3] when it is stored packed.
+        """
+        pet_id = int(pet_id)
+        with self._lock:
+            record = self._records.get(pet_id)
+            if record is None:
+                return [0]
+            if not self.__version_matches(record, if_match):
+                return [-2]
+            if RECORD_FIELD in record:
+                return [-3]
+            self.__write_fields(pet_id, record, fields)
+            self.__next_version(record)
+            return [1, [record.get(field) for field in self.stored_fields]]
+
+    def purchase(self, pet_id, unavailable_key, if_match=None):
+        """
+        Marks an available record as unavailable
+
+        Returns [1, stored values], [0] when it was not found, [-1] when it
+        is not available, [-2] when its version is not in if_match or [-3]
+        when it is stored packed.
+        """
+        pet_id = int(pet_id)
+        with self._lock:
+            record = self._records.get(pet_id)
+            if record is None:
+                return [0]
+            if not self.__version_matches(record, if_match):
+                return [-2]
+            if RECORD_FIELD in record:
+                return [-3]
+            if "available" not in record:
+                return [0]
+            if record["available"] in UNAVAILABLE:
+                return [-1]
+            fields = {"available": "false", "_available": unavailable_key}
+            self.__write_fields(pet_id, record, fields)
+            self.__next_version(record)
+            return [1, [record.get(field) for field in self.stored_fields]]
+
+    def get(self, pet_id, fields, primary=False):
+        """Returns the values of some fields of a record"""
+        with self._lock:
+            record = self._records.get(int(pet_id), {})
+            return [record.get(field) for field in fields]
+
+    def load(self, ids, fields):
+        """Returns the values of some fields of many records"""
+        with self._lock:
+            return [self.get(pet_id, fields) for pet_id in ids]
+
+    def range(self, key, after, limit):
+        """Returns up to limit ids above after from the index at key"""
+        with self._lock:
+            ids = self._indexes.get(key, [])
+            start = bisect_right(ids, int(after))
+            return ids[start : start + limit]
+
+    def stored_ids(self):
+        """Returns the ids of every stored record"""
+        with self._lock:
+            return list(self._records)
+
+    def remove_all(self):
+        """Removes every record, index, id counter and cached response"""
+        with self._lock:
+            self._records.clear()
+            self._indexes.clear()
+            self._responses.clear()
+            self._sequence = 0
+
+    def get_response(self, query):
+        """Returns the catalog version and the response cached for a query"""
+        with self._lock:
+            cached_version, body, expires = self._responses.get(query, (0, None, 0))
+            if cached_version != self._clock or expires < time.monotonic():
+                self._responses.pop(query, None)
+                return self._clock, None
+            self._responses.move_to_end(query)
+            return self._clock, body
+
+    def set_response(self, query, version, body, ttl):
+        """
+        Caches the response of a query computed at a catalog version
+
+        Only responses of the current catalog are kept, and only the most
+        recently used ones once there are max_responses of them, which is
+        what the clock and EXPIRE do for Redis.
+        """
+        with self._lock:
+            if version != self._clock:
+                return
+            if len(self._responses) >= self.max_responses:
+                now = time.monotonic()
+                stale = [
+                    key
+                    for key, (cached_version, _, expires) in self._responses.items()
+                    if cached_version != self._clock or expires < now
+                ]
+                for key in stale:
+                    del self._responses[key]
+            self._responses[query] = (version, body, time.monotonic() + ttl)
+            self._responses.move_to_end(query)
+            while len(self._responses) > self.max_responses:
+                self._responses.popitem(last=False)
+
+    def __write_fields(self, pet_id, record, fields):
+        """Writes fields and moves the record between the indexes they name"""
+        for field, value in fields.items():
+            if field.startswith("_"):
+                old = record.get(field)
+                if old and old != value:
+                    self.__unindex(old, pet_id)
+                if value != "":
+                    self.__index(value, pet_id)
+            elif value == "":
+                record.pop(field, None)
+                continue
+            record[field] = value
+
+    def __next_version(self, record):
+        """Stamps a record with the next version of the clock"""
+        self._clock += 1
+        record["_version"] = str(self._clock)
+        return self._clock
+
+    def __index(self, key, pet_id):
+        """Adds an id to the sorted list of an index"""
+        ids = self._indexes.setdefault(key, [])
+        position = bisect_left(ids, pet_id)
+        if position == len(ids) or ids[position] != pet_id:
+            ids.insert(position, pet_id)
+
+    def __unindex(self, key, pet_id):
+        """Removes an id from the sorted list of an index"""
+        ids = self._indexes.get(key)
+        if not ids:
+            return
+        position = bisect_left(ids, pet_id)
+        if position < len(ids) and ids[position] == pet_id:
+            del ids[position]
+            if not ids:
+                del self._indexes[key]
+
+    @staticmethod
+    def __version_matches(record, if_match):
+        """Checks the version of a record against the versions in if_match"""
+        if if_match is None:
+            return True
+        current = record.get("_version", "0") if record else "0"
+        return current in [str(version) for version in if_match]
@@ -0,0 +1,178 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Async Pet API Service Test Suite
+
+These tests need redis>=4.2 for redis.asyncio and starlette with httpx.
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+import json
+import unittest
+import logging
+from service import status
+from service.routes import initialize_logging, init_db, data_reset, data_load
+
+try:
+    from starlette.testclient import TestClient
+    from service.asgi import app
+    from service.async_models import AsyncPet
+except ImportError:  # redis.asyncio, starlette or httpx are missing
+    app = None
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+@unittest.skipIf(app is None, "the async service needs redis>=4.2 and starlette")
+class TestAsyncPetService(unittest.TestCase):
+    """Async Pet Service tests"""
+
+    def setUp(self):
+        initialize_logging(logging.CRITICAL)
+        init_db()
+        data_reset()
+        data_load({"name": "fido", "category": "dog", "available": True})
+        data_load({"name": "kitty", "category": "cat", "available": True})
+        self.client = TestClient(app)
+        self.client.__enter__()  # runs the lifespan that connects to Redis
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+    def test_index(self):
+        """Test the index page"""
+        resp = self.client.get("/")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn(b"Pet Demo REST API Service", resp.content)
+
+    def test_list_and_query_pets(self):
+        """List and filter the Pets"""
+        resp = self.client.get("/pets")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([pet["name"] for pet in resp.json()], ["fido", "kitty"])
+        resp = self.client.get("/pets", headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.client.get("/pets", params={"category": "CAT"})
+        self.assertEqual([pet["name"] for pet in resp.json()], ["kitty"])
+        resp = self.client.get("/pets", params={"limit": 1})
+        self.assertEqual([pet["name"] for pet in resp.json()], ["fido"])
+        resp = self.client.get(resp.links["next"]["url"])
+        self.assertEqual([pet["name"] for pet in resp.json()], ["kitty"])
+        self.assertNotIn("next", resp.links)
+        resp = self.client.get("/pets", params={"limit": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get("/pets", params={"cursor": "!!"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_pets(self):
+        """Stream the Pets as JSON and NDJSON"""
+        resp = self.client.get("/pets", params={"stream": "true"})
+        self.assertEqual(len(resp.json()), 2)
+        resp = self.client.get("/pets", headers={"Accept": "application/x-ndjson"})
+        lines = resp.text.splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines], [1, 2])
+
+    def test_get_pet(self):
+        """Get a single Pet"""
+        resp = self.client.get("/pets/2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json()["name"], "kitty")
+        etag = resp.headers["ETag"]
+        resp = self.client.get("/pets/2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.client.get("/pets/0")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(resp.json()["error"], "Not Found")
+        self.assertIn("was not found", resp.json()["message"])
+
+    def test_create_pet(self):
+        """Create new Pets from JSON and form data"""
+        new_pet = {"name": "sammy", "category": "snake", "available": True}
+        resp = self.client.post("/pets", json=new_pet)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(resp.headers["Location"].endswith("/pets/3"))
+        self.assertEqual(resp.json()["name"], "sammy")
+        resp = self.client.post(
+            "/pets", data={"name": "tom", "category": "cat", "available": "true"}
+        )
+        self.assertEqual(resp.json()["available"], True)
+        resp = self.client.post("/pets", json={"category": "dog"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post("/pets", content="name=fido")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.client.patch("/pets")
+        self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        self.assertEqual(resp.json()["error"], "Method not Allowed")
+
+    def test_update_pets(self):
+        """Update and patch a Pet with conditional requests"""
+        etag = self.client.get("/pets/2").headers["ETag"]
+        new_kitty = {"name": "kitty", "category": "tabby", "available": True}
+        resp = self.client.put("/pets/2", json=new_kitty, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json()["category"], "tabby")
+        resp = self.client.put("/pets/2", json=new_kitty, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.put("/pets/0", json=new_kitty)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.patch("/pets/2", json={"available": False})
+        self.assertEqual(resp.json()["name"], "kitty")
+        self.assertEqual(resp.json()["available"], False)
+        resp = self.client.patch("/pets/2", json={"color": "red"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for body in [{"pet_id": 3}, {"if_match": ["1"]}, {"available": "false"}]:
+            resp = self.client.patch("/pets/2", json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_pet(self):
+        """Delete a Pet"""
+        resp = self.client.delete("/pets/2", headers={"If-Match": '"0"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.delete("/pets/2")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(resp.content), 0)
+        resp = self.client.get("/pets/2")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_batches(self):
+        """Create, update and delete batches of Pets"""
+        pets = [{"name": "rex", "category": "dog", "available": True}, {"name": None}]
+        resp = self.client.post("/pets/batch", json=pets)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([item["status"] for item in resp.json()], [201, 400])
+        pets = [
+            {"id": 3, "name": "rex", "category": "k9", "available": True},
+            {"id": 7, "name": "ghost", "category": "cat", "available": True},
+        ]
+        resp = self.client.put("/pets/batch", json=pets)
+        self.assertEqual([item["status"] for item in resp.json()], [200, 404])
+        resp = self.client.request("DELETE", "/pets/batch", json=[1, 3])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get("/pets")
+        self.assertEqual([pet["name"] for pet in resp.json()], ["kitty"])
+
+    def test_purchase_a_pet(self):
+        """Purchase a Pet once"""
+        resp = self.client.put("/pets/2/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json()["available"], False)
+        resp = self.client.put("/pets/2/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.put("/pets/0/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        pets = self.client.portal.call(AsyncPet.find_by_availability, False)
+        self.assertEqual([pet.name for pet in pets], ["kitty"])
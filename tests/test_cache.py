@@ -0,0 +1,92 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+LRU Cache Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+import unittest
+from unittest.mock import patch
+from service.cache import LRUCache
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """Test Cases for the LRU Cache"""
+
+    def test_get_and_set(self):
+        """Cache a value and count hits and misses"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(
+            cache.stats(), {"size": 1, "maxsize": 2, "hits": 1, "misses": 1}
+        )
+
+    def test_evict_least_recently_used(self):
+        """Evict the least recently used value when full"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_expire_entries(self):
+        """Expire values once their time to live has passed"""
+        cache = LRUCache(maxsize=2, ttl=5)
+        with patch("service.cache.time.monotonic", return_value=100):
+            cache.set("a", 1)
+        with patch("service.cache.time.monotonic", return_value=106):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_invalidate_and_clear(self):
+        """Remove one value or all of them"""
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.invalidate("a")
+        cache.invalidate("missing")
+        self.assertIsNone(cache.get("a"))
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+
+    def test_skip_values_read_before_an_invalidation(self):
+        """Do not cache a value that was read before an invalidation"""
+        cache = LRUCache()
+        generation = cache.generation
+        cache.invalidate("a")
+        cache.set("a", 1, generation)
+        self.assertIsNone(cache.get("a"))
+        generation = cache.generation
+        cache.clear()
+        cache.set("a", 1, generation)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1, cache.generation)
+        self.assertEqual(cache.get("a"), 1)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Redis Cluster Test Suite
+
+The tests against a cluster only run when REDIS_CLUSTER_NODES names some of
+its nodes, e.g. REDIS_CLUSTER_NODES=127.0.0.1:7000
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import os
+import json
+import unittest
+from unittest.mock import patch
+from service.models import Pet, DataValidationError, VersionConflictError
+from service.storage import ClusterStorage
+
+try:
+    from redis.cluster import RedisCluster
+except ImportError:
+    RedisCluster = None
+
+REDIS_CLUSTER_NODES = os.getenv("REDIS_CLUSTER_NODES")
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestClusterConfiguration(unittest.TestCase):
+    """Test Cases for configuring a Redis Cluster"""
+
+    def test_tagged_keys(self):
+        """Keep every key of a shard in the same slot"""
+        self.assertEqual(ClusterStorage.tag("pet:17", 3), "pet:{3}:17")
+        self.assertEqual(ClusterStorage.tag("pet:ids", 3), "pet:{3}:ids")
+        self.assertEqual(
+            ClusterStorage.tag("pet:category:dog", 0), "pet:{0}:category:dog"
+        )
+        self.assertTrue(ClusterStorage.record_pattern.match("pet:{3}:17"))
+        self.assertFalse(ClusterStorage.record_pattern.match("pet:{3}:name:17"))
+
+    @patch.dict(os.environ, {"REDIS_CLUSTER_NODES": "10.0.0.1:7000, redis-2:7001"})
+    def test_cluster_nodes_from_environment(self):
+        """Find the cluster nodes in REDIS_CLUSTER_NODES"""
+        nodes, password = Pet.cluster_credentials()
+        self.assertEqual(nodes, [("10.0.0.1", 7000), ("redis-2", 7001)])
+        self.assertIsNone(password)
+
+    def test_cluster_nodes_from_vcap_services(self):
+        """Find the cluster nodes in VCAP_SERVICES"""
+        credentials = {
+            "cluster": True,
+            "hostname": "redis-1",
+            "port": "7000",
+            "password": "secret",
+            "nodes": [
+                {"hostname": "redis-1", "port": 7000},
+                {"hostname": "redis-2", "port": "7000"},
+            ],
+        }
+        vcap = json.dumps({"rediscloud": [{"credentials": credentials}]})
+        with patch.dict(os.environ, {"VCAP_SERVICES": vcap}):
+            nodes, password = Pet.cluster_credentials()
+        self.assertEqual(nodes, [("redis-1", 7000), ("redis-2", 7000)])
+        self.assertEqual(password, "secret")
+        del credentials["nodes"]
+        vcap = json.dumps({"rediscloud": [{"credentials": credentials}]})
+        with patch.dict(os.environ, {"VCAP_SERVICES": vcap}):
+            self.assertEqual(Pet.cluster_credentials()[0], [("redis-1", 7000)])
+
+    def test_single_node(self):
+        """Use a single Redis unless a cluster is configured"""
+        credentials = {"hostname": "redis", "port": 6379, "password": ""}
+        vcap = json.dumps({"rediscloud": [{"credentials": credentials}]})
+        with patch.dict(os.environ, {"VCAP_SERVICES": vcap}):
+            self.assertIsNone(Pet.cluster_credentials())
+        with patch.dict(os.environ, {"REDIS_CLUSTER_NODES": ""}):
+            self.assertIsNone(Pet.cluster_credentials())
+
+
+@unittest.skipUnless(
+    RedisCluster and REDIS_CLUSTER_NODES, "needs redis 4.1+ and REDIS_CLUSTER_NODES"
+)
+class TestClusterStorage(unittest.TestCase):
+    """Test Cases for the Pet Model stored in a Redis Cluster"""
+
+    @classmethod
+    def setUpClass(cls):
+        """initialize the database"""
+        Pet.init_db()
+
+    def setUp(self):
+        """Start in a good known state"""
+        Pet.remove_all()
+
+    def test_init_db(self):
+        """Connect to the cluster"""
+        self.assertIsInstance(Pet.redis, RedisCluster)
+        self.assertIsInstance(Pet.storage, ClusterStorage)
+        stats = Pet.pool_stats()
+        self.assertEqual(stats["created"], stats["in_use"] + stats["idle"])
+
+    def test_pets_are_sharded(self):
+        """Spread the Pets over the nodes of the cluster"""
+        Pet.create_many([Pet(0, "pet{}".format(i), "dog") for i in range(32)])
+        nodes = {
+            Pet.redis.get_node_from_key(ClusterStorage.tag(Pet.key(pet_id), shard)).name
+            for pet_id, shard in [(i, i % Pet.storage.shards) for i in range(1, 33)]
+        }
+        self.assertEqual(len(nodes), len(Pet.redis.get_primaries()))
+        self.assertEqual(sorted(Pet.storage.stored_ids()), list(range(1, 33)))
+
+    def test_commands_are_observed(self):
+        """Report the commands and pipelines sent to the cluster"""
+        commands = []
+        observer, Pet.command_observer = Pet.command_observer, (
+            lambda command, duration, failed: commands.append(command)
+        )
+        try:
+            Pet(0, "fido", "dog").save()
+            self.assertIn("EVALSHA", commands)
+            # one pipeline per node
+            Pet.create_many([Pet(0, "pet{}".format(i), "dog") for i in range(10)])
+            pipelines = commands.count("PIPELINE")
+            self.assertEqual(pipelines, len(Pet.redis.get_primaries()))
+            Pet.set_response("all", 1, "[]", 60)
+            self.assertEqual(commands.count("PIPELINE"), pipelines + 1)
+        finally:
+            Pet.command_observer = observer
+
+    def test_queries_merge_the_shards(self):
+        """List, find and page through Pets from every shard in id order"""
+        pets = [Pet(0, "pet{}".format(i), "dog" if i % 2 else "cat") for i in range(50)]
+        Pet.create_many(pets)
+        self.assertEqual([pet.id for pet in Pet.all(batch_size=7)], list(range(1, 51)))
+        dogs = [pet.id for pet in Pet.find_by_category("DOG")]
+        self.assertEqual(dogs, list(range(2, 51, 2)))
+        self.assertEqual([pet.id for pet in Pet.find_by_name("pet7")], [8])
+        page, cursor = Pet.paginate(10, None, "category", "cat")
+        self.assertEqual([pet.id for pet in page], list(range(1, 20, 2)))
+        page, cursor = Pet.paginate(10, cursor, "category", "cat")
+        self.assertEqual([pet.id for pet in page], list(range(21, 40, 2)))
+        self.assertEqual(len(list(Pet.iter_json())), 50)
+
+    def test_writes(self):
+        """Save, update, purchase and delete Pets atomically in their shard"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        first = pet.version
+        self.assertRaises(VersionConflictError, Pet.purchase, 1, if_match=[0])
+        pet = Pet.update_fields(1, if_match=[first], category="k9")
+        self.assertEqual([pet.id for pet in Pet.find_by_category("k9")], [1])
+        self.assertEqual(Pet.find_by_category("dog"), [])
+        Pet.purchase(1)
+        self.assertRaises(DataValidationError, Pet.purchase, 1)
+        self.assertEqual(Pet.find_by_availability(True), [])
+        self.assertEqual(Pet.save_many([Pet(1, "rex"), Pet(2, "ghost")]), [True, False])
+        self.assertEqual(Pet.delete_many([1, 2]), [True, False])
+        self.assertEqual(Pet.all(), [])
+        self.assertEqual(Pet.find_by_name("rex"), [])
+
+    def test_response_cache(self):
+        """Change the catalog version when any shard changes"""
+        version, body = Pet.get_response("all")
+        Pet.set_response("all", version, "[]", 60)
+        self.assertEqual(Pet.get_response("all"), (version, "[]"))
+        Pet(0, "fido", "dog").save()
+        Pet(0, "kitty", "cat").save()
+        self.assertEqual(Pet.get_response("all"), (version + 2, None))
+
+    def test_remove_all_and_reindex(self):
+        """Remove and reindex the Pets on every node"""
+        Pet.create_many([Pet(0, "pet{}".format(i), "dog") for i in range(20)])
+        self.assertEqual(Pet.reindex(), 20)
+        self.assertEqual(Pet.migrate(), 0)
+        version = Pet.get_response("all")[0]
+        Pet.remove_all()
+        # only the version clocks are kept
+        self.assertLessEqual(
+            set(Pet.redis.scan_iter(match="pet:*")), set(Pet.storage.clocks())
+        )
+        self.assertEqual(Pet.get_response("all")[0], version)
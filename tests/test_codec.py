@@ -0,0 +1,66 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON Codec Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+import unittest
+from service import codec
+
+PET = {"id": 1, "name": "fido é/", "category": None, "available": True}
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCodec(unittest.TestCase):
+    """Test Cases for the JSON codec"""
+
+    def setUp(self):
+        self.name = codec.name
+
+    def tearDown(self):
+        codec.use(self.name)
+
+    def test_codecs_agree(self):
+        """Every codec reads what the others write"""
+        for writer in codec.CODECS:
+            codec.use(writer)
+            data = codec.dumpb([PET])
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(codec.dumps(PET), data.decode("utf-8")[1:-1])
+            for reader in codec.CODECS:
+                codec.use(reader)
+                self.assertEqual(codec.loads(data), [PET])
+                self.assertEqual(codec.loads(data.decode("utf-8")), [PET])
+
+    def test_huge_integers(self):
+        """Encode integers that do not fit in 64 bits with every codec"""
+        for name in codec.CODECS:
+            codec.use(name)
+            self.assertEqual(codec.dumpb([10**20]), b"[100000000000000000000]")
+
+    def test_bad_json(self):
+        """Invalid JSON raises a ValueError with every codec"""
+        for name in codec.CODECS:
+            codec.use(name)
+            self.assertRaises(ValueError, codec.loads, "{bad")
+
+    def test_unknown_codec(self):
+        """Pick a codec that is not installed"""
+        self.assertRaises(ValueError, codec.use, "simplejson")
+        self.assertEqual(codec.name, self.name)
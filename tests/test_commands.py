@@ -0,0 +1,197 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pet CLI Command Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+import os
+import json
+import tempfile
+import unittest
+from service import app, record_codec
+from service.models import Pet
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPetCommands(unittest.TestCase):
+    """Pet CLI Command tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """initialize the database"""
+        Pet.init_db()
+
+    def setUp(self):
+        self.runner = app.test_cli_runner()
+        Pet.remove_all()
+
+    def test_migrate(self):
+        """Migrate Pets stored as JSON strings to hashes"""
+        Pet.redis.set("index", 2)
+        for pet_id, name, category in [(1, "fido", "dog"), (2, "kitty", "cat")]:
+            pet = {"id": pet_id, "name": name, "category": category, "available": True}
+            Pet.redis.set(pet_id, json.dumps(pet))
+        result = self.runner.invoke(args=["pets", "migrate"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Migrated 2 Pets", result.output)
+        self.assertIsNone(Pet.redis.get(1))
+        self.assertIsNone(Pet.redis.get("index"))
+        self.assertEqual(Pet.find(2).name, "kitty")
+        self.assertEqual(len(Pet.find_by_category("dog")), 1)
+        # new Pets carry on from the old id counter
+        pet = Pet(0, "sammy", "snake")
+        pet.save()
+        self.assertEqual(pet.id, 3)
+
+    def test_migrate_legacy_values(self):
+        """Migrate Pets whose available value is not a boolean"""
+        for pet_id, available in [(1, "true"), (2, "0"), (3, None)]:
+            pet = {"id": pet_id, "name": "fido", "category": "dog"}
+            pet["available"] = available
+            Pet.redis.set(pet_id, json.dumps(pet))
+        Pet.redis.set(4, json.dumps({"id": 4, "name": "kitty"}))
+        result = self.runner.invoke(args=["pets", "migrate"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Migrated 3 Pets", result.output)
+        self.assertIs(Pet.find(1).available, True)
+        self.assertIs(Pet.find(2).available, False)
+        self.assertIs(Pet.find(3).available, False)
+        self.assertEqual([pet.id for pet in Pet.find_by_availability(True)], [1])
+        # a Pet that can not be read is left for someone to look at
+        self.assertIsNone(Pet.find(4))
+        self.assertIsNotNone(Pet.redis.get(4))
+        Pet.redis.delete(4)
+
+    def test_reindex(self):
+        """Rebuild the indexes from the command line"""
+        Pet(0, "fido", "dog").save()
+        Pet.redis.delete("pet:ids")
+        result = self.runner.invoke(args=["pets", "reindex"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Reindexed 1 Pets", result.output)
+        self.assertEqual(len(Pet.all()), 1)
+
+    def test_reencode(self):
+        """Rewrite the Pets in the current record format from the command line"""
+        name = record_codec.name
+        record_codec.use("json")
+        try:
+            Pet(0, "fido", "dog").save()
+            record_codec.use("compact")
+            result = self.runner.invoke(args=["pets", "reencode", "--pause", "0"])
+        finally:
+            record_codec.use(name)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Rewrote 1 Pets as compact records", result.output)
+        self.assertIsNone(Pet.redis.hget(Pet.key(1), "name"))
+        self.assertEqual(Pet.find(1).name, "fido")
+
+    def test_import_ndjson(self):
+        """Import Pets from an NDJSON file"""
+        lines = [
+            json.dumps({"name": "fido", "category": "dog", "available": True}),
+            "not json",
+            json.dumps({"name": "kitty", "category": "cat", "available": False}),
+            json.dumps({"category": "bird", "available": True}),
+        ]
+        result = self.runner.invoke(
+            args=["pets", "import", "-", "--chunk-size", "1"],
+            input="\n".join(lines) + "\n",
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Imported 2 Pets with 2 errors", result.output)
+        self.assertIn("Skipping line 2", result.output)
+        self.assertEqual([pet.name for pet in Pet.all()], ["fido", "kitty"])
+        self.assertEqual(len(Pet.find_by_availability(False)), 1)
+
+    def test_import_csv_with_ids(self):
+        """Restore Pets from a CSV file keeping their ids"""
+        Pet(0, "fido", "dog").save()
+        rows = "id,name,category,available\n1,rex,k9,true\n42,kitty,,false\n"
+        result = self.runner.invoke(
+            args=["pets", "import", "-", "--format", "csv", "--keep-ids"],
+            input=rows,
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Imported 2 Pets with 0 errors", result.output)
+        self.assertEqual(Pet.find(1).name, "rex")
+        kitty = Pet.find(42)
+        self.assertIsNone(kitty.category)
+        self.assertEqual(kitty.available, False)
+        # new Pets carry on after the restored ids
+        pet = Pet(0, "sammy", "snake")
+        pet.save()
+        self.assertEqual(pet.id, 43)
+
+    def test_import_with_bad_ids(self):
+        """Skip the lines without a usable id when keeping the ids"""
+        lines = [
+            json.dumps({"id": 7, "name": "fido", "category": "dog", "available": True}),
+            json.dumps({"name": "rex", "category": "dog", "available": True}),
+            json.dumps({"id": 0, "name": "boo", "category": "cat", "available": True}),
+            json.dumps({"id": 8, "name": "tom", "category": "cat", "available": True}),
+        ]
+        result = self.runner.invoke(
+            args=["pets", "import", "-", "--keep-ids", "--chunk-size", "1"],
+            input="\n".join(lines) + "\n",
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Imported 2 Pets with 2 errors", result.output)
+        self.assertIn("Skipping line 2", result.output)
+        self.assertIn("Skipping line 3", result.output)
+        self.assertEqual([pet.id for pet in Pet.all()], [7, 8])
+
+    def test_export_and_import_round_trip(self):
+        """Export the Pets and import them back"""
+        for i in range(5):
+            Pet(0, "pet{}".format(i), "dog", i % 2 == 0).save()
+        for file_format in ["ndjson", "csv"]:
+            handle, path = tempfile.mkstemp()
+            os.close(handle)
+            try:
+                result = self.runner.invoke(
+                    args=[
+                        "pets",
+                        "export",
+                        "--output",
+                        path,
+                        "--format",
+                        file_format,
+                        "--chunk-size",
+                        "2",
+                    ]
+                )
+                self.assertEqual(result.exit_code, 0)
+                self.assertIn("Exported 5 Pets", result.output)
+                expected = [pet.serialize() for pet in Pet.all()]
+                Pet.remove_all()
+                result = self.runner.invoke(
+                    args=["pets", "import", path, "--format", file_format, "--keep-ids"]
+                )
+                self.assertEqual(result.exit_code, 0)
+                self.assertEqual([pet.serialize() for pet in Pet.all()], expected)
+            finally:
+                os.remove(path)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
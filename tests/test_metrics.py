@@ -0,0 +1,101 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Metrics Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+import os
+import unittest
+import logging
+import tempfile
+from unittest.mock import patch
+from redis.exceptions import ResponseError
+from service import app, metrics, status
+from service.models import Pet
+from service.routes import initialize_logging, init_db, data_reset
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+@unittest.skipIf(metrics.prometheus_client is None, "prometheus_client is missing")
+class TestMetrics(unittest.TestCase):
+    """Prometheus metrics tests"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        initialize_logging(logging.CRITICAL)
+        init_db()
+        data_reset()
+
+    def get_metrics(self):
+        """Returns the text of the metrics page"""
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        return resp.get_data(as_text=True)
+
+    def test_request_metrics(self):
+        """Requests are counted and timed per route and status"""
+        self.app.get("/pets/1")
+        self.app.get("/pets/1")
+        self.app.get("/nowhere")
+        text = self.get_metrics()
+        self.assertIn(
+            'http_requests_total{method="GET",route="/pets/<int:pet_id>",status="404"}'
+            " 2.0",
+            text,
+        )
+        self.assertIn(
+            'http_request_duration_seconds_count{method="GET",'
+            'route="/pets/<int:pet_id>",status="404"} 2.0',
+            text,
+        )
+        self.assertIn('route="unmatched",status="404"', text)
+        # the request for the metrics is still in progress
+        self.assertIn(
+            'http_requests_in_progress{method="GET",route="/metrics"} 1.0', text
+        )
+
+    def test_redis_metrics(self):
+        """Redis commands sent by the model are timed"""
+        Pet(0, "fido", "dog").save()
+        self.app.get("/pets")
+        with patch("redis.client.Redis.execute_command", side_effect=ResponseError):
+            self.assertRaises(ResponseError, Pet.redis.get, "pet:seq")
+        text = self.get_metrics()
+        self.assertIn('redis_command_duration_seconds_count{command="EVALSHA"}', text)
+        self.assertIn('redis_command_duration_seconds_count{command="PIPELINE"}', text)
+        self.assertIn('redis_command_errors_total{command="GET"}', text)
+        self.assertIn('redis_pool_connections{state="max_connections"}', text)
+
+    def test_pool_usage_is_read_when_scraped(self):
+        """The connection pools are only read for the metrics page"""
+        with patch.object(Pet, "pool_stats", wraps=Pet.pool_stats) as pool_stats:
+            self.app.get("/")
+            pool_stats.assert_not_called()
+            text = self.get_metrics()
+            pool_stats.assert_called_once_with()
+        self.assertIn('redis_pool_connections{state="created"}', text)
+
+    @patch.dict("os.environ", {"PROMETHEUS_MULTIPROC_DIR": ""})
+    def test_pool_usage_of_the_worker(self):
+        """Report the pools of the worker that serves the scrape"""
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+            text = self.get_metrics()
+        self.assertIn('redis_pool_connections{state="max_connections"}', text)
@@ -21,10 +21,12 @@ nosetests -v --with-spec --spec-color
 
 import os
 import json
+import time
 import unittest
+import threading
 from unittest.mock import patch
 from redis import Redis, ConnectionError
-from service.models import Pet, DataValidationError
+from service.models import Pet, DataValidationError, VersionConflictError
 
 REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
@@ -77,6 +79,67 @@ class TestPets(unittest.TestCase):
         self.assertEqual(pets[0].category, "dog")
         self.assertEqual(pets[0].available, True)
 
+    def test_add_a_pet_as_a_hash(self):
+        """Store a Pet as a hash with one field per attribute"""
+        Pet(0, "fido", "dog", True).save()
+        self.assertEqual(Pet.redis.type(Pet.key(1)), "hash")
+        self.assertEqual(Pet.redis.hget(Pet.key(1), "available"), "true")
+        self.assertEqual(Pet.redis.zrange("pet:ids", 0, -1), ["1"])
+
+    def test_create_many_pets(self):
+        """Create many Pets in one go"""
+        Pet(0, "fido", "dog").save()
+        pets = [Pet(0, "pet{}".format(i), "cat") for i in range(5)]
+        Pet.batch_size, batch_size = 2, Pet.batch_size
+        try:
+            Pet.create_many(pets)
+        finally:
+            Pet.batch_size = batch_size
+        self.assertEqual([pet.id for pet in pets], [2, 3, 4, 5, 6])
+        self.assertEqual(len(Pet.find_by_category("cat")), 5)
+        self.assertEqual(Pet.find(6).name, "pet4")
+        self.assertEqual(Pet.create_many([]), [])
+        self.assertRaises(DataValidationError, Pet.create_many, [Pet(0, None)])
+
+    def test_update_fields(self):
+        """Update some of the fields of a Pet"""
+        Pet(0, "fido", "dog", True).save()
+        pet = Pet.update_fields(1, category="k9", available=False)
+        self.assertEqual(pet.name, "fido")
+        self.assertEqual(pet.category, "k9")
+        self.assertEqual(pet.available, False)
+        self.assertEqual(Pet.find(1).category, "k9")
+        self.assertEqual(Pet.find_by_category("dog"), [])
+        self.assertEqual(len(Pet.find_by_availability(False)), 1)
+        self.assertEqual(Pet.update_fields(1).name, "fido")
+        self.assertIsNone(Pet.update_fields(5, name="ghost"))
+        self.assertIsNone(Pet.find(5))
+
+    def test_update_fields_with_bad_data(self):
+        """Update fields that are unknown or required"""
+        Pet(0, "fido", "dog").save()
+        self.assertRaises(DataValidationError, Pet.update_fields, 1, color="red")
+        self.assertRaises(DataValidationError, Pet.update_fields, 1, name=None)
+
+    def test_save_many_pets(self):
+        """Update many Pets in one go"""
+        Pet(0, "fido", "dog").save()
+        Pet(0, "kitty", "cat").save()
+        saved = Pet.save_many([Pet(1, "rex", "k9"), Pet(5, "ghost", "cat")])
+        self.assertEqual(saved, [True, False])
+        self.assertEqual(Pet.find(1).name, "rex")
+        self.assertIsNone(Pet.find(5))
+        self.assertEqual(Pet.find_by_category("dog"), [])
+        self.assertEqual(len(Pet.all()), 2)
+
+    def test_delete_many_pets(self):
+        """Delete many Pets in one go"""
+        Pet(0, "fido", "dog").save()
+        Pet(0, "kitty", "cat").save()
+        self.assertEqual(Pet.delete_many([1, 5, 2]), [True, False, True])
+        self.assertEqual(Pet.all(), [])
+        self.assertEqual(Pet.find_by_name("kitty"), [])
+
     def test_update_a_pet(self):
         """Update a Pet"""
         pet = Pet(0, "fido", "dog", True)
@@ -93,6 +156,31 @@ class TestPets(unittest.TestCase):
         self.assertEqual(pets[0].category, "k9")
         self.assertEqual(pets[0].name, "fido")
 
+    def test_versions(self):
+        """Every write of a Pet gives it a new version"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        first = pet.version
+        self.assertTrue(first > 0)
+        self.assertEqual(Pet.find(1).version, first)
+        pet.category = "k9"
+        pet.save(if_match=[first])
+        self.assertTrue(pet.version > first)
+        self.assertEqual(Pet.find(1).version, pet.version)
+        self.assertEqual(Pet.all()[0].version, pet.version)
+        self.assertRaises(VersionConflictError, pet.save, if_match=[first])
+        pet = Pet.update_fields(1, if_match=[pet.version], category="hound")
+        self.assertRaises(VersionConflictError, Pet.purchase, 1, if_match=[first])
+        self.assertRaises(
+            VersionConflictError, Pet.update_fields, 1, if_match=[first], name="x"
+        )
+        pet = Pet.purchase(1, if_match=[first, pet.version])
+        self.assertEqual(pet.available, False)
+        self.assertRaises(VersionConflictError, pet.delete, if_match=[first])
+        self.assertEqual(Pet.find(1).category, "hound")
+        pet.delete(if_match=[pet.version])
+        self.assertIsNone(Pet.find(1))
+
     def test_delete_a_pet(self):
         """Delete a Pet"""
         pet = Pet(0, "fido", "dog")
@@ -102,6 +190,40 @@ class TestPets(unittest.TestCase):
         pet.delete()
         self.assertEqual(len(Pet.all()), 0)
 
+    def test_all_in_batches(self):
+        """List all Pets a batch at a time"""
+        for i in range(7):
+            Pet(0, "pet{}".format(i), "dog").save()
+        pets = Pet.all(batch_size=3)
+        self.assertEqual(len(pets), 7)
+        self.assertEqual(sorted(pet.id for pet in pets), list(range(1, 8)))
+        self.assertEqual(len(list(Pet.iter_all(batch_size=1))), 7)
+
+    def test_remove_all_is_scoped(self):
+        """Remove all Pets without touching other keys"""
+        for i in range(5):
+            Pet(0, "pet{}".format(i), "dog").save()
+        Pet.redis.set("other:service", "keep me")
+        Pet.batch_size, batch_size = 2, Pet.batch_size
+        try:
+            Pet.remove_all()
+        finally:
+            Pet.batch_size = batch_size
+        self.assertEqual(Pet.all(), [])
+        self.assertEqual(Pet.redis.keys("pet:*"), ["pet:version"])
+        self.assertEqual(Pet.redis.get("other:service"), "keep me")
+        Pet.redis.delete("other:service")
+
+    def test_versions_survive_remove_all(self):
+        """Never hand out a version twice when all Pets are removed"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        Pet.remove_all()
+        new_pet = Pet(0, "rex", "dog")
+        new_pet.save()
+        self.assertEqual(new_pet.id, 1)
+        self.assertGreater(new_pet.version, pet.version)
+
     def test_serialize_a_pet(self):
         """Serialize a Pet"""
         pet = Pet(0, "fido", "dog")
@@ -191,6 +313,208 @@ class TestPets(unittest.TestCase):
         self.assertEqual(len(pets), 1)
         self.assertEqual(pets[0].name, "kitty")
 
+    def test_indexes_follow_updates(self):
+        """Keep the indexes in step with updates and deletes"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        pet.category = "k9"
+        pet.save()
+        self.assertEqual(Pet.find_by_category("dog"), [])
+        self.assertEqual(len(Pet.find_by_category("k9")), 1)
+        pet.delete()
+        self.assertEqual(Pet.find_by_category("k9"), [])
+        self.assertEqual(Pet.find_by_name("fido"), [])
+
+    def test_find_by_availability_string(self):
+        """Find a Pet by Availability passed as a query string"""
+        Pet(0, "fido", "dog", False).save()
+        Pet(0, "kitty", "cat", True).save()
+        pets = Pet.find_by_availability("true")
+        self.assertEqual(len(pets), 1)
+        self.assertEqual(pets[0].name, "kitty")
+
+    def test_reindex(self):
+        """Rebuild the indexes from stored Pets"""
+        Pet(0, "fido", "dog").save()
+        Pet.redis.delete(Pet.index_key("category", "dog"))
+        self.assertEqual(Pet.find_by_category("dog"), [])
+        self.assertEqual(Pet.reindex(), 1)
+        self.assertEqual(len(Pet.find_by_category("dog")), 1)
+
+    def test_purchase_a_pet(self):
+        """Purchase a Pet"""
+        Pet(0, "fido", "dog", True).save()
+        pet = Pet.purchase(1)
+        self.assertEqual(pet.id, 1)
+        self.assertEqual(pet.available, False)
+        self.assertEqual(Pet.find(1).available, False)
+        self.assertEqual(Pet.find_by_availability(True), [])
+        self.assertEqual(len(Pet.find_by_availability(False)), 1)
+        self.assertRaises(DataValidationError, Pet.purchase, 1)
+
+    def test_purchase_is_atomic(self):
+        """Purchase the same Pet from many buyers at once"""
+        Pet(0, "fido", "dog", True).save()
+        results = []
+
+        def buy():
+            try:
+                results.append(Pet.purchase(1))
+            except DataValidationError:
+                results.append(None)
+
+        buyers = [threading.Thread(target=buy) for _ in range(10)]
+        for buyer in buyers:
+            buyer.start()
+        for buyer in buyers:
+            buyer.join()
+        self.assertEqual(len([pet for pet in results if pet]), 1)
+
+    def test_purchase_not_found(self):
+        """Purchase a Pet that doesn't exist"""
+        self.assertIsNone(Pet.purchase(1))
+
+    def test_find_with_cache(self):
+        """Find a Pet through the in-process cache"""
+        Pet(0, "fido", "dog").save()
+        Pet.enable_cache(maxsize=10, ttl=60)
+        try:
+            self.assertEqual(Pet.find(1).name, "fido")
+            self.assertEqual(Pet.find(1).name, "fido")
+            stats = Pet.cache.stats()
+            self.assertEqual(stats["hits"], 1)
+            self.assertEqual(stats["misses"], 1)
+            # saving in this process drops the cached copy right away
+            pet = Pet.find(1)
+            pet.name = "rex"
+            pet.save()
+            self.assertEqual(Pet.find(1).name, "rex")
+            # deleted Pets are not served from the cache
+            pet.delete()
+            self.assertIsNone(Pet.find(1))
+        finally:
+            Pet.disable_cache()
+
+    def test_cache_filled_from_primary(self):
+        """Never cache a copy of a Pet that a lagging replica returned"""
+        Pet(0, "fido", "dog").save()
+        Pet.enable_cache(maxsize=10, ttl=60)
+        try:
+            with patch.object(Pet.storage, "get", wraps=Pet.storage.get) as get:
+                Pet.find(1)
+            get.assert_called_once_with(1, Pet.stored_fields, True)
+        finally:
+            Pet.disable_cache()
+
+    def test_cache_skips_pets_changed_while_read(self):
+        """Do not cache a Pet that was invalidated while it was being read"""
+        Pet(0, "fido", "dog").save()
+        Pet.enable_cache(maxsize=10, ttl=60)
+        get = Pet.storage.get
+
+        def get_and_invalidate(*args):
+            values = get(*args)
+            Pet.cache.invalidate(1)  # another worker changes the Pet
+            return values
+
+        try:
+            with patch.object(Pet.storage, "get", side_effect=get_and_invalidate):
+                self.assertEqual(Pet.find(1).name, "fido")
+            self.assertEqual(Pet.cache.stats()["size"], 0)
+            Pet.find(1)
+            self.assertEqual(Pet.cache.stats()["size"], 1)
+        finally:
+            Pet.disable_cache()
+
+    def test_cache_invalidated_by_other_workers(self):
+        """Drop cached Pets that another worker changed"""
+        Pet(0, "fido", "dog").save()
+        Pet.enable_cache(maxsize=10, ttl=60)
+        try:
+            Pet.find(1)
+            # another worker changes the Pet and announces it
+            Pet.redis.hset(Pet.key(1), "name", json.dumps("rex"))
+            Pet.redis.publish("pet:invalidate", 1)
+            for _ in range(50):
+                if Pet.cache.stats()["size"] == 0:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(Pet.find(1).name, "rex")
+        finally:
+            Pet.disable_cache()
+
+    @patch.dict(os.environ, {"PET_CACHE_SIZE": "5", "PET_CACHE_TTL": "10"})
+    def test_cache_from_environment(self):
+        """Turn on the cache from the environment"""
+        Pet.init_db()
+        try:
+            self.assertEqual(Pet.cache.stats()["maxsize"], 5)
+            self.assertEqual(Pet.cache.ttl, 10)
+        finally:
+            Pet.disable_cache()
+
+    def test_response_cache(self):
+        """Cached responses are only returned for the current catalog"""
+        version, body = Pet.get_response("all")
+        self.assertIsNone(body)
+        Pet.set_response("all", version, "[]", 60)
+        self.assertEqual(Pet.get_response("all"), (version, "[]"))
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        self.assertEqual(Pet.get_response("all"), (pet.version, None))
+        Pet.set_response("all", pet.version, "[1]", 60)
+        pet.delete()
+        self.assertIsNone(Pet.get_response("all")[1])
+
+    def test_paginate(self):
+        """Page through the Pets with a cursor"""
+        for i in range(5):
+            Pet(0, "pet{}".format(i), "dog" if i % 2 else "cat").save()
+        pets, cursor = Pet.paginate(2)
+        self.assertEqual([pet.id for pet in pets], [1, 2])
+        self.assertIsNotNone(cursor)
+        pets, cursor = Pet.paginate(2, cursor)
+        self.assertEqual([pet.id for pet in pets], [3, 4])
+        pets, cursor = Pet.paginate(2, cursor)
+        self.assertEqual([pet.id for pet in pets], [5])
+        self.assertIsNone(cursor)
+        pets, cursor = Pet.paginate(10, None, "category", "DOG")
+        self.assertEqual([pet.id for pet in pets], [2, 4])
+        self.assertIsNone(cursor)
+
+    def test_iter_query(self):
+        """Iterate over the Pets in id order a batch at a time"""
+        for i in range(5):
+            Pet(0, "pet{}".format(i), "dog" if i % 2 else "cat").save()
+        pets = list(Pet.iter_query(batch_size=2))
+        self.assertEqual([pet.id for pet in pets], [1, 2, 3, 4, 5])
+        pets = list(Pet.iter_query("category", "cat", batch_size=1))
+        self.assertEqual([pet.id for pet in pets], [1, 3, 5])
+        self.assertEqual(list(Pet.iter_query("category", None)), [])
+
+    def test_iter_json(self):
+        """Iterate over the stored JSON of the Pets"""
+        for i in range(5):
+            Pet(0, "pet{}".format(i), "dog" if i % 2 else None).save()
+        pets = list(Pet.iter_json(batch_size=2))
+        self.assertEqual(
+            [json.loads(pet) for pet in pets],
+            [pet.serialize() for pet in Pet.all()],
+        )
+        pets = list(Pet.iter_json("category", "DOG", batch_size=1))
+        self.assertEqual([json.loads(pet)["id"] for pet in pets], [2, 4])
+        self.assertEqual(list(Pet.iter_json("category", None)), [])
+
+    def test_pet_has_no_dict(self):
+        """Pets are stored in slots"""
+        pet = Pet(0, "fido", "dog")
+        self.assertFalse(hasattr(pet, "__dict__"))
+        self.assertRaises(AttributeError, setattr, pet, "color", "brown")
+
+    def test_paginate_bad_cursor(self):
+        """Page with a cursor that is not valid"""
+        self.assertRaises(DataValidationError, Pet.paginate, 2, "not-a-cursor!")
+
     def test_for_case_insensitive(self):
         """Test for Case Insensitive Search"""
         Pet(0, "Fido", "DOG").save()
@@ -222,6 +546,34 @@ class TestPets(unittest.TestCase):
         Pet.init_db()
         self.assertIsNotNone(Pet.redis)
 
+    def test_connection_pool_is_shared(self):
+        """Reuse one connection pool for every connection"""
+        Pet.init_db()
+        pool = Pet.redis.connection_pool
+        Pet.init_db()
+        self.assertIs(Pet.redis.connection_pool, pool)
+        stats = Pet.pool_stats()
+        self.assertEqual(stats["max_connections"], pool.max_connections)
+        self.assertGreaterEqual(stats["created"], 1)
+        self.assertEqual(stats["in_use"] + stats["idle"], stats["created"])
+
+    @patch.dict(os.environ, {"REDIS_MAX_CONNECTIONS": "7"})
+    def test_connection_pool_settings(self):
+        """Configure the connection pool from the environment"""
+        Pet.pool = None
+        Pet.init_db()
+        self.assertEqual(Pet.pool_stats()["max_connections"], 7)
+        self.assertEqual(Pet.redis.connection_pool.max_connections, 7)
+        Pet.pool = None
+        Pet.init_db()
+
+    def test_pool_stats_for_client_connection(self):
+        """Report pool usage for a client connection that was passed in"""
+        Pet.init_db(Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True))
+        stats = Pet.pool_stats()
+        self.assertGreaterEqual(stats["created"], 1)
+        Pet.init_db()
+
     def test_redis_connection_error(self):
         """Test a Bad Redis connection"""
         with patch("redis.Redis.ping") as ping_error_mock:
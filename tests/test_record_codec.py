@@ -0,0 +1,237 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Record Format Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+import json
+import unittest
+import threading
+from unittest.mock import patch
+from redis import Redis
+from service import record_codec
+from service.models import Pet, DataValidationError, VersionConflictError
+from service.storage import RECORD_FIELD, MemoryStorage
+
+VALUES = ["fido é/\x00", None, True, False, 3, 2.5, ["a", 1], {"b": None}, "x" * 300]
+
+PACKED_FORMATS = [
+    base + compression for base in record_codec.FORMATS for compression in ("", "+zlib")
+]
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRecordCodec(unittest.TestCase):
+    """Test Cases for the record formats"""
+
+    def setUp(self):
+        self.name = record_codec.name
+
+    def tearDown(self):
+        record_codec.use(self.name)
+
+    def test_formats_agree(self):
+        """Every format reads what the others write"""
+        records = []
+        for name in PACKED_FORMATS:
+            record_codec.use(name)
+            self.assertTrue(record_codec.packed())
+            records.append(record_codec.pack(VALUES))
+        for name in PACKED_FORMATS + ["json"]:
+            record_codec.use(name)
+            for record in records:
+                self.assertEqual(record_codec.unpack(record), VALUES)
+
+    def test_records_read_as_text(self):
+        """Read records that Redis returned as text"""
+        for name in PACKED_FORMATS:
+            record_codec.use(name)
+            record = record_codec.pack(VALUES)
+            text = record.decode("utf-8", "surrogateescape")
+            self.assertEqual(record_codec.to_bytes(text), record)
+            self.assertEqual(record_codec.unpack(text), VALUES)
+
+    def test_compact_records_are_small(self):
+        """Store a Pet in fewer bytes than its JSON values"""
+        record_codec.use("compact")
+        record = record_codec.pack(["fido", "dog", True])
+        self.assertEqual(len(record), 13)
+        record_codec.use("compact+zlib")
+        self.assertEqual(record_codec.pack(["fido", "dog", True]), record)
+        self.assertLess(len(record_codec.pack(["x" * 300])), 300)
+
+    def test_bad_records(self):
+        """Invalid records raise a ValueError"""
+        for record in [b"", b"\x7f", b"\x01\x09", b"\x81xyz", b"\x01\x03\x05ab"]:
+            self.assertRaises(ValueError, record_codec.unpack, record)
+
+    def test_unknown_format(self):
+        """Pick a format that does not exist"""
+        for name in ["protobuf", "json+zlib", "compact+lz4"]:
+            self.assertRaises(ValueError, record_codec.use, name)
+        self.assertEqual(record_codec.name, self.name)
+        record_codec.use("json")
+        self.assertFalse(record_codec.packed())
+
+
+class TestPackedRecords(unittest.TestCase):
+    """Test Cases for Pets stored in packed records"""
+
+    @classmethod
+    def setUpClass(cls):
+        """initialize the database"""
+        Pet.init_db()
+
+    def setUp(self):
+        """Start in a good known state"""
+        self.name = record_codec.name
+        record_codec.use("compact")
+        Pet.remove_all()
+
+    def tearDown(self):
+        record_codec.use(self.name)
+
+    def test_save_a_packed_pet(self):
+        """Store the values of a Pet in one record"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        stored = Pet.redis.hgetall(Pet.key(1))
+        self.assertNotIn("name", stored)
+        self.assertEqual(
+            record_codec.unpack(stored[RECORD_FIELD]), ["fido", "dog", True]
+        )
+        found = Pet.find(1)
+        self.assertEqual(found.serialize(), pet.serialize())
+        self.assertEqual(found.version, pet.version)
+        self.assertEqual([pet.id for pet in Pet.find_by_category("DOG")], [1])
+
+    def test_read_every_format(self):
+        """Find, list and serialize Pets stored in any format"""
+        formats = ["json"] + PACKED_FORMATS
+        for name in formats:
+            record_codec.use(name)
+            Pet(0, name, "dog").save()
+        for name in formats:
+            record_codec.use(name)
+            self.assertEqual(Pet.find(1).name, "json")
+            self.assertEqual([pet.name for pet in Pet.all()], formats)
+            self.assertEqual(
+                [json.loads(data)["name"] for data in Pet.iter_json()], formats
+            )
+            self.assertEqual(len(Pet.find_by_category("dog")), len(formats))
+
+    def test_change_the_format_on_save(self):
+        """Convert a Pet to the current format whenever it is saved"""
+        record_codec.use("json")
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        record_codec.use("compact")
+        pet.save()
+        self.assertEqual(Pet.redis.hkeys(Pet.key(1)).count("name"), 0)
+        record_codec.use("json")
+        pet.save()
+        self.assertEqual(Pet.redis.hget(Pet.key(1), "name"), '"fido"')
+        self.assertFalse(Pet.redis.hexists(Pet.key(1), RECORD_FIELD))
+
+    def test_update_and_purchase(self):
+        """Update and purchase Pets in packed records"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        first = pet.version
+        self.assertRaises(
+            VersionConflictError, Pet.update_fields, 1, if_match=[0], name="x"
+        )
+        pet = Pet.update_fields(1, if_match=[first], category="k9")
+        self.assertEqual(pet.category, "k9")
+        self.assertEqual(Pet.find(1).version, pet.version)
+        self.assertEqual([pet.id for pet in Pet.find_by_category("k9")], [1])
+        self.assertEqual(Pet.find_by_category("dog"), [])
+        record_codec.use("json")  # a worker that still writes JSON
+        self.assertFalse(Pet.purchase(1).available)
+        self.assertEqual(Pet.find_by_availability(True), [])
+        self.assertRaises(DataValidationError, Pet.purchase, 1)
+        self.assertIsNone(Pet.update_fields(2, name="x"))
+        self.assertIsNone(Pet.purchase(2))
+
+    def test_concurrent_purchases(self):
+        """Sell a packed Pet only once when many threads buy it at the same time"""
+        Pet(0, "fido", "dog").save()
+        sold = []
+
+        def buy():
+            try:
+                sold.append(Pet.purchase(1))
+            except DataValidationError:
+                pass
+
+        threads = [threading.Thread(target=buy) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(sold), 1)
+        self.assertFalse(Pet.find(1).available)
+
+    def test_reencode(self):
+        """Rewrite the Pets that are stored in another format"""
+        record_codec.use("json")
+        Pet.create_many([Pet(0, "pet{}".format(i), "dog") for i in range(5)])
+        record_codec.use("compact")
+        Pet(0, "rex", "dog").save()
+        Pet.batch_size, batch_size = 2, Pet.batch_size
+        try:
+            self.assertEqual(Pet.reencode(), 5)
+        finally:
+            Pet.batch_size = batch_size
+        self.assertEqual(Pet.reencode(), 0)
+        for pet_id in range(1, 7):
+            self.assertEqual(Pet.redis.hkeys(Pet.key(pet_id)).count("name"), 0)
+        self.assertEqual(len(Pet.all()), 6)
+        record_codec.use(
+            "msgpack+zlib" if "msgpack" in record_codec.FORMATS else "json"
+        )
+        self.assertEqual(Pet.reencode(), 6)
+
+    def test_client_that_can_not_read_records(self):
+        """Refuse a client that decodes the packed records strictly"""
+        client = Redis(decode_responses=True)
+        self.assertFalse(record_codec.readable(client))
+        self.assertRaises(ValueError, Pet.init_db, client)
+        self.assertTrue(record_codec.readable(Pet.redis))
+        self.assertTrue(record_codec.readable(Redis()))
+        record_codec.use("json")
+        self.assertTrue(record_codec.readable(client))
+
+    def test_memory_storage(self):
+        """Keep packed records in memory"""
+        with patch.dict("os.environ", {"PET_STORAGE": "memory"}):
+            Pet.init_db()
+            try:
+                self.assertIsInstance(Pet.storage, MemoryStorage)
+                Pet(0, "fido", "dog").save()
+                record_codec.use("json")
+                Pet.update_fields(1, name="rex")
+                self.assertEqual(Pet.purchase(1).name, "rex")
+                self.assertEqual(Pet.reencode(), 0)
+                record_codec.use("compact")
+                self.assertEqual(Pet.reencode(), 1)
+                self.assertEqual(Pet.find_by_availability(False)[0].name, "rex")
+            finally:
+                Pet.remove_all()
+        Pet.init_db()
@@ -0,0 +1,203 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Read Replica Test Suite
+
+The Sentinel tests only run when REDIS_SENTINELS names the Sentinels of a
+primary with at least one replica, e.g. REDIS_SENTINELS=127.0.0.1:26379
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import os
+import json
+import time
+import unittest
+from unittest.mock import patch
+from redis import ConnectionError
+from redis.sentinel import Sentinel
+from service.models import Pet
+
+REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_SENTINELS = os.getenv("REDIS_SENTINELS")
+REDIS_SENTINEL_MASTER = os.getenv("REDIS_SENTINEL_MASTER", "mymaster")
+
+
+def vcap_services(**credentials):
+    """Returns VCAP_SERVICES with the given Redis credentials"""
+    return json.dumps({"rediscloud": [{"credentials": credentials}]})
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestReplicaConfiguration(unittest.TestCase):
+    """Test Cases for configuring replicas and Sentinel"""
+
+    @patch.dict(
+        os.environ,
+        {"REDIS_SENTINELS": "10.0.0.1:26379,10.0.0.2:26379", "REDIS_PASSWORD": "x"},
+    )
+    def test_sentinels_from_environment(self):
+        """Find the Sentinels in REDIS_SENTINELS"""
+        sentinels, master_name, password = Pet.sentinel_credentials()
+        self.assertEqual(sentinels, [("10.0.0.1", 26379), ("10.0.0.2", 26379)])
+        self.assertEqual(master_name, "mymaster")
+        self.assertEqual(password, "x")
+
+    def test_sentinels_from_vcap_services(self):
+        """Find the Sentinels in VCAP_SERVICES"""
+        vcap = vcap_services(
+            hostname="redis",
+            port=6379,
+            password="secret",
+            master_name="pets",
+            sentinels=[{"hostname": "sentinel-1", "port": "26379"}],
+        )
+        with patch.dict(os.environ, {"VCAP_SERVICES": vcap}):
+            self.assertEqual(
+                Pet.sentinel_credentials(),
+                ([("sentinel-1", 26379)], "pets", "secret"),
+            )
+            self.assertEqual(Pet.replica_credentials(), [])
+
+    @patch.dict(
+        os.environ,
+        {"REDIS_REPLICAS": "replica-1:6379, replica-2:6380", "REDIS_SENTINELS": ""},
+    )
+    def test_replicas_from_environment(self):
+        """Find the replicas in REDIS_REPLICAS"""
+        self.assertIsNone(Pet.sentinel_credentials())
+        self.assertEqual(
+            Pet.replica_credentials(), [("replica-1", 6379), ("replica-2", 6380)]
+        )
+
+    def test_replicas_from_vcap_services(self):
+        """Find the replicas in VCAP_SERVICES"""
+        vcap = vcap_services(
+            hostname="redis",
+            port=6379,
+            password="",
+            replicas=[{"hostname": "replica-1", "port": 6379}],
+        )
+        with patch.dict(os.environ, {"VCAP_SERVICES": vcap}):
+            self.assertIsNone(Pet.sentinel_credentials())
+            self.assertEqual(Pet.replica_credentials(), [("replica-1", 6379)])
+
+    @patch.dict(os.environ, {"REDIS_REPLICAS": "", "REDIS_SENTINELS": ""})
+    def test_no_replicas(self):
+        """Use the primary for everything unless replicas are configured"""
+        self.assertIsNone(Pet.sentinel_credentials())
+        self.assertEqual(Pet.replica_credentials(), [])
+
+
+class TestReplicaRouting(unittest.TestCase):
+    """Test Cases for sending reads to replicas"""
+
+    def setUp(self):
+        """Use the Redis we test against as its own replica"""
+        replica = "{}:{}".format(REDIS_HOST, REDIS_PORT)
+        with patch.dict(os.environ, {"REDIS_REPLICAS": replica, "REDIS_SENTINELS": ""}):
+            Pet.init_db()
+        Pet.remove_all()
+
+    def tearDown(self):
+        """Go back to the primary alone"""
+        Pet.init_db()
+
+    def test_reads_go_to_replicas(self):
+        """Read from the replica and write to the primary"""
+        self.assertEqual(len(Pet.replicas), 1)
+        replica = Pet.replicas[0]
+        with patch.object(replica, "execute_command", side_effect=AssertionError):
+            Pet(0, "fido", "dog").save()
+            Pet.purchase(1)
+            Pet.update_fields(1, category="k9")
+        with patch.object(
+            replica, "execute_command", wraps=replica.execute_command
+        ) as reads:
+            self.assertEqual(Pet.find(1).category, "k9")
+            self.assertEqual(reads.call_count, 1)
+            self.assertEqual(Pet.find(1, primary=True).category, "k9")
+            self.assertEqual(reads.call_count, 1)
+        with patch.object(replica, "pipeline", wraps=replica.pipeline) as reads:
+            self.assertEqual(len(Pet.all()), 1)
+            Pet.get_response("all")
+            self.assertEqual(reads.call_count, 2)
+
+    def test_pool_stats_include_replicas(self):
+        """Count the connections to the replicas"""
+        stats = Pet.pool_stats()
+        self.assertEqual(
+            stats["max_connections"],
+            Pet.redis.connection_pool.max_connections
+            + Pet.replicas[0].connection_pool.max_connections,
+        )
+
+    def test_replica_down(self):
+        """Read from the primary when a replica cannot be reached"""
+        with patch.dict(
+            os.environ, {"REDIS_REPLICAS": "127.0.0.1:1", "REDIS_SENTINELS": ""}
+        ):
+            Pet.init_db()
+        Pet(0, "fido", "dog").save()
+        self.assertEqual(Pet.find(1).name, "fido")
+        self.assertEqual(len(Pet.find_by_category("dog")), 1)
+        self.assertIsNone(Pet.get_response("all")[1])
+
+
+@unittest.skipUnless(REDIS_SENTINELS, "needs REDIS_SENTINELS")
+class TestSentinel(unittest.TestCase):
+    """Test Cases for a primary and replicas monitored by Sentinel"""
+
+    def setUp(self):
+        """Connect through the Sentinels"""
+        Pet.init_db()
+        Pet.remove_all()
+
+    def test_init_db(self):
+        """Find the primary and the replicas through the Sentinels"""
+        self.assertEqual(Pet.redis.info("replication")["role"], "master")
+        self.assertEqual(len(Pet.replicas), 1)
+        Pet(0, "fido", "dog").save()
+        Pet.redis.wait(1, 1000)
+        self.assertEqual(Pet.find(1).name, "fido")
+        self.assertEqual(len(Pet.all()), 1)
+
+    def test_failover(self):
+        """Keep working when a replica is promoted to primary"""
+        sentinel = Sentinel(Pet.sentinel_credentials()[0], socket_timeout=1)
+        primary = sentinel.discover_master(REDIS_SENTINEL_MASTER)
+        Pet(0, "fido", "dog").save()
+        Pet.redis.wait(1, 1000)
+        sentinel.sentinels[0].execute_command(
+            "SENTINEL FAILOVER", REDIS_SENTINEL_MASTER
+        )
+        for _ in range(100):
+            if sentinel.discover_master(REDIS_SENTINEL_MASTER) != primary:
+                break
+            time.sleep(0.1)
+        self.assertNotEqual(sentinel.discover_master(REDIS_SENTINEL_MASTER), primary)
+        # writes that were on their way to the old primary fail once
+        for _ in range(100):
+            try:
+                Pet(0, "rex", "dog").save()
+                break
+            except ConnectionError:
+                time.sleep(0.1)
+        self.assertEqual(Pet.find(2, primary=True).name, "rex")
+        self.assertEqual(Pet.find(1, primary=True).name, "fido")
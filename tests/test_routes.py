@@ -18,8 +18,10 @@ Pet API Service Test Suite
 Test cases can be run with the following:
 nosetests -v --with-spec --spec-color
 """
+import json
 import unittest
 import logging
+from unittest.mock import patch
 from service import app, status # HTTP Status Codes
 from service.routes import initialize_logging, init_db, data_reset, data_load
 
@@ -87,6 +89,66 @@ class TestPetService(unittest.TestCase):
         self.assertEqual(len(data), pet_count + 1)
         self.assertIn(new_json, data)
 
+    def test_create_pet_with_a_huge_number(self):
+        """Create a Pet with a number that does not fit in 64 bits"""
+        new_pet = {"name": 10**20, "category": "snake", "available": True}
+        resp = self.app.post("/pets", json=new_pet, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIn(b'"name":100000000000000000000', resp.data.replace(b" ", b""))
+        resp = self.app.get("/pets", query_string={"name": str(10**20)})
+        self.assertEqual(len(resp.get_json()), 1)
+
+    def test_create_pet_batch(self):
+        """Create a batch of Pets"""
+        new_pets = [
+            {"name": "sammy", "category": "snake", "available": True},
+            {"name": "polly", "category": "bird", "available": False},
+        ]
+        resp = self.app.post("/pets/batch", json=new_pets)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual([item["status"] for item in data], [201, 201])
+        self.assertEqual([item["pet"]["id"] for item in data], [3, 4])
+        self.assertTrue(data[1]["location"].endswith("/pets/4"))
+        self.assertEqual(self.get_pet_count(), 4)
+
+    def test_create_pet_batch_with_bad_items(self):
+        """Create a batch of Pets where some are bad"""
+        new_pets = [
+            {"name": "sammy", "category": "snake", "available": True},
+            {"category": "bird", "available": False},
+        ]
+        resp = self.app.post("/pets/batch", json=new_pets)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(data[0]["status"], status.HTTP_201_CREATED)
+        self.assertEqual(data[1]["status"], status.HTTP_400_BAD_REQUEST)
+        self.assertIn("missing name", data[1]["error"])
+        self.assertEqual(self.get_pet_count(), 3)
+
+    def test_create_pet_batch_ndjson(self):
+        """Create a batch of Pets from NDJSON"""
+        body = "\n".join(
+            [
+                json.dumps({"name": "sammy", "category": "snake", "available": True}),
+                "not json",
+                "",
+            ]
+        )
+        resp = self.app.post(
+            "/pets/batch", data=body, content_type="application/x-ndjson"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]["pet"]["name"], "sammy")
+        self.assertEqual(data[1]["status"], status.HTTP_400_BAD_REQUEST)
+
+    def test_create_pet_batch_not_a_list(self):
+        """Create a batch of Pets that is not a list"""
+        resp = self.app.post("/pets/batch", json={"name": "sammy"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_pet(self):
         """Update a Pet"""
         new_kitty = {"name": "kitty", "category": "tabby", "available": True}
@@ -97,6 +159,124 @@ class TestPetService(unittest.TestCase):
         new_json = resp.get_json()
         self.assertEqual(new_json["category"], "tabby")
 
+    def test_update_pet_batch(self):
+        """Update a batch of Pets"""
+        pets = [
+            {"id": 1, "name": "rex", "category": "k9", "available": True},
+            {"id": 2, "name": "kitty", "category": "tabby", "available": False},
+            {"id": 7, "name": "ghost", "category": "cat", "available": True},
+            {"name": "nobody", "category": "cat", "available": True},
+        ]
+        resp = self.app.put("/pets/batch", json=pets)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual([item["status"] for item in data], [200, 200, 404, 400])
+        self.assertEqual(data[0]["pet"]["name"], "rex")
+        resp = self.app.get("/pets/2")
+        self.assertEqual(resp.get_json()["category"], "tabby")
+        self.assertEqual(self.get_pet_count(), 2)
+
+    def test_delete_pet_batch(self):
+        """Delete a batch of Pets"""
+        resp = self.app.delete("/pets/batch", json=[1, 2])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([item["id"] for item in data], [1, 2])
+        self.assertEqual(self.get_pet_count(), 0)
+        resp = self.app.delete("/pets/batch", json=[1, "x"])
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual([item["status"] for item in data], [404, 400])
+
+    def test_patch_pet(self):
+        """Partially update a Pet"""
+        resp = self.app.patch("/pets/2", json={"available": False})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["name"], "kitty")
+        self.assertEqual(data["available"], False)
+        resp = self.app.get("/pets", query_string="available=false")
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["kitty"])
+
+    def test_get_pet_not_modified(self):
+        """Get a Pet that has not changed since the client read it"""
+        resp = self.app.get("/pets/2")
+        etag = resp.headers["ETag"]
+        self.assertFalse(etag.startswith("W/"))
+        resp = self.app.get("/pets/2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        self.app.patch("/pets/2", json={"category": "tabby"})
+        resp = self.app.get("/pets/2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_query_pet_list_is_cached(self):
+        """Repeat queries are served from the response cache"""
+        resp = self.app.get("/pets", query_string="category=cat")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        with patch("service.models.Pet.iter_json") as iter_json:
+            resp = self.app.get("/pets", query_string="category=CAT")
+            self.assertFalse(iter_json.called)
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["kitty"])
+        self.assertEqual(resp.content_type, "application/json")
+        # any change to the catalog makes the cached response stale
+        data_load({"name": "tom", "category": "cat", "available": True})
+        resp = self.app.get("/pets", query_string="category=cat")
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["kitty", "tom"])
+        self.app.delete("/pets/2")
+        resp = self.app.get("/pets", query_string="category=cat")
+        self.assertEqual([pet["name"] for pet in resp.get_json()], ["tom"])
+
+    def test_get_pet_list_not_modified(self):
+        """Get a list of Pets that has not changed"""
+        resp = self.app.get("/pets")
+        etag = resp.headers["ETag"]
+        resp = self.app.get("/pets", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.put("/pets/2/purchase")
+        resp = self.app.get("/pets", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_update_pet_if_match(self):
+        """Update a Pet only if it has not changed"""
+        etag = self.app.get("/pets/2").headers["ETag"]
+        new_kitty = {"name": "kitty", "category": "tabby", "available": True}
+        resp = self.app.put("/pets/2", json=new_kitty, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        # the second write with the same ETag lost the race
+        resp = self.app.put("/pets/2", json=new_kitty, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.patch("/pets/2", json={"name": "x"}, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put("/pets/2/purchase", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete("/pets/2", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete("/pets/2", headers={"If-Match": "W/" + etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.get_pet_count(), 2)
+        resp = self.app.delete("/pets/2", headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_patch_pet_bad_requests(self):
+        """Partially update a Pet with bad requests"""
+        resp = self.app.patch("/pets/0", json={"available": False})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.patch("/pets/2", json={"color": "red"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch("/pets/2", json=["available"])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for body in [{"pet_id": 3}, {"if_match": ["1"]}, {"available": "false"}]:
+            resp = self.app.patch("/pets/2", json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        new_pet = {"name": "kitty", "category": "cat", "available": "false"}
+        resp = self.app.put("/pets/2", json=new_pet)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put("/pets/2/purchase")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
     def test_update_pet_with_no_name(self):
         """Update a Pet without assigning a name"""
         new_pet = {"category": "dog"}
@@ -120,6 +300,13 @@ class TestPetService(unittest.TestCase):
         new_count = self.get_pet_count()
         self.assertEqual(new_count, pet_count - 1)
 
+    def test_delete_pet_not_found(self):
+        """Delete a Pet that doesn't exist"""
+        pet_count = self.get_pet_count()
+        resp = self.app.delete("/pets/5", content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.get_pet_count(), pet_count)
+
     def test_create_pet_with_no_name(self):
         """Create a Pet without a name"""
         new_pet = {"category": "dog"}
@@ -154,6 +341,52 @@ class TestPetService(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item["category"], "dog")
 
+    def test_get_pet_list_paged(self):
+        """Page through the list of Pets"""
+        resp = self.app.get("/pets", query_string="limit=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["name"], "fido")
+        self.assertIn('rel="next"', resp.headers["Link"])
+        next_url = resp.headers["Link"].split(">")[0].lstrip("<")
+        resp = self.app.get(next_url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["name"], "kitty")
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_pet_list_bad_page(self):
+        """Page through the list of Pets with bad parameters"""
+        resp = self.app.get("/pets", query_string="limit=zero")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/pets", query_string="cursor=@@@")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_pet_list(self):
+        """Stream the list of Pets as a JSON array"""
+        resp = self.app.get("/pets", query_string="stream=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, "application/json")
+        data = resp.get_json()
+        self.assertEqual([pet["name"] for pet in data], ["fido", "kitty"])
+        resp = self.app.get("/pets", query_string="stream=true&category=bird")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_stream_pet_list_ndjson(self):
+        """Stream the list of Pets as NDJSON"""
+        resp = self.app.get(
+            "/pets",
+            query_string="category=cat",
+            headers={"Accept": "application/x-ndjson"},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])["name"], "kitty")
+
     def test_purchase_a_pet(self):
         """Purchase a Pet"""
         resp = self.app.put("/pets/2/purchase", content_type="application/json")
@@ -172,6 +405,11 @@ class TestPetService(unittest.TestCase):
         resp_json = resp.get_json()
         self.assertIn("not available", resp_json["message"])
 
+    def test_purchase_not_found(self):
+        """Purchase a Pet that doesn't exist"""
+        resp = self.app.put("/pets/5/purchase", content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     ######################################################################
     # Utility functions
     ######################################################################
@@ -0,0 +1,244 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-Memory Storage Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import json
+import unittest
+import threading
+from unittest.mock import patch
+from service import app, status
+from service.models import Pet, DataValidationError, VersionConflictError
+from service.storage import MemoryStorage, RedisStorage
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMemoryStorage(unittest.TestCase):
+    """Test Cases for the Pet Model stored in memory"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Store the Pets in memory"""
+        cls.environment = patch.dict("os.environ", {"PET_STORAGE": "memory"})
+        cls.environment.start()
+        Pet.init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Go back to Redis for the other tests"""
+        cls.environment.stop()
+        Pet.init_db()
+
+    def setUp(self):
+        """Start in a good known state"""
+        Pet.remove_all()
+
+    def test_init_db(self):
+        """Initialize the model without Redis"""
+        self.assertIsInstance(Pet.storage, MemoryStorage)
+        self.assertIsNone(Pet.redis)
+        Pet(0, "fido", "dog").save()
+        Pet.init_db()
+        self.assertEqual(Pet.find(1).name, "fido")
+
+    def test_unknown_engine(self):
+        """Refuse to start with an unknown storage engine"""
+        with patch.dict("os.environ", {"PET_STORAGE": "floppy"}):
+            self.assertRaises(ValueError, Pet.init_db)
+        self.assertIsInstance(Pet.storage, MemoryStorage)
+
+    def test_crud(self):
+        """Create, read, update and delete Pets"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        self.assertEqual(pet.id, 1)
+        found = Pet.find(1)
+        self.assertEqual(found.serialize(), pet.serialize())
+        self.assertEqual(found.version, pet.version)
+        pet.category = "k9"
+        pet.save()
+        self.assertEqual(Pet.find(1).category, "k9")
+        pet.delete()
+        self.assertIsNone(Pet.find(1))
+        self.assertEqual(Pet.all(), [])
+        self.assertRaises(DataValidationError, Pet(0, None).save)
+
+    def test_indexes_follow_updates(self):
+        """Keep the indexes in step with every write"""
+        fido = Pet(0, "fido", "dog")
+        fido.save()
+        Pet(0, "kitty", "cat").save()
+        self.assertEqual([pet.name for pet in Pet.find_by_category("DOG")], ["fido"])
+        fido.category = "cat"
+        fido.save()
+        self.assertEqual(Pet.find_by_category("dog"), [])
+        self.assertEqual(len(Pet.find_by_category("cat")), 2)
+        Pet.update_fields(2, name="Tom")
+        self.assertEqual([pet.id for pet in Pet.find_by_name("tom")], [2])
+        self.assertEqual(Pet.find_by_name("kitty"), [])
+        Pet.purchase(2)
+        self.assertEqual([pet.id for pet in Pet.find_by_availability(True)], [1])
+        self.assertRaises(DataValidationError, Pet.purchase, 2)
+        fido.delete()
+        self.assertEqual([pet.id for pet in Pet.find_by_category("cat")], [2])
+        self.assertEqual(Pet.find_by_availability(True), [])
+
+    def test_versions(self):
+        """Refuse writes made against an old version"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        first = pet.version
+        pet.save(if_match=[first])
+        self.assertTrue(pet.version > first)
+        self.assertRaises(VersionConflictError, pet.save, if_match=[first])
+        self.assertRaises(VersionConflictError, Pet.purchase, 1, if_match=[first])
+        self.assertRaises(
+            VersionConflictError, Pet.update_fields, 1, if_match=[first], name="x"
+        )
+        self.assertRaises(VersionConflictError, pet.delete, if_match=[first])
+        pet.delete(if_match=[pet.version])
+        self.assertIsNone(Pet.update_fields(1, name="x"))
+        self.assertIsNone(Pet.purchase(1))
+
+    def test_versions_survive_remove_all(self):
+        """Keep counting versions when all Pets are removed"""
+        pet = Pet(0, "fido", "dog")
+        pet.save()
+        Pet.remove_all()
+        new_pet = Pet(0, "rex", "dog")
+        new_pet.save()
+        self.assertEqual(new_pet.id, 1)
+        self.assertGreater(new_pet.version, pet.version)
+
+    def test_bulk_operations(self):
+        """Create, restore, save and delete many Pets"""
+        pets = Pet.create_many([Pet(0, "pet{}".format(i), "dog") for i in range(5)])
+        self.assertEqual([pet.id for pet in pets], [1, 2, 3, 4, 5])
+        Pet.restore_many([Pet(10, "rex", "dog")])
+        self.assertEqual(Pet.find(10).name, "rex")
+        pet = Pet(0, "new", "dog")
+        pet.save()
+        self.assertEqual(pet.id, 11)
+        pets[0].name = "renamed"
+        self.assertEqual(Pet.save_many([pets[0], Pet(99, "ghost")]), [True, False])
+        self.assertEqual(Pet.find(1).name, "renamed")
+        self.assertIsNone(Pet.find(99))
+        self.assertEqual(Pet.delete_many([1, 2, 99]), [True, True, False])
+        self.assertEqual(len(Pet.all(batch_size=2)), 5)
+
+    def test_paginate(self):
+        """Page through the Pets with a cursor"""
+        for i in range(5):
+            Pet(0, "pet{}".format(i), "dog" if i % 2 else "cat").save()
+        pets, cursor = Pet.paginate(2)
+        self.assertEqual([pet.id for pet in pets], [1, 2])
+        pets, cursor = Pet.paginate(2, cursor)
+        self.assertEqual([pet.id for pet in pets], [3, 4])
+        pets, cursor = Pet.paginate(2, cursor)
+        self.assertEqual([pet.id for pet in pets], [5])
+        self.assertIsNone(cursor)
+        pets, cursor = Pet.paginate(10, None, "category", "DOG")
+        self.assertEqual([pet.id for pet in pets], [2, 4])
+
+    def test_iter_json(self):
+        """Serialize Pets straight from their stored values"""
+        Pet(0, "fido", "dog").save()
+        self.assertEqual(
+            [json.loads(pet) for pet in Pet.iter_json()],
+            [{"id": 1, "name": "fido", "category": "dog", "available": True}],
+        )
+
+    def test_response_cache(self):
+        """Cached responses are only returned for the current catalog"""
+        version, body = Pet.get_response("all")
+        Pet.set_response("all", version, "[]", 60)
+        self.assertEqual(Pet.get_response("all"), (version, "[]"))
+        Pet(0, "fido", "dog").save()
+        self.assertIsNone(Pet.get_response("all")[1])
+        version, body = Pet.get_response("all")
+        Pet.set_response("all", version, "[1]", 0)
+        self.assertIsNone(Pet.get_response("all")[1])
+
+    def test_response_cache_is_bounded(self):
+        """Keep only the most recent responses of the current catalog"""
+        storage = Pet.storage
+        version = storage.get_response("all")[0]
+        storage.set_response("old", version, "[]", 60)
+        Pet(0, "fido", "dog").save()
+        version = storage.get_response("all")[0]
+        storage.set_response("stale", version - 1, "[]", 60)
+        for i in range(storage.max_responses):
+            storage.set_response("name=q{}".format(i), version, "[]", 60)
+        self.assertEqual(len(storage._responses), storage.max_responses)
+        self.assertNotIn("old", storage._responses)
+        self.assertNotIn("stale", storage._responses)
+        storage.set_response("name=last", version, "[]", 60)
+        self.assertEqual(len(storage._responses), storage.max_responses)
+        self.assertIsNone(storage.get_response("name=q0")[1])
+        self.assertEqual(storage.get_response("name=last"), (version, "[]"))
+
+    def test_concurrent_purchases(self):
+        """Sell a Pet only once when many threads buy it at the same time"""
+        Pet(0, "fido", "dog").save()
+        sold = []
+
+        def buy():
+            try:
+                sold.append(Pet.purchase(1))
+            except DataValidationError:
+                pass
+
+        threads = [threading.Thread(target=buy) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(sold), 1)
+        self.assertFalse(Pet.find(1).available)
+
+    def test_cache_is_not_used(self):
+        """Never cache Pets that are already in memory"""
+        Pet.enable_cache(10, 60)
+        self.assertIsNone(Pet.cache)
+        self.assertEqual(Pet.migrate(), 0)
+
+    def test_routes(self):
+        """Serve the API without Redis"""
+        client = app.test_client()
+        pet = {"name": "fido", "category": "dog", "available": True}
+        response = client.post("/pets", json=pet)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = client.get("/pets", query_string={"category": "dog"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([pet["name"] for pet in response.get_json()], ["fido"])
+        response = client.put("/pets/1/purchase")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = client.get("/pets/1")
+        self.assertFalse(response.get_json()["available"])
+
+    def test_redis_engine_name(self):
+        """Use Redis unless told otherwise"""
+        with patch.dict("os.environ", {"PET_STORAGE": "redis"}):
+            Pet.init_db()
+            self.assertIsInstance(Pet.storage, RedisStorage)
+            self.assertIsNotNone(Pet.redis)
+        Pet.init_db()
+        self.assertIsInstance(Pet.storage, MemoryStorage)